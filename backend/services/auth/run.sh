@@ -1,4 +1,4 @@
 #!/usr/bin/env bash
 
 export PYTHONPATH=/var/www/backend:${PYTHONPATH}
-uwsgi --http-socket 0.0.0.0:5000 --master --workers 1 --module service.auth.app:app --vacuum --die-on-term
\ No newline at end of file
+uwsgi --http-socket 0.0.0.0:5000 --master --workers 1 --module service.auth.app:app --enable-threads --vacuum --die-on-term
\ No newline at end of file
@@ -7,9 +7,12 @@ from flask_sqlalchemy import SQLAlchemy
 
 from dao import UserDao
 from lib.models import Base
+from lib.queries import enable_query_counter
+from passwords import LoginThrottle
 from resources import (
-    RootResource, TokensResource, TokenChecksResource, UsersResource, UserResource, UserGroupsResource,
-    UserGroupResource, UserGroupUsersResource, UserGroupUserResource)
+    RootResource, TokensResource, TokenChecksResource, PermissionChecksResource, RevocationsResource, UsersResource,
+    UserResource, UserGroupsResource, UserGroupResource, UserGroupUsersResource, UserGroupUserResource,
+    LoginMetricsResource)
 
 app = Flask(__name__)
 
@@ -22,15 +25,26 @@ api = Api(app)
 api.add_resource(RootResource, RootResource.URI)
 api.add_resource(TokensResource, TokensResource.URI)
 api.add_resource(TokenChecksResource, TokenChecksResource.URI)
+api.add_resource(PermissionChecksResource, PermissionChecksResource.URI)
+api.add_resource(RevocationsResource, RevocationsResource.URI)
 api.add_resource(UsersResource, UsersResource.URI)
 api.add_resource(UserResource, UserResource.URI.format('<int:id>'))
 api.add_resource(UserGroupsResource, UserGroupsResource.URI)
 api.add_resource(UserGroupResource, UserGroupResource.URI.format('<int:id>'))
 api.add_resource(UserGroupUsersResource, UserGroupUsersResource.URI.format('<int:id>'))
 api.add_resource(UserGroupUserResource, UserGroupUserResource.URI.format('<int:id>', '<int:user_id>'))
+api.add_resource(LoginMetricsResource, LoginMetricsResource.URI)
 
 db = SQLAlchemy(app)
 
+if app.config.get('QUERY_COUNTER_ENABLED', False):
+    enable_query_counter(app)
+
+# Login throttles keep their counters in this process, so with multiple workers the effective
+# limits are LOGIN_MAX_ATTEMPTS_PER_USERNAME and LOGIN_MAX_ATTEMPTS_PER_IP times the number of workers
+username_throttle = LoginThrottle(app.config['LOGIN_MAX_ATTEMPTS_PER_USERNAME'], app.config['LOGIN_THROTTLE_WINDOW'])
+ip_throttle = LoginThrottle(app.config['LOGIN_MAX_ATTEMPTS_PER_IP'], app.config['LOGIN_THROTTLE_WINDOW'])
+
 
 # ----------------------------------------------------------------------------------------------------------------------
 def init_tables():
@@ -74,6 +88,8 @@ def init_db(drop=False):
 def before_request():
     g.config = app.config
     g.db_session = db.session
+    g.username_throttle = username_throttle
+    g.ip_throttle = ip_throttle
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -1,21 +1,83 @@
+import hashlib
+import json
 import logging
+import time
+import requests
+import lib.client as client
 from flask import request, g
 from functools import wraps
 from jose import jwt, JWTError
-from dao import UserDao
+import lib.http as http
+from dao import UserDao, RevocationDao
+from lib.authentication import token_header, user_from_claims
+from passwords import get_password_verifier, PasswordVerifierBusy
 
 logger = logging.getLogger(__name__)
 
 
+# ----------------------------------------------------------------------------------------------------------------------
+def token_algorithm():
+    return g.config.get('TOKEN_ALGORITHM', 'HS256')
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def signing_key():
+    # HMAC tokens are signed and verified with the secret key. Asymmetric tokens are signed
+    # with a private key so that downstream services only need the public key.
+    name = 'SECRET_KEY' if token_algorithm().startswith('HS') else 'TOKEN_SIGNING_KEY'
+    if name not in g.config.keys():
+        return None, 'Could not retrieve {}'.format(name)
+    if g.config[name] is None:
+        return None, '{} is empty'.format(name)
+    return g.config[name], None
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def verification_key():
+    name = 'SECRET_KEY' if token_algorithm().startswith('HS') else 'TOKEN_VERIFICATION_KEY'
+    if name not in g.config.keys():
+        return None, 'Could not retrieve {}'.format(name)
+    if g.config[name] is None:
+        return None, '{} is empty'.format(name)
+    return g.config[name], None
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def permissions_digest(user):
+    indexes = user.permission_index()
+    return hashlib.sha256(json.dumps([sorted(index.items()) for index in indexes])).hexdigest()[:16]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def token_claims(user):
+    now = int(time.time())
+    if g.config.get('TOKEN_FORMAT', 'compact') == 'full':
+        claims = user.to_dict()
+    else:
+        # Compact tokens only contain what services need to identify the user. Permissions
+        # are checked by the auth service, so only their version (and digest) is included.
+        claims = {
+            'ver': 2,
+            'sub': str(user.id),
+            'username': user.username,
+            'is_admin': user.is_admin,
+            'is_superuser': user.is_superuser,
+            'pv': user.permissions_version,
+        }
+        if g.config.get('TOKEN_PERMISSIONS_DIGEST', False):
+            claims['pd'] = permissions_digest(user)
+    claims['iat'] = now
+    claims['exp'] = now + g.config.get('TOKEN_LIFETIME', 3600)
+    return claims
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 def create_token(user):
-    if 'SECRET_KEY' not in g.config.keys():
-        return None, 'Could not retrieve secret key'
-    secret = g.config['SECRET_KEY']
-    if secret is None:
-        return None, 'Secret key is empty'
+    key, msg = signing_key()
+    if key is None:
+        return None, msg
     try:
-        token = jwt.encode(user.to_dict(), secret, algorithm='HS256')
+        token = jwt.encode(token_claims(user), key, algorithm=token_algorithm())
         return token, None
     except JWTError as e:
         return None, 'Could not encode token ({})'.format(e.message)
@@ -23,24 +85,82 @@ def create_token(user):
 
 # ----------------------------------------------------------------------------------------------------------------------
 def check_token(token):
-    if 'SECRET_KEY' not in g.config.keys():
-        return None, 'Could not retrieve secret key'
-    secret = g.config['SECRET_KEY']
-    if secret is None:
-        return None, 'Secret key is empty'
+    key, msg = verification_key()
+    if key is None:
+        return None, msg
     try:
-        data = jwt.decode(token, secret, algorithms=['HS256'])
+        data = jwt.decode(token, key, algorithms=[token_algorithm()])
     except JWTError as e:
         return None, 'Could not decode token ({})'.format(e.message)
+    user_id = user_from_claims(data)['id']
     user_dao = UserDao(g.db_session)
-    user = user_dao.retrieve(id=data['id'])
+    user = user_dao.retrieve(id=user_id)
     if user is None:
-        return None, 'User {} not found'.format(data['id'])
+        return None, 'User {} not found'.format(user_id)
     if not user.is_active:
         return None, 'User {} no longer active'.format(user.username)
+    # Tokens issued before the user was last deactivated stay invalid after it is restored
+    revocation = RevocationDao(g.db_session).retrieve(user_id=user_id)
+    if revocation is not None and data.get('iat', 0) <= revocation.revoked_at:
+        return None, 'Token for user {} revoked'.format(user.username)
     return user, None
 
 
+# ----------------------------------------------------------------------------------------------------------------------
+def revoke_user(user_id):
+    # Services that verify tokens locally poll the revocation list, so this is how
+    # deactivation and deletion of a user reach them.
+    revocation_dao = RevocationDao(g.db_session)
+    revocation = revocation_dao.retrieve(user_id=user_id)
+    if revocation is None:
+        revocation_dao.create(user_id=user_id, revoked_at=int(time.time()))
+    else:
+        revocation.revoked_at = int(time.time())
+        revocation_dao.save(revocation)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def restore_user(user_id):
+    # The revocation is kept as a cutoff so that tokens issued before it, e.g., leaked ones,
+    # do not become valid again. New tokens are issued after the cutoff. The revocation is
+    # removed by prune_revocations() once the tokens it applies to have expired.
+    prune_revocations()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def prune_revocations():
+    # Removes revocations older than the token lifetime. Tokens issued before them have
+    # expired, so they no longer need to be on the revocation list.
+    cutoff = int(time.time()) - g.config.get('TOKEN_LIFETIME', 3600)
+    RevocationDao(g.db_session).delete_older_than(cutoff)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def invalidate_cached_tokens(user_id):
+    # Tell services caching verified tokens that this user's cached verifications are stale,
+    # e.g., because the user was deactivated or its permissions changed. Services only accept
+    # this from administrators and the auth service's own account, so we authenticate with a
+    # token for the latter. Failures are only logged because cache entries expire by themselves.
+    service_user = UserDao(g.db_session).retrieve(username=g.config.get('SERVICE_USERNAME', 'auth'))
+    if service_user is None:
+        logger.warning('Could not invalidate cached tokens of user {} (No service account)'.format(user_id))
+        return
+    token, msg = create_token(service_user)
+    if token is None:
+        logger.warning('Could not invalidate cached tokens of user {} ({})'.format(user_id, msg))
+        return
+    for service in g.config.get('TOKEN_CACHE_SERVICES', []):
+        try:
+            response = client.post(
+                service, '/token-cache-invalidations', json={'user_id': user_id}, headers=token_header(token))
+            if response.status_code != 201:
+                logger.warning('Could not invalidate cached tokens of user {} in service {} ({})'.format(
+                    user_id, service, response.status_code))
+        except requests.RequestException as e:
+            logger.warning('Could not invalidate cached tokens of user {} in service {} ({})'.format(
+                user_id, service, e))
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 def check_login(username, password):
     user_dao = UserDao(g.db_session)
@@ -49,11 +169,36 @@ def check_login(username, password):
         return None, 'User {} not found'.format(username)
     if not user.is_active:
         return None, 'User {} no longer active'.format(username)
-    if user.password != password:
+    # Hashing is CPU-intensive so it is done by the password verifier's thread pool
+    if not get_password_verifier(g.config).verify(user.password, password):
         return None, 'Invalid password'
     return user, None
 
 
+# ----------------------------------------------------------------------------------------------------------------------
+def client_address():
+    # Clients behind the UI proxy all connect from the proxy's address. The proxy appends the
+    # address of its client to X-Forwarded-For, so the last entry is the one it added.
+    forwarded_for = request.headers.get('X-Forwarded-For')
+    if forwarded_for:
+        return forwarded_for.split(',')[-1].strip()
+    return request.remote_addr
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def check_login_attempt(username):
+    # Returns the number of seconds the client should wait before trying again, or zero
+    retry_after = g.username_throttle.check(username)
+    retry_after = max(retry_after, g.ip_throttle.check(client_address()))
+    return retry_after
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def fail_login_attempt(username):
+    g.username_throttle.fail(username)
+    g.ip_throttle.fail(client_address())
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 def login_required(f):
     @wraps(f)
@@ -64,8 +209,16 @@ def login_required(f):
         auth = request.authorization
         if auth is None:
             return {'message': 'Missing authorization header'}, 403
-        user, msg = check_login(auth.username, auth.password)
+        retry_after = check_login_attempt(auth.username)
+        if retry_after > 0:
+            msg = 'Too many login attempts'
+            return {'message': msg}, http.TOO_MANY_REQUESTS_429, {'Retry-After': str(retry_after)}
+        try:
+            user, msg = check_login(auth.username, auth.password)
+        except PasswordVerifierBusy as e:
+            return {'message': e.message}, http.SERVICE_UNAVAILABLE_503, {'Retry-After': '1'}
         if user is None:
+            fail_login_attempt(auth.username)
             return {'message': msg}, 403
         g.current_user = user
         return f(*args, **kwargs)
@@ -83,6 +236,7 @@ def token_required(f):
             return {'message': 'Missing authorization header'}, 403
         user, msg = check_token(auth.username)
         if user is None:
+            fail_login_attempt(auth.username)
             return {'message': msg}, 403
         g.current_user = user
         return f(*args, **kwargs)
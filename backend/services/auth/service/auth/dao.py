@@ -1,4 +1,4 @@
-from models import User, UserGroup, Permission
+from models import User, UserGroup, Permission, Revocation
 from lib.dao import BaseDao
 
 
@@ -21,3 +21,18 @@ class PermissionDao(BaseDao):
 
     def __init__(self, db_session):
         super(PermissionDao, self).__init__(Permission, db_session)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class RevocationDao(BaseDao):
+
+    def __init__(self, db_session):
+        super(RevocationDao, self).__init__(Revocation, db_session)
+
+    def delete_older_than(self, revoked_at):
+        revocations = self.query().filter(Revocation.revoked_at < revoked_at).all()
+        for revocation in revocations:
+            self.db_session.delete(revocation)
+        if len(revocations) > 0:
+            self.db_session.commit()
+        return len(revocations)
@@ -1,5 +1,7 @@
+import threading
+from collections import OrderedDict
 import flask
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Table
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Table, event
 from sqlalchemy.orm import relationship, validates
 from sqlalchemy_utils import PasswordType, force_auto_coercion
 
@@ -13,6 +15,67 @@ UserGroupUsers = Table(
     Column('user_id', Integer, ForeignKey('user.id'))
 )
 
+# Compiled permission indexes per principal, each stored together with the version it was
+# compiled from. See Principal.permission_index() and User.permission_index(). Entries are
+# keyed by principal only, so a permission change replaces the stale entry. The least recently
+# used entries are dropped beyond PERMISSION_INDEX_CACHE_SIZE entries (e.g., deleted principals).
+_permission_indexes = OrderedDict()
+_permission_indexes_lock = threading.Lock()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def get_cached_permission_index(key, version):
+    # Returns the cached index for 'key' if it was compiled from 'version', otherwise None
+    with _permission_indexes_lock:
+        cached = _permission_indexes.pop(key, None)
+        if cached is None:
+            return None
+        _permission_indexes[key] = cached
+    return cached[1] if cached[0] == version else None
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def cache_permission_index(key, version, index):
+    max_size = flask.current_app.config.get('PERMISSION_INDEX_CACHE_SIZE', 10000)
+    with _permission_indexes_lock:
+        _permission_indexes.pop(key, None)
+        _permission_indexes[key] = (version, index)
+        while len(_permission_indexes) > max_size:
+            _permission_indexes.popitem(last=False)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def compile_permissions(permissions):
+    # Maps (action, resource) to the position and granted flag of the first permission for
+    # them, where resource is either a resource class or 'resource_class@id'. The positions
+    # are needed to find the first permission matching either the class or the resource.
+    index = {}
+    for position, p in enumerate(permissions):
+        actions = Permission.ACTIONS if p.action == 'all' else [p.action]
+        for action in actions:
+            index.setdefault((action, p.resource_id), (position, p.granted))
+    return index
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def check_permission(indexes, permission):
+    # Get action and resource info from permission string
+    resource_id = None
+    action, resource_class = permission.split(':')
+    if '@' in resource_class:
+        resource_class, resource_id = resource_class.split('@')
+    # A permission is granted if any of the principals grants it. As before, the first of a
+    # principal's permissions matching the resource class or (if given) the resource wins, so
+    # a class-level deny hides later resource-level grants but not earlier ones.
+    for index in indexes:
+        matches = [index.get((action, resource_class))]
+        if resource_id:
+            matches.append(index.get((action, '{}@{}'.format(resource_class, resource_id))))
+        matches = [match for match in matches if match is not None]
+        if matches and min(matches)[1]:
+            return True
+    return False
+
 
 # ----------------------------------------------------------------------------------------------------------------------
 class Principal(BaseModel):
@@ -29,26 +92,22 @@ class Principal(BaseModel):
         'polymorphic_on': principal_type,
     }
 
+    # Version of this principal's permissions. It is incremented whenever its permissions,
+    # group memberships or flags change so compiled permission indexes can be invalidated.
+    permissions_version = Column(Integer, default=0, nullable=False)
+
+    def permission_index(self):
+        key = ('principal', self.id)
+        cached = get_cached_permission_index(key, self.permissions_version)
+        if cached is not None:
+            return cached
+        index = compile_permissions(self.permissions)
+        if self.id is not None:
+            cache_permission_index(key, self.permissions_version, index)
+        return index
+
     def has_permission(self, permission):
-        # Get action and resource info from permission string
-        resource_id = None
-        action, resource_class = permission.split(':')
-        if '@' in resource_class:
-            resource_class, resource_id = resource_class.split('@')
-        # First check class-level access. If granted, we need check no further.
-        for p in self.permissions:
-            if p.resource_id == resource_class:
-                if p.action == action or p.action == 'all':
-                    # Permission may have been denied so return 'granted'
-                    return p.granted
-            # If resource IDs were provided, check if they match
-            if resource_id:
-                if p.resource_id == '{}@{}'.format(resource_class, resource_id):
-                    if p.action == action or p.action == 'all':
-                        # Permission granted
-                        return p.granted
-        # All failed, return False
-        return False
+        return check_permission([self.permission_index()], permission)
 
     def to_dict(self):
         obj = super(Principal, self).to_dict()
@@ -66,6 +125,10 @@ class User(Principal):
         'polymorphic_identity': 'user',
     }
 
+    LOAD_PROFILES = {
+        'dict': {'selectin': ['user_groups', 'permissions']},
+    }
+
     # User ID in database
     id = Column(Integer, ForeignKey('principal.id'), primary_key=True)
     # User name
@@ -90,20 +153,36 @@ class User(Principal):
     # Flag indicating if user should be visible in the UI
     is_visible = Column(Boolean, default=True)
 
+    def permission_index(self):
+        # The indexes of the user's own permissions and those of its groups. The list is
+        # rebuilt only if the version of the user or any of its groups changed.
+        user_groups = self.user_groups
+        version = (self.permissions_version, tuple(sorted([
+            (user_group.id, user_group.permissions_version) for user_group in user_groups])))
+        key = ('user', self.id)
+        cached = get_cached_permission_index(key, version)
+        if cached is not None:
+            return cached
+        indexes = [super(User, self).permission_index()]
+        for user_group in user_groups:
+            indexes.append(user_group.permission_index())
+        if self.id is not None:
+            cache_permission_index(key, version, indexes)
+        return indexes
+
     def has_permission(self, permission):
         # If user is staff or even superuser, grant permission
         if self.is_admin or self.is_superuser:
             return True
-        # Then check if user herself has permission. If not, continue with
-        # her group memberships
-        if super(User, self).has_permission(permission):
-            return True
-        # Check group membership permissions
-        for user_group in self.user_groups:
-            if user_group.has_permission(permission):
-                return True
-        # Nothing matched
-        return False
+        # Check user's own permissions and those of her group memberships
+        return check_permission(self.permission_index(), permission)
+
+    def has_permissions(self, permissions):
+        # Evaluates a list of permissions against the compiled indexes
+        if self.is_admin or self.is_superuser:
+            return [True] * len(permissions)
+        indexes = self.permission_index()
+        return [check_permission(indexes, permission) for permission in permissions]
 
     def to_dict(self):
         user_groups = []
@@ -135,6 +214,10 @@ class UserGroup(Principal):
         'polymorphic_identity': 'user_group',
     }
 
+    LOAD_PROFILES = {
+        'dict': {'selectin': ['users', 'permissions']},
+    }
+
     # User ID in database
     id = Column(Integer, ForeignKey('principal.id'), primary_key=True)
     # User group name
@@ -172,7 +255,8 @@ class Permission(BaseModel):
     RETRIEVE = 'retrieve'
     UPDATE = 'update'
     DELETE = 'delete'
-    ALL = ','.join([CREATE, RETRIEVE, UPDATE, DELETE])
+    ACTIONS = [CREATE, RETRIEVE, UPDATE, DELETE]
+    ALL = ','.join(ACTIONS)
 
     # User ID in database
     id = Column(Integer, ForeignKey('base.id'), primary_key=True)
@@ -202,3 +286,58 @@ class Permission(BaseModel):
             'granted': self.granted,
         })
         return obj
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+@event.listens_for(Permission, 'after_insert')
+@event.listens_for(Permission, 'after_update')
+@event.listens_for(Permission, 'after_delete')
+def permission_changed(mapper, connection, target):
+    # Permissions are often added or removed without loading their principal, so we
+    # increment the principal's version directly in the database.
+    principal = Principal.__table__
+    connection.execute(principal.update().where(principal.c.id == target.principal_id).values(
+        permissions_version=principal.c.permissions_version + 1))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+@event.listens_for(UserGroup.users, 'append')
+@event.listens_for(UserGroup.users, 'remove')
+def user_group_membership_changed(target, value, initiator):
+    if value.id is not None:
+        value.permissions_version = (value.permissions_version or 0) + 1
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+@event.listens_for(User.is_superuser, 'set')
+@event.listens_for(User.is_admin, 'set')
+@event.listens_for(User.is_active, 'set')
+def user_flag_changed(target, value, oldvalue, initiator):
+    if target.id is not None and value != oldvalue:
+        target.permissions_version = (target.permissions_version or 0) + 1
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class Revocation(BaseModel):
+
+    __tablename__ = 'revocation'
+    __mapper_args__ = {
+        'polymorphic_identity': 'revocation',
+    }
+
+    # Revocation ID in database
+    id = Column(Integer, ForeignKey('base.id'), primary_key=True)
+    # ID of user whose tokens are revoked. This is not a foreign key because the
+    # revocation must outlive the user if the user is deleted.
+    user_id = Column(Integer, nullable=False, unique=True, index=True)
+    # Time of revocation in seconds since epoch. Tokens issued before this time are
+    # no longer valid.
+    revoked_at = Column(Integer, nullable=False)
+
+    def to_dict(self):
+        obj = super(Revocation, self).to_dict()
+        obj.update({
+            'user_id': self.user_id,
+            'revoked_at': self.revoked_at,
+        })
+        return obj
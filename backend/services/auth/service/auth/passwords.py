@@ -0,0 +1,147 @@
+import os
+import threading
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+_verifiers = {}
+_verifiers_lock = threading.Lock()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def get_password_verifier(config):
+    # uWSGI forks its workers after loading the app and threads do not survive a fork, so
+    # each process creates its own pool on first use
+    pid = os.getpid()
+    with _verifiers_lock:
+        if pid not in _verifiers:
+            _verifiers[pid] = PasswordVerifier(
+                config.get('PASSWORD_POOL_SIZE', 2), config.get('PASSWORD_QUEUE_SIZE', 16),
+                config.get('PASSWORD_TIMEOUT', 10))
+        return _verifiers[pid]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class PasswordVerifierBusy(RuntimeError):
+    pass
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class PasswordVerifier(object):
+
+    def __init__(self, pool_size=2, queue_size=16, timeout=10):
+        # Password hashes are verified by a fixed number of threads so that a burst of logins
+        # cannot occupy all request threads. At most 'queue_size' verifications wait for a
+        # thread. Beyond that new logins are rejected immediately.
+        self.pool_size = pool_size
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._pool = ThreadPool(pool_size)
+        self._slots = threading.BoundedSemaphore(pool_size + queue_size)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._nr_verified = 0
+        self._nr_rejected = 0
+        self._nr_timeouts = 0
+        self._total_time = 0.0
+        self._max_time = 0.0
+
+    def verify(self, hashed_password, password):
+        # The hashed password is the user's PasswordType value, which compares itself to the
+        # plain text password using passlib. Its slot is released by the worker thread when
+        # done, so verifications that time out still count until they finish.
+        if not self._slots.acquire(False):
+            with self._lock:
+                self._nr_rejected += 1
+            raise PasswordVerifierBusy('Too many concurrent logins')
+        with self._lock:
+            self._in_flight += 1
+        try:
+            result = self._pool.apply_async(self._verify, (hashed_password, password))
+        except Exception:
+            self._release()
+            raise
+        try:
+            return result.get(self.timeout)
+        except TimeoutError:
+            with self._lock:
+                self._nr_timeouts += 1
+            raise PasswordVerifierBusy('Password verification timed out')
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pool_size': self.pool_size,
+                'queue_size': self.queue_size,
+                'in_flight': self._in_flight,
+                'verified': self._nr_verified,
+                'rejected': self._nr_rejected,
+                'timeouts': self._nr_timeouts,
+                'avg_time': self._total_time / self._nr_verified if self._nr_verified > 0 else 0.0,
+                'max_time': self._max_time,
+            }
+
+    def _verify(self, hashed_password, password):
+        start = time.time()
+        try:
+            return hashed_password == password
+        finally:
+            elapsed = time.time() - start
+            with self._lock:
+                self._nr_verified += 1
+                self._total_time += elapsed
+                self._max_time = max(self._max_time, elapsed)
+            self._release()
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class LoginThrottle(object):
+
+    def __init__(self, max_attempts, window=60):
+        # Counts failed login attempts per key (e.g., user name or IP address) in fixed windows
+        # of 'window' seconds. Counters of previous windows are dropped when a new one starts.
+        # Successful logins are not counted, so clients that log in often are not throttled.
+        self.max_attempts = max_attempts
+        self.window = window
+        self._window_start = 0
+        self._counts = {}
+        self._nr_throttled = 0
+        self._lock = threading.Lock()
+
+    def check(self, key):
+        # Returns the number of seconds to wait if the key reached its maximum number of
+        # failed attempts in the current window, or zero otherwise
+        now = time.time()
+        with self._lock:
+            window_start = self._start_window(now)
+            if self._counts.get(key, 0) >= self.max_attempts:
+                self._nr_throttled += 1
+                return int(window_start + self.window - now) + 1
+            return 0
+
+    def fail(self, key):
+        # Registers a failed attempt
+        with self._lock:
+            self._start_window(time.time())
+            self._counts[key] = self._counts.get(key, 0) + 1
+
+    def _start_window(self, now):
+        window_start = now - now % self.window
+        if window_start != self._window_start:
+            self._window_start = window_start
+            self._counts.clear()
+        return window_start
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_attempts': self.max_attempts,
+                'window': self.window,
+                'keys': len(self._counts),
+                'throttled': self._nr_throttled,
+            }
@@ -1,8 +1,12 @@
 import lib.http as http
+from flask import g
 from flask_restful import reqparse
 
-from authentication import create_token, check_token, login_required, token_required
-from dao import UserDao, UserGroupDao
+from authentication import (
+    create_token, check_token, login_required, token_required, revoke_user, restore_user, prune_revocations,
+    invalidate_cached_tokens)
+from dao import UserDao, UserGroupDao, RevocationDao
+from passwords import get_password_verifier
 from lib.resources import BaseResource
 
 
@@ -14,7 +18,7 @@ class RootResource(BaseResource):
     def get(self):
         return self.response({
             'service': 'auth',
-            'endpoints': ['tokens', 'token-checks', 'users']
+            'endpoints': ['tokens', 'token-checks', 'permission-checks', 'revocations', 'users', 'login-metrics']
         })
 
 
@@ -59,6 +63,56 @@ class TokenChecksResource(BaseResource):
         }, http.CREATED_201)
 
 
+# ----------------------------------------------------------------------------------------------------------------------
+class PermissionChecksResource(BaseResource):
+
+    URI = '/permission-checks'
+
+    @token_required
+    def post(self):
+
+        parser = reqparse.RequestParser()
+        parser.add_argument('token', type=str, required=True, location='json')
+        parser.add_argument('permissions', type=list, required=True, location='json')
+        args = parser.parse_args()
+
+        # Permissions have the format 'action:resource_class' or 'action:resource_class@id'
+        for permission in args['permissions']:
+            if not isinstance(permission, basestring) or permission.count(':') != 1 or permission.count('@') > 1:
+                return self.error_response('Invalid permission {}'.format(permission), http.BAD_REQUEST_400)
+
+        user, msg = check_token(args['token'])
+        if user is None:
+            return self.error_response(msg, http.FORBIDDEN_403)
+
+        # Results are returned in the same order as the permissions
+        return self.response({
+            'user_id': user.id,
+            'results': user.has_permissions(args['permissions']),
+        }, http.CREATED_201)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class RevocationsResource(BaseResource):
+
+    URI = '/revocations'
+
+    @token_required
+    def get(self):
+
+        # Revocations older than the token lifetime are removed first, so the list only holds
+        # revocations that still apply to unexpired tokens
+        prune_revocations()
+        revocation_dao = RevocationDao(self.db_session())
+        revocations = revocation_dao.retrieve_all()
+        result = [{
+            'user_id': revocation.user_id,
+            'revoked_at': revocation.revoked_at,
+        } for revocation in revocations]
+
+        return self.response({'revocations': result})
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 class UsersResource(BaseResource):
 
@@ -76,11 +130,16 @@ class UsersResource(BaseResource):
         parser.add_argument('is_active', type=bool, location='args')
         args = parser.parse_args()
 
+        list_args, msg = self.list_args(['id', 'username', 'email', 'first_name', 'last_name', 'created_at'])
+        if list_args is None:
+            return self.error_response(msg, http.BAD_REQUEST_400)
+
         user_dao = UserDao(self.db_session())
-        users = user_dao.retrieve_all(**args)
-        result = [user.to_dict() for user in users]
+        users, next_cursor = user_dao.stream_page(
+            profile='dict', cursor=list_args['cursor'], limit=list_args['limit'], filters=list_args['filters'],
+            **args)
 
-        return self.response(result)
+        return self.stream_list_response(users, next_cursor, list_args)
 
     @token_required
     def post(self):
@@ -145,6 +204,13 @@ class UserResource(BaseResource):
 
         user = user_dao.save(user)
 
+        # Services verifying tokens locally learn about (de)activation through the revocation list
+        if user.is_active:
+            restore_user(user.id)
+        else:
+            revoke_user(user.id)
+        invalidate_cached_tokens(user.id)
+
         return self.response(user.to_dict())
 
     @token_required
@@ -155,6 +221,8 @@ class UserResource(BaseResource):
         if user is None:
             return self.error_response('User {} not found'.format(id), http.NOT_FOUND_404)
         user_dao.delete(user)
+        revoke_user(id)
+        invalidate_cached_tokens(id)
 
         return self.response({}, http.NO_CONTENT_204)
 
@@ -171,11 +239,16 @@ class UserGroupsResource(BaseResource):
         parser.add_argument('name', type=str, location='args')
         args = parser.parse_args()
 
+        list_args, msg = self.list_args(['id', 'name', 'created_at'])
+        if list_args is None:
+            return self.error_response(msg, http.BAD_REQUEST_400)
+
         user_group_dao = UserGroupDao(self.db_session())
-        user_groups = user_group_dao.retrieve_all(**args)
-        result = [user_group.to_dict() for user_group in user_groups]
+        user_groups, has_more = user_group_dao.retrieve_page(
+            profile='dict', cursor=list_args['cursor'], limit=list_args['limit'], filters=list_args['filters'],
+            **args)
 
-        return self.response(result)
+        return self.list_response(user_groups, has_more, list_args)
 
     @token_required
     def post(self):
@@ -232,7 +305,10 @@ class UserGroupResource(BaseResource):
         user_group = user_group_dao.retrieve(id=id)
         if user_group is None:
             return self.error_response('User group {} not found'.format(id), http.NOT_FOUND_404)
+        user_ids = [user.id for user in user_group.users]
         user_group_dao.delete(user_group)
+        for user_id in user_ids:
+            invalidate_cached_tokens(user_id)
 
         return self.response({}, http.NO_CONTENT_204)
 
@@ -250,9 +326,16 @@ class UserGroupUsersResource(BaseResource):
         if user_group is None:
             return self.error_response('User group {} not found'.format(id), http.NOT_FOUND_404)
 
-        result = [user.to_dict() for user in user_group.users]
+        list_args, msg = self.list_args(['id', 'username', 'email', 'first_name', 'last_name', 'created_at'])
+        if list_args is None:
+            return self.error_response(msg, http.BAD_REQUEST_400)
+
+        user_dao = UserDao(self.db_session())
+        users, has_more = user_dao.retrieve_page(
+            cursor=list_args['cursor'], limit=list_args['limit'], filters=list_args['filters'],
+            profile='dict', query=user_dao.query().with_parent(user_group, 'users'))
 
-        return self.response(result)
+        return self.list_response(users, has_more, list_args)
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -276,6 +359,7 @@ class UserGroupUserResource(BaseResource):
         if user not in user_group.users:
             user_group.users.append(user)
             user_group = user_group_dao.save(user_group)
+            invalidate_cached_tokens(user.id)
 
         return self.response(user_group.to_dict())
 
@@ -295,5 +379,22 @@ class UserGroupUserResource(BaseResource):
         if user in user_group.users:
             user_group.users.remove(user)
             user_group = user_group_dao.save(user_group)
+            invalidate_cached_tokens(user.id)
 
         return self.response(user_group.to_dict())
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class LoginMetricsResource(BaseResource):
+
+    URI = '/login-metrics'
+
+    @token_required
+    def get(self):
+
+        # Metrics are per worker process
+        return self.response({
+            'password_verifier': get_password_verifier(self.config()).stats(),
+            'username_throttle': g.username_throttle.stats(),
+            'ip_throttle': g.ip_throttle.stats(),
+        })
@@ -9,6 +9,14 @@ if not os.getenv('AUTH_SERVICE_HOST'):
     os.environ['AUTH_SERVICE_HOST'] = '0.0.0.0'
     os.environ['AUTH_SERVICE_PORT'] = '5000'
 
+if not os.getenv('COMPUTE_SERVICE_HOST'):
+    os.environ['COMPUTE_SERVICE_HOST'] = '0.0.0.0'
+    os.environ['COMPUTE_SERVICE_PORT'] = '5001'
+
+if not os.getenv('STORAGE_SERVICE_HOST'):
+    os.environ['STORAGE_SERVICE_HOST'] = '192.168.99.100'
+    os.environ['STORAGE_SERVICE_PORT'] = '5002'
+
 # ------------------------------------------------------------------------------------------------------------------
 # Log settings
 # ------------------------------------------------------------------------------------------------------------------
@@ -36,6 +44,9 @@ RESTFUL_JSON = {'indent': 2, 'sort_keys': True}
 
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Adds the number of SQL queries per request as 'X-Query-Count' header (for testing)
+QUERY_COUNTER_ENABLED = os.getenv('QUERY_COUNTER_ENABLED', 'false').lower() == 'true'
+
 if os.getenv('DB_USER', None) is not None:
     SQLALCHEMY_DATABASE_URI = 'postgres://{}:{}@{}:{}/{}'.format(
         os.getenv('DB_USER'),
@@ -50,10 +61,52 @@ else:
 # Security settings
 # ------------------------------------------------------------------------------------------------------------------
 
-SECRET_KEY = os.urandom(64)
+# Services that verify tokens locally (TOKEN_VERIFICATION = 'local') need the same secret
+# key for HS256, so it can be provided through the environment. For RS256 tokens are signed
+# with TOKEN_SIGNING_KEY (private key) and services only get TOKEN_VERIFICATION_KEY (public key).
+SECRET_KEY = os.getenv('SECRET_KEY') or os.urandom(64)
+
+TOKEN_ALGORITHM = os.getenv('TOKEN_ALGORITHM', 'HS256')
+TOKEN_SIGNING_KEY = os.getenv('TOKEN_SIGNING_KEY')
+TOKEN_VERIFICATION_KEY = os.getenv('TOKEN_VERIFICATION_KEY')
+
+# Tokens are either 'compact' (user ID, name and flags, permissions version) or 'full' (the
+# complete user, as issued before). Both expire after TOKEN_LIFETIME seconds and both formats
+# are accepted, whichever is issued. With TOKEN_PERMISSIONS_DIGEST compact tokens also carry
+# a hash of the user's permissions so services can tell if their copy is up to date.
+TOKEN_FORMAT = os.getenv('TOKEN_FORMAT', 'compact')
+TOKEN_LIFETIME = 3600
+TOKEN_PERMISSIONS_DIGEST = False
+
+# Services that cache verified tokens. These are notified when a user is deactivated or
+# its group memberships change so they can drop the user's cached verifications. The auth
+# service authenticates these notifications as the (invisible) user SERVICE_USERNAME.
+TOKEN_CACHE_SERVICES = ['storage', 'compute']
+SERVICE_USERNAME = 'auth'
 
 PASSWORD_SCHEMES = ['pbkdf2_sha512']
 
+# Maximum number of compiled permission indexes kept per worker (least recently used are dropped)
+PERMISSION_INDEX_CACHE_SIZE = 10000
+
+# List endpoints return at most DEFAULT_PAGE_SIZE objects unless clients ask for more with
+# 'limit' (up to MAX_PAGE_SIZE). The next page is referred to in the 'Link' header.
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
+# Passwords are verified by a pool of PASSWORD_POOL_SIZE threads per worker process. At most
+# PASSWORD_QUEUE_SIZE logins wait for a thread, others get a 503 response right away.
+PASSWORD_POOL_SIZE = 2
+PASSWORD_QUEUE_SIZE = 16
+PASSWORD_TIMEOUT = 10
+
+# Failed login attempts per user name and per client IP address allowed within LOGIN_THROTTLE_WINDOW
+# seconds. Counters are kept per worker process, so the limits are multiplied by the number of workers.
+# Clients exceeding them get a 429 response until the window ends.
+LOGIN_MAX_ATTEMPTS_PER_USERNAME = 20
+LOGIN_MAX_ATTEMPTS_PER_IP = 120
+LOGIN_THROTTLE_WINDOW = 60
+
 USERS = [
     {
         'username': 'ralph',
@@ -110,6 +163,17 @@ USERS = [
         'is_active': True,
         'is_visible': False,
     },
+    {
+        'username': 'auth',
+        'password': os.getenv('SERVICE_PASSWORD') or os.urandom(16).encode('hex'),
+        'email': 'auth@yoda.com',
+        'first_name': None,
+        'last_name': None,
+        'is_superuser': False,
+        'is_admin': False,
+        'is_active': True,
+        'is_visible': False,
+    },
     {
         'username': 'compute',
         'password': 'secret',
@@ -1,8 +1,14 @@
 import base64
+import logging
+import time
 from functools import wraps
 import requests
+import lib.client as client
 from flask import request, g
-from lib.util import uri
+from jose import jwt, JWTError
+from lib.tokens import get_token_manager
+
+LOG = logging.getLogger(__name__)
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -20,6 +26,164 @@ def token_header(token):
     return {'Authorization': 'Basic {}'.format(encode(token))}
 
 
+# ----------------------------------------------------------------------------------------------------------------------
+def user_from_claims(data):
+    # Compact tokens (version 2) identify the user by its subject claim. Older tokens contain
+    # the complete user dictionary and are returned as-is.
+    if data.get('ver') != 2:
+        return data
+    return {
+        'id': int(data['sub']),
+        'username': data['username'],
+        'is_admin': data.get('is_admin', False),
+        'is_superuser': data.get('is_superuser', False),
+        'permissions_version': data.get('pv'),
+        'permissions_digest': data.get('pd'),
+    }
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def service_token_manager():
+    # The service's own token is managed per host. It is requested once, shared between
+    # worker processes and refreshed before it expires.
+    return get_token_manager(
+        g.config['SERVICE_USERNAME'], g.config['SERVICE_PASSWORD'], g.config['SERVICE_TOKEN_DIR'],
+        g.config.get('SERVICE_TOKEN_REFRESH_MARGIN', 300), g.config.get('SERVICE_TOKEN_LIFETIME', 3600))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def get_service_token():
+    try:
+        return service_token_manager().get_token(), None
+    except RuntimeError as e:
+        return None, e.message
+    except requests.RequestException as e:
+        return None, 'Authentication failed (Auth service not available ({}))'.format(e)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def get_revocations():
+    # The revocation list is fetched from the auth service at most once every poll interval
+    # and kept in the process cache without a timeout. If the auth service cannot be reached
+    # we keep using the last list we received. Only if we never received one do we fail.
+    revocations = g.cache.get('revocations')
+    interval = g.config.get('TOKEN_REVOCATIONS_POLL_INTERVAL', 30)
+    if revocations is not None and time.time() - revocations['fetched_at'] < interval:
+        return revocations['users']
+    token, msg = get_service_token()
+    if token is not None:
+        try:
+            response = client.get('auth', '/revocations', headers=token_header(token))
+        except requests.RequestException as e:
+            response = None
+            msg = 'Could not retrieve revocation list ({})'.format(e)
+        if response is not None and response.status_code == 200:
+            users = {}
+            for item in response.json()['revocations']:
+                users[item['user_id']] = item['revoked_at']
+            # Drop cached verifications of users that were revoked since the last poll
+            token_cache = getattr(g, 'token_cache', None)
+            if token_cache is not None:
+                for user_id in users.keys():
+                    if revocations is None or revocations['users'].get(user_id) != users[user_id]:
+                        token_cache.invalidate_user(user_id)
+            revocations = {'fetched_at': time.time(), 'users': users}
+            g.cache.set('revocations', revocations, timeout=0)
+            return users
+        if response is not None:
+            msg = 'Could not retrieve revocation list ({})'.format(response.status_code)
+    if revocations is None:
+        return None
+    LOG.warning('{}, using revocation list from {}'.format(msg, revocations['fetched_at']))
+    return revocations['users']
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def check_token_remotely(token, retry=True):
+    # Returns the user, an error message and whether the outcome may be cached. Failures
+    # that are not a verdict on the token itself (e.g., no service token) are not cached.
+    service_token, msg = get_service_token()
+    if service_token is None:
+        return None, msg, False
+    # Send request to auth service to verify the client token
+    try:
+        response = client.post(
+            'auth', '/token-checks', json={'token': token}, headers=token_header(service_token))
+        if response.status_code == 403 and retry:
+            # The rejection may concern our own token, e.g., if the auth service was restarted
+            # with a new key. In that case we get a new service token and try again.
+            check = client.post(
+                'auth', '/token-checks', json={'token': service_token}, headers=token_header(service_token))
+            if check.status_code == 403:
+                service_token_manager().invalidate()
+                return check_token_remotely(token, retry=False)
+    except requests.RequestException as e:
+        return None, 'Authentication failed (Auth service not available ({}))'.format(e), False
+    if response.status_code != 201:
+        return None, 'Authentication failed ({})'.format(response.json()), response.status_code == 403
+    return response.json()['user'], None, True
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def check_token_locally(token):
+    # Verify signature and expiry ourselves using the key shared by the auth service. For
+    # HS256 this is the auth service's SECRET_KEY, for RS256 it is its public key.
+    key = g.config.get('TOKEN_VERIFICATION_KEY')
+    if key is None:
+        return None, 'Token verification key not configured', False
+    try:
+        data = jwt.decode(token, key, algorithms=[g.config.get('TOKEN_ALGORITHM', 'HS256')])
+    except JWTError as e:
+        return None, 'Authentication failed (Could not decode token ({}))'.format(e.message), True
+    # Users that were deactivated or deleted after the token was issued end up on the
+    # revocation list. Tokens issued after the revocation (user reactivated) are accepted.
+    revocations = get_revocations()
+    if revocations is None:
+        return None, 'Authentication failed (Revocation list not available)', False
+    user = user_from_claims(data)
+    revoked_at = revocations.get(user['id'])
+    if revoked_at is not None and data.get('iat', 0) <= revoked_at:
+        return None, 'Authentication failed (Token for user {} revoked)'.format(user['id']), True
+    return user, None, True
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def check_token(token):
+    # Look up the token in the verified-token cache first. Both accepted and rejected
+    # tokens are cached, the latter with a shorter TTL.
+    token_cache = getattr(g, 'token_cache', None)
+    if token_cache is not None:
+        cached = token_cache.get(token)
+        if cached is not None:
+            return cached
+    if g.config.get('TOKEN_VERIFICATION', 'remote') == 'local':
+        user, msg, cacheable = check_token_locally(token)
+    else:
+        user, msg, cacheable = check_token_remotely(token)
+    if token_cache is not None and cacheable:
+        token_cache.set(token, user, msg, expires_at=token_expiry(token))
+    return user, msg
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def token_expiry(token):
+    # Returns the token's expiry time without verifying it (verification is done elsewhere)
+    # or None if it has none
+    try:
+        return jwt.get_unverified_claims(token).get('exp')
+    except JWTError:
+        return None
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def is_admin_or_auth_service(user):
+    # Only administrators and the auth service's own account may manage the caches of
+    # other services
+    if user.get('is_admin', False) or user.get('is_superuser', False):
+        return True
+    return user.get('username') == g.config.get('AUTH_SERVICE_USERNAME', 'auth')
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 def token_required(f):
     @wraps(f)
@@ -29,28 +193,10 @@ def token_required(f):
         auth = request.authorization
         if auth is None:
             return {'message': 'Missing authorization header'}, 403
-        # Check cache for a token. If it's not there request one from the auth service.
-        token = g.cache.get('token')
-        if token is None:
-            print('Could not find token in cache')
-            # Get username and password from service settings
-            username = g.config['SERVICE_USERNAME']
-            password = g.config['SERVICE_PASSWORD']
-            # Request new access token
-            print('Requesting new token for user {}'.format(username))
-            response = requests.post(uri('auth', '/tokens'), headers=login_header(username, password))
-            if response.status_code != 201:
-                return {'message': 'Authentication failed ({})'.format(response.json())}, 403
-            # Get token and store it in cache for future use
-            token = response.json()['token']
-            print('Received token {}, storing in cache'.format(token))
-            g.cache.set('token', token)
-        # Send request to auth service to verify the client token
-        response = requests.post(
-            uri('auth', '/token-checks'), json={'token': auth.username}, headers=token_header(token))
-        if response.status_code != 201:
-            return {'message': 'Authentication failed ({})'.format(response.json())}, 403
+        user, msg = check_token(auth.username)
+        if user is None:
+            return {'message': msg}, 403
         # Token verification was successful
-        g.current_user = response.json()['user']
+        g.current_user = user
         return f(*args, **kwargs)
     return decorated
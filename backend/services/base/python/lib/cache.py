@@ -0,0 +1,241 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+import redis
+
+LOG = logging.getLogger(__name__)
+
+# Redis channel on which invalidations are broadcast to the local caches of all processes
+INVALIDATIONS_CHANNEL = 'token-cache-invalidations'
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def create_token_cache(config):
+    backend = config.get('TOKEN_CACHE_BACKEND', 'local')
+    ttl = config.get('TOKEN_CACHE_TTL', 60)
+    negative_ttl = config.get('TOKEN_CACHE_NEGATIVE_TTL', 5)
+    if backend == 'local':
+        return LocalTokenCache(
+            config.get('TOKEN_CACHE_MAX_SIZE', 10000), ttl, negative_ttl, config.get('TOKEN_CACHE_INVALIDATIONS_URL'))
+    if backend == 'redis':
+        return RedisTokenCache(config['TOKEN_CACHE_URL'], ttl, negative_ttl)
+    return None
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def token_key(token):
+    # Tokens are never stored as-is, only their hash
+    return hashlib.sha256(token).hexdigest()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def entry_ttl(ttl, expires_at=None):
+    # Cache entries never outlive the token they belong to
+    if expires_at is not None:
+        ttl = min(ttl, int(expires_at - time.time()))
+    return ttl
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class LocalTokenCache(object):
+
+    def __init__(self, max_size=10000, ttl=60, negative_ttl=5, invalidations_url=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        # Entries are kept in least-recently-used order. Each entry is a tuple
+        # (expires_at, user, message) where user is None for rejected tokens.
+        self._entries = OrderedDict()
+        # Token keys per user ID so we can invalidate all tokens of a user
+        self._user_keys = {}
+        self._lock = threading.Lock()
+        # Each process has its own cache, so an invalidation posted to one process would not
+        # reach the others. With an invalidations URL, invalidations are broadcast through
+        # Redis instead and each process listens for them. The cache is bypassed while a
+        # process is not subscribed, since it could miss invalidations.
+        self._invalidations = None
+        if invalidations_url:
+            self._invalidations = redis.StrictRedis.from_url(invalidations_url)
+        self._listener_pid = None
+        self._listener_lock = threading.Lock()
+        self._subscribed = False
+
+    def get(self, token):
+        key = token_key(token)
+        if not self._listen():
+            self.misses += 1
+            return None
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self._forget(key, entry)
+                self.misses += 1
+                return None
+            # Re-insert to mark entry as most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def set(self, token, user, message=None, expires_at=None):
+        key = token_key(token)
+        ttl = entry_ttl(self.ttl if user is not None else self.negative_ttl, expires_at)
+        if ttl <= 0 or not self._listen():
+            return
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._forget(key, entry)
+            self._entries[key] = (time.time() + ttl, user, message)
+            if user is not None:
+                self._user_keys.setdefault(user['id'], set()).add(key)
+            while len(self._entries) > self.max_size:
+                oldest_key, oldest_entry = self._entries.popitem(last=False)
+                self._forget(oldest_key, oldest_entry)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for key in self._user_keys.pop(user_id, set()):
+                self._entries.pop(key, None)
+
+    def broadcast_invalidation(self, user_id=None):
+        # Invalidates the cached verifications of a user (or all of them if user_id is None)
+        # in every process. Raises redis.RedisError if the invalidation could not be sent.
+        if self._invalidations is None:
+            self._invalidate(user_id)
+            return
+        self._invalidations.publish(INVALIDATIONS_CHANNEL, json.dumps({'user_id': user_id}))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._user_keys.clear()
+
+    def stats(self):
+        return {
+            'backend': 'local',
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'subscribed': self._subscribed,
+        }
+
+    def _invalidate(self, user_id):
+        if user_id is None:
+            self.clear()
+        else:
+            self.invalidate_user(user_id)
+
+    def _listen(self):
+        # Starts the listener in this process if needed (uWSGI forks its workers after the
+        # cache is created) and returns whether the cache can be used
+        if self._invalidations is None:
+            return True
+        if self._listener_pid != os.getpid():
+            with self._listener_lock:
+                if self._listener_pid != os.getpid():
+                    self._listener_pid = os.getpid()
+                    self._subscribed = False
+                    self.clear()
+                    thread = threading.Thread(target=self._receive)
+                    thread.daemon = True
+                    thread.start()
+        return self._subscribed
+
+    def _receive(self):
+        while True:
+            try:
+                pubsub = self._invalidations.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATIONS_CHANNEL)
+                # Invalidations may have been missed while we were not subscribed
+                self.clear()
+                self._subscribed = True
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self._invalidate(json.loads(message['data'])['user_id'])
+            except (redis.RedisError, ValueError, KeyError) as e:
+                LOG.warning('Token cache invalidations not available ({})'.format(e))
+            self._subscribed = False
+            time.sleep(5)
+
+    def _forget(self, key, entry):
+        if entry[1] is not None:
+            keys = self._user_keys.get(entry[1]['id'])
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self._user_keys[entry[1]['id']]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class RedisTokenCache(object):
+
+    PREFIX = 'token-cache:'
+
+    def __init__(self, url, ttl=60, negative_ttl=5):
+        # This cache is shared by all worker processes using the same Redis. Entries expire through
+        # Redis TTLs. Eviction under memory pressure is left to Redis ('maxmemory-policy allkeys-lru').
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._redis = redis.StrictRedis.from_url(url)
+
+    def get(self, token):
+        # If Redis is not available tokens are verified without the cache
+        try:
+            value = self._redis.get(self.PREFIX + token_key(token))
+            self._redis.incr(self.PREFIX + ('misses' if value is None else 'hits'))
+        except redis.RedisError as e:
+            LOG.warning('Token cache not available ({})'.format(e))
+            return None
+        if value is None:
+            return None
+        entry = json.loads(value)
+        return entry['user'], entry['message']
+
+    def set(self, token, user, message=None, expires_at=None):
+        key = self.PREFIX + token_key(token)
+        ttl = entry_ttl(self.ttl if user is not None else self.negative_ttl, expires_at)
+        if ttl <= 0:
+            return
+        pipeline = self._redis.pipeline()
+        pipeline.setex(key, ttl, json.dumps({'user': user, 'message': message}))
+        if user is not None:
+            user_key = self.PREFIX + 'user:{}'.format(user['id'])
+            pipeline.sadd(user_key, key)
+            pipeline.expire(user_key, max(ttl, self.ttl))
+        try:
+            pipeline.execute()
+        except redis.RedisError as e:
+            LOG.warning('Token cache not available ({})'.format(e))
+
+    def invalidate_user(self, user_id):
+        user_key = self.PREFIX + 'user:{}'.format(user_id)
+        keys = self._redis.smembers(user_key)
+        self._redis.delete(user_key, *keys)
+
+    def broadcast_invalidation(self, user_id=None):
+        # The cache is shared by all processes, so invalidating it here is enough
+        if user_id is None:
+            self.clear()
+        else:
+            self.invalidate_user(user_id)
+
+    def clear(self):
+        keys = list(self._redis.scan_iter(self.PREFIX + '*'))
+        if len(keys) > 0:
+            self._redis.delete(*keys)
+
+    def stats(self):
+        hits, misses = self._redis.mget(self.PREFIX + 'hits', self.PREFIX + 'misses')
+        return {
+            'backend': 'redis',
+            'hits': int(hits or 0),
+            'misses': int(misses or 0),
+        }
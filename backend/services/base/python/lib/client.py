@@ -0,0 +1,82 @@
+import os
+import threading
+import requests
+from flask import g, has_request_context
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from lib.util import uri
+
+# Client settings are read from the environment because this module is used both by the
+# Flask services and by the Celery workers, which have no Flask config.
+POOL_SIZE = int(os.getenv('SERVICE_CLIENT_POOL_SIZE', '10'))
+CONNECT_TIMEOUT = float(os.getenv('SERVICE_CLIENT_CONNECT_TIMEOUT', '3.05'))
+READ_TIMEOUT = float(os.getenv('SERVICE_CLIENT_READ_TIMEOUT', '60'))
+MAX_RETRIES = int(os.getenv('SERVICE_CLIENT_MAX_RETRIES', '3'))
+BACKOFF_FACTOR = float(os.getenv('SERVICE_CLIENT_BACKOFF_FACTOR', '0.5'))
+
+# Only these methods are retried after the request was sent. Failures to connect are
+# retried for every method because nothing reached the server.
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def session():
+    # Each process gets its own session (and connection pool). uWSGI and Celery fork their
+    # workers, so a session created before the fork must not be shared with the children.
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        with _session_lock:
+            if _session is None or _session_pid != os.getpid():
+                retry = Retry(
+                    total=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR, status_forcelist=[502, 503, 504],
+                    method_whitelist=IDEMPOTENT_METHODS, raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+                s = requests.Session()
+                s.mount('http://', adapter)
+                s.mount('https://', adapter)
+                _session = s
+                _session_pid = os.getpid()
+    return _session
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def request(method, service, path='', correlation_id=None, timeout=None, **kwargs):
+    # Forward the correlation ID of the request we're handling (if any) so the call can
+    # be traced across services
+    headers = dict(kwargs.pop('headers', None) or {})
+    if correlation_id is None and has_request_context():
+        correlation_id = getattr(g, 'correlation_id', None)
+    if correlation_id is not None and 'X-Correlation-ID' not in headers:
+        headers['X-Correlation-ID'] = correlation_id
+    if timeout is None:
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+    return session().request(method, uri(service, path), headers=headers, timeout=timeout, **kwargs)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def get(service, path='', **kwargs):
+    return request('GET', service, path, **kwargs)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def head(service, path='', **kwargs):
+    return request('HEAD', service, path, **kwargs)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def post(service, path='', **kwargs):
+    return request('POST', service, path, **kwargs)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def put(service, path='', **kwargs):
+    return request('PUT', service, path, **kwargs)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def delete(service, path='', **kwargs):
+    return request('DELETE', service, path, **kwargs)
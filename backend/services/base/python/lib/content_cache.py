@@ -0,0 +1,202 @@
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import stat
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+# Cache settings are read from the environment because the cache is used by the Celery
+# workers, which have no Flask config. An empty CONTENT_CACHE_DIR disables the cache.
+CONTENT_CACHE_DIR = os.getenv('CONTENT_CACHE_DIR', '')
+CONTENT_CACHE_MAX_SIZE = int(os.getenv('CONTENT_CACHE_MAX_SIZE', str(10 * 1024 * 1024 * 1024)))
+CONTENT_CACHE_MIN_AGE = int(os.getenv('CONTENT_CACHE_MIN_AGE', '60'))
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def get_content_cache():
+    # Returns None if the cache is disabled. The cache itself lives on disk, so all worker
+    # processes on this node share its entries.
+    if not CONTENT_CACHE_DIR:
+        return None
+    key = (os.getpid(), CONTENT_CACHE_DIR)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = ContentCache(CONTENT_CACHE_DIR, CONTENT_CACHE_MAX_SIZE, CONTENT_CACHE_MIN_AGE)
+        return _caches[key]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class ContentCache(object):
+
+    # Fills are serialized per entry using a fixed set of lock files, so lock files never
+    # have to be removed (which would race with processes waiting for them).
+    NR_LOCKS = 256
+
+    def __init__(self, cache_dir, max_size, min_age=60):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        # Entries used less than min_age seconds ago are not evicted. They may still be
+        # about to be linked into a task directory.
+        self.min_age = min_age
+        self.hits = 0
+        self.misses = 0
+        for d in (self._entries_dir(), self._locks_dir()):
+            if not os.path.isdir(d):
+                try:
+                    os.makedirs(d, 0o700)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+
+    def link(self, storage_id, target_path, fill, sha1=None):
+        # Makes the content of 'storage_id' available at 'target_path', calling fill(file_path)
+        # to download it into the cache first if needed. Concurrent callers on this node wait
+        # for a single fill. Entries are read-only, so the task directory gets a hard link
+        # instead of a copy. A hard link keeps the content when the entry is evicted. If the
+        # cache is on another file system the entry is copied, because a symlink would break
+        # when the entry is evicted while a task still uses it.
+        entry_path = self._entry_path(storage_id, sha1)
+        if not os.path.isfile(entry_path):
+            with self._lock(entry_path):
+                if not os.path.isfile(entry_path):
+                    self.misses += 1
+                    self._fill(entry_path, fill, sha1)
+                    self.evict()
+                else:
+                    self.hits += 1
+        else:
+            self.hits += 1
+        self._touch(entry_path)
+        if os.path.lexists(target_path):
+            os.remove(target_path)
+        try:
+            os.link(entry_path, target_path)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copyfile(entry_path, target_path)
+        return target_path
+
+    def evict(self):
+        # Removes least recently used entries until the cache fits in max_size bytes
+        entries = []
+        total = 0
+        for name in self._entry_names():
+            path = os.path.join(self._entries_dir(), name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        if total <= self.max_size:
+            return
+        now = time.time()
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if now - mtime < self.min_age:
+                continue
+            with self._lock(path, blocking=False) as locked:
+                if not locked:
+                    continue
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError as e:
+                    LOG.warning('Could not evict {} from content cache ({})'.format(path, e))
+
+    def clear(self):
+        shutil.rmtree(self._entries_dir(), ignore_errors=True)
+        os.makedirs(self._entries_dir(), 0o700)
+
+    def stats(self):
+        size = 0
+        names = self._entry_names()
+        for name in names:
+            try:
+                size += os.path.getsize(os.path.join(self._entries_dir(), name))
+            except OSError:
+                pass
+        return {
+            'size': size,
+            'max_size': self.max_size,
+            'nr_entries': len(names),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def _fill(self, entry_path, fill, sha1):
+        # The downloader writes to '<entry_path>.part' and renames it when complete, so other
+        # processes never see a partial entry. An interrupted fill is resumed by the next one.
+        fill(entry_path)
+        if sha1 is not None:
+            digest = hashlib.sha1()
+            with open(entry_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+            if digest.hexdigest() != sha1:
+                os.remove(entry_path)
+                raise RuntimeError('Content of {} does not match SHA-1 {}'.format(entry_path, sha1))
+        os.chmod(entry_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+
+    def _touch(self, entry_path):
+        # The modification time records when an entry was last used
+        try:
+            os.utime(entry_path, None)
+        except OSError:
+            pass
+
+    def _entry_names(self):
+        # Skips downloads in progress
+        return [n for n in os.listdir(self._entries_dir()) if not n.endswith('.part') and not n.endswith('.part.json')]
+
+    def _entry_path(self, storage_id, sha1=None):
+        name = storage_id if sha1 is None else '{}-{}'.format(storage_id, sha1)
+        return os.path.join(self._entries_dir(), name)
+
+    def _entries_dir(self):
+        return os.path.join(self.cache_dir, 'entries')
+
+    def _locks_dir(self):
+        return os.path.join(self.cache_dir, 'locks')
+
+    def _lock(self, entry_path, blocking=True):
+        nr = int(hashlib.md5(os.path.basename(entry_path)).hexdigest(), 16) % self.NR_LOCKS
+        return _FileLock(os.path.join(self._locks_dir(), '{}.lock'.format(nr)), blocking)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class _FileLock(object):
+
+    def __init__(self, path, blocking=True):
+        self.path = path
+        self.blocking = blocking
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'a')
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                self._file.close()
+                raise
+            self._file.close()
+            self._file = None
+            return False
+        return True
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
@@ -1,5 +1,29 @@
+from sqlalchemy.orm import joinedload, selectinload, subqueryload
 from sqlalchemy.sql import func
 
+# Operators for range and prefix filters, e.g., 'size__gte'
+FILTER_OPERATORS = {
+    'gt': lambda column, value: column > value,
+    'gte': lambda column, value: column >= value,
+    'lt': lambda column, value: column < value,
+    'lte': lambda column, value: column <= value,
+    'prefix': lambda column, value: column.startswith(value),
+}
+
+# Loader strategies that can be used in a model's load profiles
+LOADERS = {
+    'joined': joinedload,
+    'selectin': selectinload,
+    'subquery': subqueryload,
+}
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class InvalidFilter(ValueError):
+    # Raised for filter values that do not match the type of their field. Resources turn
+    # it into a 400 response.
+    pass
+
 
 # ----------------------------------------------------------------------------------------------------------------------
 class BaseDao(object):
@@ -27,21 +51,87 @@ class BaseDao(object):
         self.db_session.commit()
         return obj
 
-    def retrieve(self, **kwargs):
+    def query(self, profile=None):
+        query = self.obj_class.query
+        if profile is not None:
+            query = query.options(*self.load_options(profile))
+        return query
+
+    def load_options(self, profile):
+        # Load profiles are declared per model in LOAD_PROFILES. They list the relationships
+        # to load together with the objects themselves, e.g., everything to_dict() needs.
+        if profile not in self.obj_class.LOAD_PROFILES.keys():
+            raise ValueError('Unknown load profile {} for {}'.format(profile, self.obj_class.__name__))
+        options = []
+        for strategy, attributes in self.obj_class.LOAD_PROFILES[profile].items():
+            for attribute in attributes:
+                options.append(LOADERS[strategy](attribute))
+        return options
+
+    def retrieve(self, profile=None, **kwargs):
         if 'id' in kwargs.keys():
-            obj = self.obj_class.query.get(kwargs['id'])
+            obj = self.query(profile).get(kwargs['id'])
         else:
-            obj = self.obj_class.query.filter_by(**kwargs).first()
+            obj = self.query(profile).filter_by(**kwargs).first()
         return obj
 
-    def retrieve_all(self, **kwargs):
+    def retrieve_by_ids(self, ids, profile=None):
+        # Returns a dictionary of the objects with the given IDs, retrieved with a single query
+        ids = set(ids)
+        if len(ids) == 0:
+            return {}
+        return {obj.id: obj for obj in self.query(profile).filter(self.obj_class.id.in_(ids))}
+
+    def retrieve_all(self, profile=None, **kwargs):
         args = self.parse_args(**kwargs)
         if len(args.keys()) == 0:
-            objects = self.obj_class.query.all()
+            objects = self.query(profile).all()
         else:
-            objects = self.obj_class.query.filter_by(**args).all()
+            objects = self.query(profile).filter_by(**args).all()
         return objects
 
+    def retrieve_page(self, profile=None, cursor=None, limit=None, filters=None, query=None, **kwargs):
+        # Returns objects ordered by ID, starting after ID 'cursor', and whether there are more.
+        # Filters are (field, operator, value) tuples. Equality filters are passed as keyword
+        # arguments, like for retrieve_all(). Instead of all objects of this DAO's class a custom
+        # query (without load options) can be paged through as well.
+        query = self.page_query(cursor, filters, query, **kwargs)
+        if profile is not None:
+            query = query.options(*self.load_options(profile))
+        if limit is None:
+            return query.all(), False
+        # Fetch one extra object to find out if there is a next page
+        objects = query.limit(limit + 1).all()
+        return objects[:limit], len(objects) > limit
+
+    def stream_page(self, profile=None, cursor=None, limit=None, filters=None, query=None, batch_size=1000, **kwargs):
+        # Like retrieve_page() but returns an iterator that loads the objects in batches through
+        # a server-side cursor, and the cursor of the next page (None if there is none). The IDs
+        # in the page are retrieved first so the page's end is known before streaming starts.
+        query = self.page_query(cursor, filters, query, **kwargs)
+        next_cursor = None
+        if limit is not None:
+            ids = [row[0] for row in query.with_entities(self.obj_class.id).limit(limit + 1)]
+            if len(ids) > limit:
+                next_cursor = ids[limit - 1]
+                query = query.filter(self.obj_class.id <= next_cursor)
+        if profile is not None:
+            query = query.options(*self.load_options(profile))
+        return query.yield_per(batch_size), next_cursor
+
+    def page_query(self, cursor=None, filters=None, query=None, **kwargs):
+        if query is None:
+            query = self.query()
+        args = self.parse_args(**kwargs)
+        if len(args.keys()) > 0:
+            query = query.filter_by(**args)
+        for field, operator, value in filters or []:
+            column = getattr(self.obj_class, field)
+            query = query.filter(FILTER_OPERATORS[operator](column, self.parse_value(column, value, field)))
+        if cursor is not None:
+            query = query.filter(self.obj_class.id > cursor)
+        return query.order_by(self.obj_class.id)
+
     def delete(self, obj):
         self.db_session.delete(obj)
         self.db_session.commit()
@@ -53,3 +143,17 @@ class BaseDao(object):
             if kwargs[key]:
                 args[key] = kwargs[key]
         return args
+
+    @staticmethod
+    def parse_value(column, value, field=None):
+        # Filter values arrive as strings. Convert them for numeric columns.
+        try:
+            python_type = column.property.columns[0].type.python_type
+        except NotImplementedError:
+            return value
+        if python_type in (int, long, float):
+            try:
+                return python_type(value)
+            except ValueError:
+                raise InvalidFilter('Invalid value {} for filter on {}'.format(value, field or column.key))
+        return value
@@ -1,7 +1,21 @@
+import hashlib
+import json
+import logging
+import mmap
 import os
+import threading
+import time
 import requests
+import lib.client as client
+from multiprocessing.pool import ThreadPool
 from lib.authentication import token_header
-from lib.util import uri
+from lib.content_cache import get_content_cache
+
+LOG = logging.getLogger(__name__)
+
+# Workers that mount the storage service's files volume read files directly from there
+# instead of downloading them. An empty STORAGE_ROOT_DIR disables direct access.
+STORAGE_ROOT_DIR = os.getenv('STORAGE_ROOT_DIR', '')
 
 
 # --------------------------------------------------------------------------------------------------------------------
@@ -14,49 +28,490 @@ def read_chunks(file_obj, chunk_size):
 
 
 # --------------------------------------------------------------------------------------------------------------------
-def upload_file(file_name, file_type_id, scan_type_id, repository_id, token):
-    session_id = None
-    file_id = None
-    storage_id = None
+def file_sha1(file_name, chunk_size=1024 * 1024):
+    sha1 = hashlib.sha1()
     with open(file_name, 'rb') as f:
-        i = 0
-        n = os.path.getsize(file_name)
-        chunk_size = int(n / 10)
         for chunk in read_chunks(f, chunk_size):
-            content_length = len(chunk)
-            content_range = 'bytes {}-{}/{}'.format(i, i + len(chunk) - 1, n)
-            headers = token_header(token)
-            headers.update({
-                'Content-Length': '{}'.format(content_length),
-                'Content-Type': 'application/octet-stream',
-                'Content-Disposition': 'attachment; filename={}'.format(file_name),
-                'X-Content-Range': content_range,
-                'X-Session-ID': session_id,
-                'X-File-Type': '{}'.format(file_type_id),
-                'X-Scan-Type': '{}'.format(scan_type_id),
-                'X-Repository-ID': '{}'.format(repository_id)})
-            response = requests.post(uri('storage', '/uploads'), headers=headers, data=chunk)
-            if response.status_code == 201:
-                file_id = response.json()['id']
-                storage_id = response.json()['storage_id']
-                break
-            if response.status_code != 202:
-                raise RuntimeError('Response not 202 ({})'.format(response.status_code))
-            session_id = response.headers['X-Session-ID']
-            i += len(chunk)
-    return file_id, storage_id
-
-
-# --------------------------------------------------------------------------------------------------------------------
-def download_file(storage_id, target_dir, token, extension=None):
-    response = requests.get(
-        uri('storage', '/downloads/{}'.format(storage_id)), headers=token_header(token))
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def check_upload(file_name, file_type_id, scan_type_id, repository_id, token, sha1=None):
+    # Asks the storage service to create the file from content it already has. Returns the
+    # file ID and storage ID if it did, or (None, None) if the file still has to be uploaded.
+    response = client.post('storage', '/uploads/check', headers=token_header(token), json={
+        'sha1': sha1 or file_sha1(file_name),
+        'size': os.path.getsize(file_name),
+        'name': os.path.basename(file_name),
+        'file_type_id': file_type_id,
+        'scan_type_id': scan_type_id,
+        'repository_id': repository_id,
+    })
+    if response.status_code == 201:
+        return response.json()['id'], response.json()['storage_id']
+    if response.status_code != 404:
+        raise RuntimeError('Upload check failed ({})'.format(response.status_code))
+    return None, None
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def upload_file(file_name, file_type_id, scan_type_id, repository_id, token, check=True, progress=None):
+    uploader = FileUploader(token, progress=progress)
+    return uploader.upload(file_name, file_type_id, scan_type_id, repository_id, check)
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def upload_files(files, token, check=True, progress=None, concurrency=None):
+    # Uploads (file_name, file_type_id, scan_type_id, repository_id) tuples in parallel and
+    # returns their (file_id, storage_id) tuples in the same order
+    uploader = FileUploader(token, progress=progress, concurrency=concurrency)
+    return uploader.upload_all(files, check)
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def upload_batch(file_names, file_type_id, scan_type_id, repository_id, token, batch_size=None):
+    # Uploads many small files with few requests. Files are sent together in multipart
+    # requests of at most 'batch_size' bytes (nginx accepts up to 128 MB per request), each
+    # creating its files in a single transaction. Requests carry at most UPLOAD_BATCH_MAX_FILES
+    # files because each of them is kept open. Larger files are uploaded in chunks. Returns
+    # the (file_id, storage_id) tuples in the same order.
+    batch_size = batch_size or int(os.getenv('UPLOAD_BATCH_SIZE', str(64 * 1024 * 1024)))
+    max_files = int(os.getenv('UPLOAD_BATCH_MAX_FILES', '500'))
+    results = {}
+    batch = []
+    nr_bytes = 0
+    for file_name in file_names:
+        size = os.path.getsize(file_name)
+        if size > batch_size:
+            results[file_name] = upload_file(file_name, file_type_id, scan_type_id, repository_id, token)
+            continue
+        if nr_bytes + size > batch_size or len(batch) == max_files:
+            results.update(_upload_batch(batch, file_type_id, scan_type_id, repository_id, token))
+            batch = []
+            nr_bytes = 0
+        batch.append(file_name)
+        nr_bytes += size
+    results.update(_upload_batch(batch, file_type_id, scan_type_id, repository_id, token))
+    return [results[file_name] for file_name in file_names]
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def _upload_batch(file_names, file_type_id, scan_type_id, repository_id, token):
+    if len(file_names) == 0:
+        return {}
+    handles = [open(file_name, 'rb') for file_name in file_names]
+    try:
+        response = client.post(
+            'storage', '/repositories/{}/files:batch'.format(repository_id), headers=token_header(token),
+            data={'file_type_id': file_type_id, 'scan_type_id': scan_type_id},
+            files=[('files', (os.path.basename(n), f)) for n, f in zip(file_names, handles)])
+    finally:
+        for f in handles:
+            f.close()
+    if response.status_code != 201:
+        raise RuntimeError('Batch upload failed ({})'.format(response.status_code))
+    return {n: (f['id'], f['storage_id']) for n, f in zip(file_names, response.json())}
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def upload_archive(file_name, file_set_name, file_type_id, scan_type_id, repository_id, token, content_type=None):
+    # Uploads a tar or zip archive, e.g., of a DICOM series, and has the storage service add
+    # its files to the repository and to a new file set. Archives that are too large for a
+    # single request are uploaded in chunks first. Returns the file set.
+    params = {
+        'name': file_set_name, 'file_type_id': file_type_id, 'scan_type_id': scan_type_id,
+        'content_type': content_type,
+    }
+    path = '/repositories/{}/file-sets:extract'.format(repository_id)
+    if os.path.getsize(file_name) > int(os.getenv('UPLOAD_BATCH_SIZE', str(64 * 1024 * 1024))):
+        params['file_id'], _ = upload_file(file_name, file_type_id, scan_type_id, repository_id, token)
+        response = client.post('storage', path, params=params, headers=token_header(token))
+    else:
+        headers = token_header(token)
+        if file_name.endswith('.zip'):
+            headers['Content-Type'] = 'application/zip'
+        else:
+            headers['Content-Type'] = 'application/x-tar'
+        with open(file_name, 'rb') as f:
+            response = client.post('storage', path, params=params, data=f, headers=headers)
+    if response.status_code != 201:
+        raise RuntimeError('Archive upload failed ({})'.format(response.status_code))
+    return response.json()
+
+
+# --------------------------------------------------------------------------------------------------------------------
+class FileUploader(object):
+
+    # Upload settings are read from the environment, like the client settings in lib.client.
+    # Chunks must stay below nginx's client_max_body_size (128m).
+    CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', str(8 * 1024 * 1024)))
+    MIN_CHUNK_SIZE = int(os.getenv('UPLOAD_MIN_CHUNK_SIZE', str(1024 * 1024)))
+    MAX_CHUNK_SIZE = int(os.getenv('UPLOAD_MAX_CHUNK_SIZE', str(64 * 1024 * 1024)))
+    # Chunk sizes are adapted so that each chunk takes about this many seconds
+    CHUNK_TARGET_TIME = float(os.getenv('UPLOAD_CHUNK_TARGET_TIME', '2.0'))
+    MAX_RETRIES = int(os.getenv('UPLOAD_MAX_RETRIES', '5'))
+    BACKOFF_FACTOR = float(os.getenv('UPLOAD_BACKOFF_FACTOR', '0.5'))
+    CONCURRENCY = int(os.getenv('UPLOAD_CONCURRENCY', '4'))
+
+    def __init__(self, token, chunk_size=None, progress=None, concurrency=None):
+        self.token = token
+        self.chunk_size = chunk_size or self.CHUNK_SIZE
+        # Called as progress(file_name, nr_bytes_sent, nr_bytes_total) after each chunk
+        self.progress = progress
+        self.concurrency = concurrency or self.CONCURRENCY
+        self.nr_bytes = 0
+        self.nr_seconds = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def throughput(self):
+        # Bytes per second per connection, over all chunks uploaded so far
+        return self.nr_bytes / self.nr_seconds if self.nr_seconds > 0 else 0.0
+
+    def upload_all(self, files, check=True):
+        # nginx-big-upload only accepts the chunks of a file in order, so concurrency comes
+        # from uploading multiple files at the same time, each with one chunk in flight
+        if len(files) == 0:
+            return []
+        start = time.time()
+        pool = ThreadPool(min(self.concurrency, len(files)))
+        try:
+            results = pool.map(lambda args: self.upload(*(tuple(args) + (check,))), files)
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = time.time() - start
+        LOG.info('Uploaded {} files ({} bytes) in {:.1f}s ({:.0f} bytes/s)'.format(
+            len(files), self.nr_bytes, elapsed, self.nr_bytes / elapsed if elapsed > 0 else 0.0))
+        return results
+
+    def upload(self, file_name, file_type_id, scan_type_id, repository_id, check=True):
+        # Content the storage service already has is not uploaded again
+        sha1 = None
+        if check:
+            sha1 = file_sha1(file_name)
+            file_id, storage_id = check_upload(
+                file_name, file_type_id, scan_type_id, repository_id, self.token, sha1)
+            if file_id is not None:
+                return file_id, storage_id
+        n = os.path.getsize(file_name)
+        headers = token_header(self.token)
+        headers.update({
+            'Content-Type': 'application/octet-stream',
+            'Content-Disposition': 'attachment; filename={}'.format(file_name),
+            'X-File-Type': '{}'.format(file_type_id),
+            'X-Scan-Type': '{}'.format(scan_type_id),
+            'X-Repository-ID': '{}'.format(repository_id)})
+        session_id = None
+        chunk_size = min(self.chunk_size, self.MAX_CHUNK_SIZE)
+        offset = 0
+        nr_resumes = 0
+        start = time.time()
+        with open(file_name, 'rb') as f:
+            while True:
+                f.seek(offset)
+                chunk = f.read(min(chunk_size, n - offset))
+                if len(chunk) == 0 and n > 0:
+                    raise RuntimeError('File {} changed during upload'.format(file_name))
+                # The server checks the SHA-1 of the complete file when it receives the last chunk
+                last = offset + len(chunk) >= n
+                chunk_start = time.time()
+                response, session_id = self._upload_chunk(
+                    headers, chunk, offset, n, session_id, sha1 if last else None)
+                elapsed = time.time() - chunk_start
+                if response.status_code == 201:
+                    self._add_stats(len(chunk), elapsed)
+                    self._report(file_name, n, n)
+                    LOG.info('Uploaded {} ({} bytes) in {:.1f}s'.format(file_name, n, time.time() - start))
+                    return response.json()['id'], response.json()['storage_id']
+                # Both 202 (chunk accepted) and 409 (chunk out of order) tell us how much the
+                # server has, so we continue from there
+                received = self._received(response)
+                if received <= offset:
+                    nr_resumes += 1
+                    if nr_resumes > self.MAX_RETRIES:
+                        raise RuntimeError('Upload of {} not making progress'.format(file_name))
+                    LOG.warning('Resuming upload of {} at byte {}'.format(file_name, received))
+                else:
+                    nr_resumes = 0
+                    self._add_stats(received - offset, elapsed)
+                    chunk_size = self._adapt_chunk_size(chunk_size, len(chunk), elapsed)
+                offset = received
+                self._report(file_name, offset, n)
+
+    def _upload_chunk(self, headers, chunk, offset, n, session_id, sha1=None):
+        # Chunks are retried with exponential backoff. Re-sending a chunk the server already
+        # (partially) received is fine, it will simply be written again.
+        headers = dict(headers)
+        headers.update({
+            'Content-Length': '{}'.format(len(chunk)),
+            'X-Content-Range': 'bytes {}-{}/{}'.format(offset, max(offset + len(chunk) - 1, 0), n)})
+        if session_id is not None:
+            headers['X-Session-ID'] = session_id
+        if sha1 is not None:
+            headers['X-SHA1'] = sha1
+        for i in range(self.MAX_RETRIES + 1):
+            try:
+                response = client.post('storage', '/uploads', headers=headers, data=chunk)
+                if response.status_code in (201, 202, 409):
+                    return response, response.headers.get('X-Session-ID', session_id)
+                if response.status_code < 500:
+                    raise RuntimeError('Upload failed ({}: {})'.format(response.status_code, response.text))
+                error = 'status code {}'.format(response.status_code)
+            except requests.RequestException as e:
+                error = e
+            if i == self.MAX_RETRIES:
+                raise RuntimeError('Upload failed after {} retries ({})'.format(self.MAX_RETRIES, error))
+            LOG.warning('Retrying chunk at byte {} ({})'.format(offset, error))
+            time.sleep(self.BACKOFF_FACTOR * (2 ** i))
+
+    @staticmethod
+    def _received(response):
+        # Response body is the range the server has so far, e.g., '0-1023/4096'. For an
+        # unknown session it is '0-0/0', meaning we have to start over.
+        received, total = response.text.strip().split('/')
+        if total == '0':
+            return 0
+        return int(received.split('-', 1)[1]) + 1
+
+    def _adapt_chunk_size(self, chunk_size, nr_bytes, elapsed):
+        # Double or halve the chunk size if chunks are much faster or slower than the target.
+        # Small chunks mean a lot of request overhead, large chunks mean a lot of work lost on
+        # failure and nginx refusing them.
+        if nr_bytes < chunk_size:
+            return chunk_size
+        if elapsed < self.CHUNK_TARGET_TIME / 2:
+            return min(chunk_size * 2, self.MAX_CHUNK_SIZE)
+        if elapsed > self.CHUNK_TARGET_TIME * 2:
+            return max(chunk_size / 2, self.MIN_CHUNK_SIZE)
+        return chunk_size
+
+    def _add_stats(self, nr_bytes, elapsed):
+        with self._lock:
+            self.nr_bytes += nr_bytes
+            self.nr_seconds += elapsed
+
+    def _report(self, file_name, nr_bytes, total):
+        if self.progress is not None:
+            self.progress(file_name, nr_bytes, total)
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def download_file(storage_id, target_dir, token, extension=None, byte_range=None, progress=None, concurrency=None,
+                  sha1=None):
+    # Downloads the file to <target_dir>/<storage_id>[.<extension>]. Interrupted downloads
+    # are resumed. With byte_range=(first, last) only these bytes (inclusive) are downloaded.
+    # If the worker mounts the files volume, complete files are linked from there instead.
+    # Otherwise, if the node has a content cache, they are linked from the cache and only
+    # downloaded once per node. If given, the SHA-1 is verified when filling the cache.
     file_path = os.path.join(target_dir, storage_id)
     if extension:
         if not extension.startswith('.'):
             extension = '.{}'.format(extension)
         file_path = '{}{}'.format(file_path, extension)
-    with open(file_path, 'wb') as f:
-        for chunk in response.iter_content(1024 * 1024):
-            f.write(chunk)
+    downloader = FileDownloader(token, progress=progress, concurrency=concurrency)
+    if byte_range is not None:
+        with open(file_path, 'wb') as f:
+            f.write(downloader.download_range(storage_id, byte_range[0], byte_range[1]))
+        return file_path
+    shared_path = shared_file_path(storage_id, token)
+    if shared_path is not None:
+        # Files on the shared volume are never modified, so a symlink is enough
+        if os.path.lexists(file_path):
+            os.remove(file_path)
+        os.symlink(shared_path, file_path)
+        return file_path
+    cache = get_content_cache()
+    if cache is not None:
+        return cache.link(storage_id, file_path, lambda path: downloader.download(storage_id, path), sha1=sha1)
+    return downloader.download(storage_id, file_path)
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def shared_file_path(storage_id, token):
+    # Returns the file's path on the shared files volume, or None if this worker does not
+    # mount it (or the file is not there, e.g., the volume is local to another node). The
+    # HEAD request goes through the same access check as a download but transfers no data.
+    if not STORAGE_ROOT_DIR or os.path.basename(storage_id) != storage_id:
+        return None
+    file_path = os.path.join(STORAGE_ROOT_DIR, storage_id)
+    if not os.path.isfile(file_path):
+        return None
+    response = client.head('storage', '/downloads/{}'.format(storage_id), headers=token_header(token))
+    if response.status_code != 200:
+        raise RuntimeError('Access to {} denied ({})'.format(storage_id, response.status_code))
     return file_path
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def open_file(storage_id, token):
+    # Returns a read-only memory map of the file on the shared files volume, or None if it
+    # has to be downloaded. Pages are read from the volume on demand without copying.
+    file_path = shared_file_path(storage_id, token)
+    if file_path is None:
+        return None
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def download_range(storage_id, first, last, token):
+    # Returns bytes 'first' up to and including 'last' of the file, e.g., a NIfTI header
+    return FileDownloader(token).download_range(storage_id, first, last)
+
+
+# --------------------------------------------------------------------------------------------------------------------
+class FileDownloader(object):
+
+    # Files larger than PART_SIZE are downloaded in parts of that size, CONCURRENCY at a time
+    PART_SIZE = int(os.getenv('DOWNLOAD_PART_SIZE', str(64 * 1024 * 1024)))
+    CONCURRENCY = int(os.getenv('DOWNLOAD_CONCURRENCY', '4'))
+    BUFFER_SIZE = 1024 * 1024
+    MAX_RETRIES = int(os.getenv('DOWNLOAD_MAX_RETRIES', '5'))
+    BACKOFF_FACTOR = float(os.getenv('DOWNLOAD_BACKOFF_FACTOR', '0.5'))
+
+    def __init__(self, token, progress=None, concurrency=None):
+        self.token = token
+        # Called as progress(storage_id, nr_bytes_received, nr_bytes_total)
+        self.progress = progress
+        self.concurrency = concurrency or self.CONCURRENCY
+        self._nr_bytes = 0
+        self._lock = threading.Lock()
+
+    def download(self, storage_id, file_path):
+        # Data is written to '<file_path>.part' and renamed once complete. Parts that were
+        # completed by an earlier, interrupted download are listed in '<file_path>.part.json'.
+        size, ranges_supported = self._file_info(storage_id)
+        part_path = file_path + '.part'
+        state_path = part_path + '.json'
+        state = self._load_state(state_path, size)
+        if size == 0:
+            open(part_path, 'wb').close()
+        elif not ranges_supported:
+            # No way to resume or split up the download
+            self._fetch(storage_id, part_path, 0, size - 1, size, truncate=True)
+        elif size <= self.PART_SIZE or self.concurrency == 1:
+            # Sequential download that continues where a previous attempt stopped. A state file
+            # means the '.part' file was created by a download in parts. Its size then says
+            # nothing about the bytes received (it is truncated to the full size up front), so
+            # we start over.
+            offset = 0
+            if os.path.isfile(part_path) and not os.path.isfile(state_path):
+                offset = min(os.path.getsize(part_path), size)
+            self._nr_bytes = offset
+            if offset < size:
+                self._fetch(storage_id, part_path, offset, size - 1, size, truncate=offset == 0)
+        else:
+            self._download_parts(storage_id, part_path, state_path, state)
+        os.rename(part_path, file_path)
+        if os.path.isfile(state_path):
+            os.remove(state_path)
+        return file_path
+
+    def download_range(self, storage_id, first, last):
+        shared_path = shared_file_path(storage_id, self.token)
+        if shared_path is not None:
+            with open(shared_path, 'rb') as f:
+                f.seek(first)
+                return f.read(last - first + 1)
+        headers = token_header(self.token)
+        headers['Range'] = 'bytes={}-{}'.format(first, last)
+        response = self._get(storage_id, headers)
+        if response.status_code == 206:
+            return response.content
+        # Server ignored the range, so take it from the complete file
+        return response.content[first:last + 1]
+
+    def _download_parts(self, storage_id, part_path, state_path, state):
+        size = state['size']
+        if not os.path.isfile(part_path) or len(state['done']) == 0:
+            # The state file is written before the '.part' file is truncated, so a sequential
+            # retry never takes the zero-filled file for received data (see download())
+            with open(state_path, 'w') as f:
+                json.dump(state, f)
+            with open(part_path, 'wb') as f:
+                f.truncate(size)
+        parts = []
+        for i, first in enumerate(range(0, size, state['part_size'])):
+            last = min(first + state['part_size'], size) - 1
+            if i in state['done']:
+                self._nr_bytes += last - first + 1
+            else:
+                parts.append((i, first, last))
+
+        def fetch_part(part):
+            i, first, last = part
+            self._fetch(storage_id, part_path, first, last, size)
+            with self._lock:
+                state['done'].append(i)
+                with open(state_path, 'w') as f:
+                    json.dump(state, f)
+
+        pool = ThreadPool(min(self.concurrency, max(len(parts), 1)))
+        try:
+            pool.map(fetch_part, parts)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _fetch(self, storage_id, path, first, last, size, truncate=False):
+        # Writes bytes 'first' to 'last' to the same position in the file. If the connection
+        # fails we continue after the last byte written.
+        mode = 'r+b' if os.path.isfile(path) and not truncate else 'wb'
+        with open(path, mode) as f:
+            f.seek(first)
+            nr_written = 0
+            for i in range(self.MAX_RETRIES + 1):
+                headers = token_header(self.token)
+                if first + nr_written > 0 or last < size - 1:
+                    headers['Range'] = 'bytes={}-{}'.format(first + nr_written, last)
+                try:
+                    response = self._get(storage_id, headers)
+                    if response.status_code == 200 and 'Range' in headers:
+                        raise RuntimeError('Server ignored range request for {}'.format(storage_id))
+                    for chunk in response.iter_content(self.BUFFER_SIZE):
+                        f.write(chunk)
+                        nr_written += len(chunk)
+                        self._report(storage_id, len(chunk), size)
+                    if first + nr_written > last:
+                        return
+                    raise requests.ConnectionError('Connection closed after {} bytes'.format(nr_written))
+                except requests.RequestException as e:
+                    if i == self.MAX_RETRIES:
+                        raise RuntimeError('Download of {} failed after {} retries ({})'.format(
+                            storage_id, self.MAX_RETRIES, e))
+                    LOG.warning('Retrying download of {} at byte {} ({})'.format(storage_id, first + nr_written, e))
+                    time.sleep(self.BACKOFF_FACTOR * (2 ** i))
+
+    def _get(self, storage_id, headers):
+        response = client.get('storage', '/downloads/{}'.format(storage_id), headers=headers, stream=True)
+        if response.status_code not in (200, 206):
+            raise RuntimeError('Download of {} failed ({})'.format(storage_id, response.status_code))
+        return response
+
+    def _file_info(self, storage_id):
+        # Returns the file's size and whether the server accepts range requests for it
+        response = client.head('storage', '/downloads/{}'.format(storage_id), headers=token_header(self.token))
+        if response.status_code != 200:
+            raise RuntimeError('Download of {} failed ({})'.format(storage_id, response.status_code))
+        return int(response.headers.get('Content-Length', 0)), response.headers.get('Accept-Ranges') == 'bytes'
+
+    def _load_state(self, state_path, size):
+        try:
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+            if state['size'] == size and state['part_size'] > 0:
+                return state
+        except (IOError, ValueError, KeyError):
+            pass
+        return {'size': size, 'part_size': self.PART_SIZE, 'done': []}
+
+    def _report(self, storage_id, nr_bytes, size):
+        with self._lock:
+            self._nr_bytes += nr_bytes
+            nr_bytes = self._nr_bytes
+        if self.progress is not None:
+            self.progress(storage_id, nr_bytes, size)
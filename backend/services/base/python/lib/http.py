@@ -7,6 +7,7 @@ UNAUTHORIZED_401 = 401  # Not authenticated
 FORBIDDEN_403 = 403  # Not authorized
 NOT_FOUND_404 = 404  # Requested resource could not be found
 METHOD_NOT_ALLOWED_405 = 405  # Request method not allowed for this resource
+TOO_MANY_REQUESTS_429 = 429  # Client sent too many requests in a given amount of time
 INTERNAL_SERVER_ERROR_500 = 500  # General error/exception server-side
 NOT_IMPLEMENTED_501 = 501  # Server could not process request
 BAD_GATEWAY_502 = 502  # Server is acting as gateway and received error from upstream
@@ -22,6 +23,7 @@ STRINGS = {
     403: 'FORBIDDEN_403 - Client is authenticated but not authorized to perform intended action',
     404: 'NOT_FOUND_404 - Requested resource not found on server',
     405: 'METHOD_NOT_ALLOWED_405 - Request method not allowed or available for this resource',
+    429: 'TOO_MANY_REQUESTS_429 - Client sent too many requests in a given amount of time',
     500: 'INTERNAL_SERVER_ERROR_500 - General server-side error',
     501: 'NOT_IMPLEMENTED_501 - Server did not recognize HTTP method',
     502: 'BAD_GATEWAY_502 - Server is acting as a gateway and received error from upstream server',
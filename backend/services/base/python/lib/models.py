@@ -40,6 +40,10 @@ class BaseModel(Base):
     # Model type
     model_type = Column(String(64))
 
+    # Relationships to load eagerly per load profile, e.g., {'dict': {'joined': ['file_type']}}.
+    # See BaseDao.query() for the available strategies.
+    LOAD_PROFILES = {}
+
     __mapper_args__ = {
         'polymorphic_identity': 'base',
         'polymorphic_on': model_type,
@@ -1,5 +1,23 @@
+import requests
+import lib.client as client
+from lib.authentication import get_service_token, token_header
 
 
-# --------------------------------------------------------------------------------------------------------------------
-def check_permissions(user):
-    pass
+# ----------------------------------------------------------------------------------------------------------------------
+def check_permissions(token, permissions):
+    # Asks the auth service which of the given permissions the owner of the client token
+    # has. Returns a list of booleans in the same order as the permissions.
+    if len(permissions) == 0:
+        return [], None
+    service_token, msg = get_service_token()
+    if service_token is None:
+        return None, msg
+    try:
+        response = client.post(
+            'auth', '/permission-checks', json={'token': token, 'permissions': permissions},
+            headers=token_header(service_token))
+    except requests.RequestException as e:
+        return None, 'Permission check failed (Auth service not available ({}))'.format(e)
+    if response.status_code != 201:
+        return None, 'Permission check failed ({})'.format(response.json())
+    return response.json()['results'], None
@@ -0,0 +1,19 @@
+from flask import g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def enable_query_counter(app):
+    # Counts the SQL statements executed per request and returns the count in the
+    # 'X-Query-Count' response header. Meant for tests, which use it to check that
+    # endpoints run a bounded number of queries regardless of the number of objects.
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context():
+            g.query_count = getattr(g, 'query_count', 0) + 1
+
+    @app.after_request
+    def add_query_count(response):
+        response.headers['X-Query-Count'] = str(getattr(g, 'query_count', 0))
+        return response
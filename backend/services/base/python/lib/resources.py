@@ -1,6 +1,12 @@
+import json
 import logging
-from flask import g
-from flask_restful import Resource
+import urllib
+import redis
+import lib.http as http
+from flask import g, request, Response, stream_with_context
+from flask_restful import Resource, reqparse
+from lib.authentication import token_required, is_admin_or_auth_service
+from lib.dao import FILTER_OPERATORS, InvalidFilter
 from lib.util import get_correlation_id
 
 
@@ -14,7 +20,12 @@ class BaseResource(Resource):
 
     def dispatch_request(self, *args, **kwargs):
         self._correlation_id = get_correlation_id()
-        return super(BaseResource, self).dispatch_request(*args, **kwargs)
+        g.correlation_id = self._correlation_id
+        try:
+            return super(BaseResource, self).dispatch_request(*args, **kwargs)
+        except InvalidFilter as e:
+            # Filter values are only converted when the query is built (see BaseDao.page_query())
+            return self.error_response(e.message, http.BAD_REQUEST_400)
 
     @staticmethod
     def db_session():
@@ -46,6 +57,135 @@ class BaseResource(Resource):
     def response(data, status_code=200, headers=None):
         return data, status_code, headers
 
+    def list_args(self, filter_fields=None):
+        # Parses the paging, field selection and filter parameters of list requests, e.g.,
+        # '?limit=100&cursor=2000&fields=id,name&size__gte=1024&name__prefix=scan'. Filters
+        # are only allowed on 'filter_fields'. Returns the arguments or an error message.
+        parser = reqparse.RequestParser()
+        parser.add_argument('limit', type=int, location='args')
+        parser.add_argument('cursor', type=int, location='args')
+        parser.add_argument('fields', type=str, location='args')
+        args = parser.parse_args()
+        page_size = self.config().get('DEFAULT_PAGE_SIZE', 1000)
+        max_page_size = self.config().get('MAX_PAGE_SIZE', 10000)
+        if args['limit'] is None:
+            args['limit'] = page_size
+        if args['limit'] < 1:
+            return None, 'Invalid limit {}'.format(args['limit'])
+        args['limit'] = min(args['limit'], max_page_size)
+        if args['fields'] is not None:
+            args['fields'] = [field.strip() for field in args['fields'].split(',') if field.strip()]
+        args['filters'] = []
+        for key, value in request.args.items():
+            if '__' not in key:
+                continue
+            field, operator = key.rsplit('__', 1)
+            if field not in (filter_fields or []) or operator not in FILTER_OPERATORS.keys():
+                return None, 'Invalid filter {}'.format(key)
+            args['filters'].append((field, operator, value))
+        return args, None
+
+    def list_response(self, objects, has_more, args, result=None):
+        # Returns (the selected fields of) the objects. If there are more objects a 'Link'
+        # header refers to the next page.
+        if result is None:
+            result = [obj.to_dict() for obj in objects]
+        result = [self.select_fields(item, args['fields']) for item in result]
+        next_cursor = objects[-1].id if has_more and len(objects) > 0 else None
+        return self.response(result, http.OK_200, self.next_page_headers(next_cursor, args))
+
+    def stream_list_response(self, objects, next_cursor, args):
+        # Writes the objects while they are loaded, instead of building the complete response
+        # in memory first. Objects are written as a JSON array, or as newline-delimited JSON if
+        # the client accepts 'application/x-ndjson'.
+        ndjson = request.accept_mimetypes.best == 'application/x-ndjson'
+        buffer_size = self.config().get('STREAM_BUFFER_SIZE', 65536)
+        items = (self.select_fields(obj.to_dict(), args['fields']) for obj in objects)
+        if self.config().get('QUERY_COUNTER_ENABLED', False):
+            # Load everything before the headers are sent so that the query count is complete
+            items = list(items)
+
+        def generate():
+            chunks, size = [], 0
+            if not ndjson:
+                chunks.append('[')
+            for i, item in enumerate(items):
+                item = json.dumps(item)
+                if ndjson:
+                    chunks.append(item + '\n')
+                else:
+                    chunks.append(item if i == 0 else ', ' + item)
+                size += len(chunks[-1])
+                if size >= buffer_size:
+                    yield ''.join(chunks)
+                    chunks, size = [], 0
+            if not ndjson:
+                chunks.append(']')
+            yield ''.join(chunks)
+
+        mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+        return Response(
+            stream_with_context(generate()), http.OK_200, self.next_page_headers(next_cursor, args), mimetype=mimetype)
+
+    @staticmethod
+    def select_fields(item, fields):
+        if fields is None:
+            return item
+        return dict((field, item[field]) for field in fields if field in item)
+
+    @staticmethod
+    def next_page_headers(next_cursor, args):
+        # The link is relative so that it also works for clients going through the UI
+        # service's proxy
+        headers = {}
+        if next_cursor is not None:
+            params = request.args.to_dict()
+            params.update({'cursor': next_cursor, 'limit': args['limit']})
+            headers['Link'] = '<?{}>; rel="next"'.format(urllib.urlencode(sorted(params.items())))
+        return headers
+
     @property
     def correlation_id(self):
         return self._correlation_id
+
+
+# --------------------------------------------------------------------------------------------------------------------
+class TokenCacheResource(BaseResource):
+
+    URI = '/token-cache'
+
+    @token_required
+    def get(self):
+
+        if g.token_cache is None:
+            return self.error_response('Token cache not enabled', http.NOT_FOUND_404)
+
+        return self.response(g.token_cache.stats())
+
+
+# --------------------------------------------------------------------------------------------------------------------
+class TokenCacheInvalidationsResource(BaseResource):
+
+    URI = '/token-cache-invalidations'
+
+    @token_required
+    def post(self):
+
+        # Called by the auth service when a user is deactivated or its permissions change.
+        # Without a user ID the whole cache is cleared. Local caches pass the invalidation on
+        # to the other processes of this service.
+        if not is_admin_or_auth_service(g.current_user):
+            return self.error_response('Not allowed to invalidate token cache', http.FORBIDDEN_403)
+
+        parser = reqparse.RequestParser()
+        parser.add_argument('user_id', type=int, location='json')
+        args = parser.parse_args()
+
+        if g.token_cache is not None:
+            try:
+                g.token_cache.broadcast_invalidation(args['user_id'])
+            except redis.RedisError as e:
+                return self.error_response(
+                    'Could not invalidate token cache ({})'.format(e), http.SERVICE_UNAVAILABLE_503)
+
+        return self.response({}, http.CREATED_201)
@@ -0,0 +1,163 @@
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import requests
+import lib.client as client
+from jose import jwt, JWTError
+
+LOG = logging.getLogger(__name__)
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def get_token_manager(username, password, token_dir, refresh_margin=300, lifetime=3600):
+    # One manager per user per process. Managers inherited from a parent process are not
+    # reused because their locks and background threads belong to the parent.
+    key = (os.getpid(), username)
+    with _managers_lock:
+        if key not in _managers:
+            _managers[key] = ServiceTokenManager(username, password, token_dir, refresh_margin, lifetime)
+        return _managers[key]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class ServiceTokenManager(object):
+
+    # The refresh margin is at most this fraction of a token's lifetime. Otherwise tokens would
+    # be due for refresh as soon as they are issued and every call would log in again.
+    MAX_MARGIN_FRACTION = 0.5
+
+    def __init__(self, username, password, token_dir, refresh_margin=300, lifetime=3600):
+        self.username = username
+        self.password = password
+        self.token_dir = token_dir
+        # Tokens are refreshed in the background once they are within this many seconds
+        # of expiring. Tokens without an expiry claim are refreshed after 'lifetime' seconds.
+        self.refresh_margin = min(refresh_margin, lifetime * self.MAX_MARGIN_FRACTION)
+        self.lifetime = lifetime
+        self._token = None
+        self._expires_at = 0
+        self._margin = self.refresh_margin
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._refreshing_lock = threading.Lock()
+
+    def get_token(self):
+        now = time.time()
+        if self._token is None or now >= self._expires_at:
+            # No usable token, so we have to wait for a new one. Concurrent callers in this
+            # process wait for the same refresh.
+            with self._lock:
+                if self._token is None or time.time() >= self._expires_at:
+                    self._refresh()
+        elif now >= self._expires_at - self._margin:
+            # Token is still valid but about to expire. Hand it out and refresh in the background.
+            self._refresh_in_background()
+        return self._token
+
+    def invalidate(self):
+        # Drop the current token, e.g., because the auth service no longer accepts it. The
+        # shared copy is only removed if no other process replaced it with a new token yet.
+        with self._lock:
+            token = self._token
+            self._token = None
+            self._expires_at = 0
+            try:
+                with open(self._token_file(), 'r') as f:
+                    if json.load(f)['token'] == token:
+                        os.remove(self._token_file())
+            except (IOError, OSError, ValueError):
+                pass
+
+    def _refresh_in_background(self):
+        with self._refreshing_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def refresh():
+            try:
+                with self._lock:
+                    self._refresh()
+            except (RuntimeError, requests.RequestException) as e:
+                LOG.warning('Background refresh of token for user {} failed ({})'.format(self.username, e))
+            finally:
+                self._refreshing = False
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+    def _refresh(self):
+        # Another process on this host may have refreshed the token already. If not, take
+        # the host-wide lock so only one process logs in and the others pick up its token.
+        if self._load_shared_token():
+            return
+        if not os.path.isdir(self.token_dir):
+            os.makedirs(self.token_dir, 0o700)
+        with open(self._token_file() + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if self._load_shared_token():
+                    return
+                token, issued_at, expires_at = self._login()
+                self._save_shared_token(token, issued_at, expires_at)
+                self._token = token
+                self._expires_at = expires_at
+                self._margin = self._margin_for(issued_at, expires_at)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _login(self):
+        LOG.debug('Requesting new token for user {}'.format(self.username))
+        response = client.post('auth', '/tokens', auth=(self.username, self.password))
+        if response.status_code != 201:
+            raise RuntimeError('Authentication failed ({})'.format(response.json()))
+        token = response.json()['token']
+        issued_at = time.time()
+        expires_at = None
+        try:
+            claims = jwt.get_unverified_claims(token)
+            issued_at = claims.get('iat', issued_at)
+            expires_at = claims.get('exp')
+        except JWTError:
+            pass
+        if expires_at is None:
+            expires_at = issued_at + self.lifetime
+        return token, issued_at, expires_at
+
+    def _margin_for(self, issued_at, expires_at):
+        # The refresh margin for a token, clamped to a fraction of its actual lifetime
+        if issued_at is None:
+            return self.refresh_margin
+        return min(self.refresh_margin, (expires_at - issued_at) * self.MAX_MARGIN_FRACTION)
+
+    def _load_shared_token(self):
+        try:
+            with open(self._token_file(), 'r') as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return False
+        margin = self._margin_for(data.get('issued_at'), data['expires_at'])
+        if data['expires_at'] - time.time() <= margin:
+            return False
+        self._token = data['token']
+        self._expires_at = data['expires_at']
+        self._margin = margin
+        return True
+
+    def _save_shared_token(self, token, issued_at, expires_at):
+        # Write to a temporary file first so readers never see a partially written token
+        fd, tmp_path = tempfile.mkstemp(dir=self.token_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'token': token, 'issued_at': issued_at, 'expires_at': expires_at}, f)
+        os.rename(tmp_path, self._token_file())
+
+    def _token_file(self):
+        return os.path.join(self.token_dir, '{}.json'.format(self.username))
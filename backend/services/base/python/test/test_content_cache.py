@@ -0,0 +1,30 @@
+import os
+import shutil
+from lib.util import generate_string
+from lib.content_cache import ContentCache
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def test_content_cache():
+
+    cache_dir = 'tmp-cache-{}'.format(generate_string(8))
+    cache = ContentCache(cache_dir, max_size=1500, min_age=0)
+    fills = []
+
+    def fill(file_path):
+        fills.append(file_path)
+        with open(file_path, 'w') as f:
+            f.write(generate_string(1000))
+
+    try:
+        file_path = cache.link('a', os.path.join(cache_dir, 'a.txt'), fill)
+        cache.link('a', os.path.join(cache_dir, 'a-again.txt'), fill)
+        assert len(fills) == 1
+        assert os.stat(file_path).st_nlink == 3
+        # Adding a second entry exceeds the maximum size, so the least recently used one goes
+        cache.link('b', os.path.join(cache_dir, 'b.txt'), fill)
+        assert len(fills) == 2
+        assert cache.stats()['nr_entries'] == 1
+        assert os.path.isfile(file_path)
+    finally:
+        shutil.rmtree(cache_dir)
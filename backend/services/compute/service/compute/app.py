@@ -5,7 +5,9 @@ from flask_restful import Api
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.contrib.cache import SimpleCache
 from resources import RootResource, TasksResource, TaskResource, PipelinesResource
+from lib.cache import create_token_cache
 from lib.models import Base
+from lib.resources import TokenCacheResource, TokenCacheInvalidationsResource
 
 app = Flask(__name__)
 
@@ -19,11 +21,15 @@ api.add_resource(RootResource, RootResource.URI)
 api.add_resource(TasksResource, TasksResource.URI)
 api.add_resource(TaskResource, TaskResource.URI.format('<string:id>'))
 api.add_resource(PipelinesResource, PipelinesResource.URI)
+api.add_resource(TokenCacheResource, TokenCacheResource.URI)
+api.add_resource(TokenCacheInvalidationsResource, TokenCacheInvalidationsResource.URI)
 
 db = SQLAlchemy(app)
 
 cache = SimpleCache()
 
+token_cache = create_token_cache(app.config)
+
 
 # ----------------------------------------------------------------------------------------------------------------------
 @api.representation('application/json')
@@ -48,6 +54,7 @@ def before_request():
     g.config = app.config
     g.db_session = db.session
     g.cache = cache
+    g.token_cache = token_cache
 
 
 # ----------------------------------------------------------------------------------------------------------------------
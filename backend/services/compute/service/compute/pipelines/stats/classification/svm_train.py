@@ -1,14 +1,21 @@
 from celery import chord, shared_task
 from lib.util import timing_now, timing_elapsed_to_str
+from sklearn.base import clone
 from sklearn.cross_validation import StratifiedKFold
-from sklearn.grid_search import GridSearchCV
 from sklearn.metrics import accuracy_score
 from sklearn.svm import SVC
 from lib.files import download_file
 from service.compute.pipelines.base import Pipeline
-from service.compute.pipelines.stats.util import load_features, get_xy, save_model, upload_model_archive
+from service.compute.pipelines.stats.kernels import KERNELS, KernelCache, PrecomputedKernelSVC, row_indices
+from service.compute.pipelines.stats.search import STRATEGIES, search, score_points, points
+from service.compute.pipelines.stats.util import load_xy, save_model, upload_model_archive, get_n_jobs, parallel_jobs
 from service.compute.pipelines.util import create_task_dir, delete_task_dir
-from service.compute.pipelines.util import get_access_token, get_storage_id_for_file
+from service.compute.pipelines.util import get_access_token, get_file
+
+# Hyper-parameter grid searched inside each cross-validation fold
+PARAM_GRID = {
+    'C': [2 ** i for i in range(-5, 15, 2)],
+    'gamma': [2 ** i for i in range(-15, 4, 2)]}
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -18,24 +25,59 @@ class SupportVectorMachineTraining(Pipeline):
 
         # Validate the pipeline parameters
         self.validate_params(params)
-        # Request access token from auth service
-        token = get_access_token()
-        # Get file storage ID from storage service
+        # Get file storage ID and content digest from storage service. Sub-tasks request their
+        # own access token, because a run may take longer than the lifetime of a token.
         print('Retrieving storage ID for repository {} and file {}'.format(params['repository_id'], params['file_id']))
-        storage_id = get_storage_id_for_file(params['repository_id'], params['file_id'], token)
+        f = get_file(params['repository_id'], params['file_id'], get_access_token())
+        storage_id = f['storage_id']
+        sha1 = f.get('sha1')
         # Columns to exclude (optional parameter)
         if 'exclude_columns' not in params.keys():
             params['exclude_columns'] = []
+        # Number of parallel jobs for the grid search in each fold (optional parameter)
+        if 'n_jobs' not in params.keys():
+            params['n_jobs'] = 0
+        # Hyper-parameter search strategy and its settings (optional parameters)
+        if 'search' not in params.keys():
+            params['search'] = 'grid'
+        if 'search_budget' not in params.keys():
+            params['search_budget'] = 20
+        if 'halving_factor' not in params.keys():
+            params['halving_factor'] = 3
+        # Compute the kernel once per fold instead of in each fit (optional parameter)
+        if 'precompute_kernel' not in params.keys():
+            params['precompute_kernel'] = False
+        # Number of folds of the cross-validation inside each fold's search (optional parameter)
+        if 'nr_inner_folds' not in params.keys():
+            params['nr_inner_folds'] = 3
+
+        folds = []
+        for train, test in StratifiedKFold(params['subject_labels'], n_folds=params['nr_folds'], shuffle=True):
+            folds.append((list(train), list(test)))
+
+        if params.get('grid_subtasks', False):
+            # Create sub-task for each fold that scores all grid points on the fold's training
+            # subjects. The body selects the best grid point for each fold, evaluates it on all
+            # folds after loading the features only once and retrains the classifier.
+            print('Training classifier with {}-fold cross-validation and grid search sub-tasks'.format(
+                params['nr_folds']))
+            header = []
+            for i in range(len(folds)):
+                header.append(self.run_grid_fold.subtask((storage_id, sha1, i, folds[i][0], params)))
+            body = self.evaluate_grid_points.subtask((storage_id, sha1, folds, params))
+            job = chord(header=header, body=body)
+            result = job.apply_async()
+            return result.task_id
 
         # Create sub-task for each fold in the cross-validation
         print('Training classifier with {}-fold cross-validation'.format(params['nr_folds']))
         header = []
-        for train, test in StratifiedKFold(params['subject_labels'], n_folds=params['nr_folds'], shuffle=True):
-            header.append(self.run_training_fold.subtask((storage_id, list(train), list(test), params, token)))
+        for train, test in folds:
+            header.append(self.run_training_fold.subtask((storage_id, sha1, train, test, params)))
 
         # Create final task to be executed when the fold tasks are finished
         print('Retraining classifier on all subjects')
-        body = self.retrain_classifier.subtask((storage_id, params, token))
+        body = self.retrain_classifier.subtask((storage_id, sha1, params))
 
         # Create chord task consisting of a header listing each cross-validation fold and
         # a body task that averages the accuracies across folds and then retrains the classifier
@@ -46,37 +88,40 @@ class SupportVectorMachineTraining(Pipeline):
 
     @staticmethod
     @shared_task
-    def run_training_fold(storage_id, train, test, params, token):
+    def run_training_fold(storage_id, sha1, train, test, params):
 
         # Create temporary folder for storing a local copy of the input file(s) as
         # well as any intermediate files that are generated by the pipeline.
         task_dir = create_task_dir()
 
         try:
-            # Download and import the features
+            # Download and import the features. The CSV file is only parsed by the first task
+            # on this node, the others load the columns they need from the converted file. X is
+            # a read-only memory map shared by the tasks on this node, so X[train] and X[test]
+            # only copy the rows of this fold.
             print('Downloading file {} to directory {}'.format(storage_id, task_dir))
-            file_path = download_file(storage_id, task_dir, token)
-            print('Loading features from file {} with index column {}'.format(file_path, params['index_column']))
-            features = load_features(file_path, index_col=params['index_column'])
-            print('Converting to Numpy array with target column {}, excluding {}'.format(
-                params['target_column'], params['exclude_columns']))
-            X, y = get_xy(features, target_column=params['target_column'], exclude_columns=params['exclude_columns'])
-
-            # Convert kernel parameter from unicode to str. For some reason SVC() does
-            # not support unicode parameters.
-            kernel = str(params['kernel'])
+            file_path = download_file(storage_id, task_dir, get_access_token(), sha1=sha1)
+            print('Loading features from file {} with index column {}, target column {}, excluding {}'.format(
+                file_path, params['index_column'], params['target_column'], params['exclude_columns']))
+            X, y = load_xy(
+                file_path, sha1 or storage_id, params['index_column'], target_column=params['target_column'],
+                exclude_columns=params['exclude_columns'])
 
             # Start timing training procedure
             start = timing_now()
 
-            # Start training the classifier using a grid search approach for determining
-            # the optimal hyper-parameters.
-            print('Start training classifier using grid search')
-            param_grid = [{
-                'C': [2 ** i for i in range(-5, 15, 2)],
-                'gamma': [2 ** i for i in range(-15, 4, 2)]}]
-            classifier = GridSearchCV(SVC(kernel=kernel), param_grid=param_grid, scoring='accuracy')
-            classifier.fit(X[train], y[train])
+            # Start training the classifier using a search of the hyper-parameter grid for
+            # determining the optimal hyper-parameters (see search.py). The grid points are
+            # fitted in parallel on the cores reserved by this worker process.
+            strategy = params.get('search', 'grid')
+            n_jobs = get_n_jobs(params.get('n_jobs', 0))
+            estimator, X = create_estimator(X, params)
+            print('Start training classifier using {} search ({} jobs)'.format(strategy, n_jobs))
+            with parallel_jobs():
+                classifier, best_params, n_fits = search(
+                    estimator, PARAM_GRID, X[train], y[train], strategy=strategy,
+                    budget=params.get('search_budget', 20), factor=params.get('halving_factor', 3),
+                    cv=params.get('nr_inner_folds', 3), n_jobs=n_jobs)
             y_pred = classifier.predict(X[test])
             y_true = y[test]
             accuracy = accuracy_score(y_true, y_pred)
@@ -84,8 +129,8 @@ class SupportVectorMachineTraining(Pipeline):
             # Record time elapsed, accuracy and optimal hyper parameters
             time_elapsed = timing_elapsed_to_str(start)
             print('Classifier training fold time elapsed: {}'.format(time_elapsed))
-            print('Classifier accuracy: {} (C: {}, gamma: {})'.format(
-                accuracy, classifier.best_params_['C'], classifier.best_params_['gamma']))
+            print('Classifier accuracy: {} (C: {}, gamma: {}, {} fits)'.format(
+                accuracy, best_params['C'], best_params['gamma'], n_fits))
 
         finally:
             # Clean up task directory under any circumstances, even error
@@ -94,14 +139,91 @@ class SupportVectorMachineTraining(Pipeline):
 
         return {
             'accuracy': accuracy,
-            'C': classifier.best_params_['C'],
-            'gamma': classifier.best_params_['gamma'],
+            'C': best_params['C'],
+            'gamma': best_params['gamma'],
+            'search': strategy,
+            'n_fits': n_fits,
             'time_elapsed': time_elapsed,
         }
 
     @staticmethod
     @shared_task
-    def retrain_classifier(outputs, storage_id, params, token):
+    def run_grid_fold(storage_id, sha1, fold, train, params):
+
+        # Scores all grid points on the training subjects of a fold, using the same inner
+        # cross-validation as the grid search in run_training_fold()
+        task_dir = create_task_dir()
+        try:
+            file_path = download_file(storage_id, task_dir, get_access_token(), sha1=sha1)
+            X, y = load_xy(
+                file_path, sha1 or storage_id, params['index_column'], target_column=params['target_column'],
+                exclude_columns=params['exclude_columns'])
+            estimator, X = create_estimator(X, params)
+            with parallel_jobs():
+                scores = score_points(
+                    estimator, points(PARAM_GRID), X[train], y[train], cv=params.get('nr_inner_folds', 3),
+                    n_jobs=get_n_jobs(params.get('n_jobs', 0)))
+        finally:
+            delete_task_dir(task_dir)
+
+        return {
+            'fold': fold,
+            'scores': [float(score) for score in scores],
+        }
+
+    @staticmethod
+    @shared_task
+    def evaluate_grid_points(scores, storage_id, sha1, folds, params):
+
+        # Select the best grid point for each fold. Like GridSearchCV, the first grid point
+        # wins if several have the same score.
+        candidates = points(PARAM_GRID)
+        best = {}
+        for score in scores:
+            fold_scores = score['scores']
+            best[score['fold']] = candidates[fold_scores.index(max(fold_scores))]
+
+        task_dir = create_task_dir()
+        nr_inner_folds = params.get('nr_inner_folds', 3)
+
+        try:
+            file_path = download_file(storage_id, task_dir, get_access_token(), sha1=sha1)
+            X, y = load_xy(
+                file_path, sha1 or storage_id, params['index_column'], target_column=params['target_column'],
+                exclude_columns=params['exclude_columns'])
+            estimator, X = create_estimator(X, params)
+
+            # Train each fold's classifier with its best grid point and test it, like the
+            # refit done by GridSearchCV in run_training_fold()
+            outputs = []
+            for i in range(len(folds)):
+                start = timing_now()
+                train, test = folds[i]
+                classifier = clone(estimator).set_params(C=best[i]['C'], gamma=best[i]['gamma'])
+                classifier.fit(X[train], y[train])
+                accuracy = accuracy_score(y[test], classifier.predict(X[test]))
+                print('Classifier accuracy fold {}: {} (C: {}, gamma: {})'.format(
+                    i, accuracy, best[i]['C'], best[i]['gamma']))
+                outputs.append({
+                    'accuracy': accuracy,
+                    'C': best[i]['C'],
+                    'gamma': best[i]['gamma'],
+                    'search': 'grid',
+                    'n_fits': len(candidates) * nr_inner_folds + 1,
+                    'time_elapsed': timing_elapsed_to_str(start),
+                })
+
+        finally:
+            delete_task_dir(task_dir)
+
+        # Retrain the classifier on all subjects in this task, so the chord's result is the
+        # same as without grid search sub-tasks
+        print('Retraining classifier on all subjects')
+        return SupportVectorMachineTraining.retrain_classifier(outputs, storage_id, sha1, params)
+
+    @staticmethod
+    @shared_task
+    def retrain_classifier(outputs, storage_id, sha1, params):
 
         # Extract accuracies, C and gamma values from the outputs
         accuracies = []
@@ -116,6 +238,10 @@ class SupportVectorMachineTraining(Pipeline):
         accuracy = sum(accuracies) / params['nr_folds']
         print('Average accuracy: {}'.format(accuracy))
 
+        # Total number of fits of the hyper-parameter searches in all folds
+        n_fits = sum([output.get('n_fits', 0) for output in outputs])
+        print('Hyper-parameter search: {} ({} fits)'.format(params.get('search', 'grid'), n_fits))
+
         # Figure out which hyper-parameters to choose
         max_accuracy = 0.0
         max_C = 0.0
@@ -136,9 +262,10 @@ class SupportVectorMachineTraining(Pipeline):
 
         try:
             # Download the file and load its features
-            file_path = download_file(storage_id, task_dir, token)
-            features = load_features(file_path, index_col=params['index_column'])
-            X, y = get_xy(features, target_column=params['target_column'], exclude_columns=params['exclude_columns'])
+            file_path = download_file(storage_id, task_dir, get_access_token(), sha1=sha1)
+            X, y = load_xy(
+                file_path, sha1 or storage_id, params['index_column'], target_column=params['target_column'],
+                exclude_columns=params['exclude_columns'])
 
             # Train the classifier on all features with the optimal hyper-parameters
             classifier = SVC(kernel=kernel, C=max_C, gamma=max_gamma)
@@ -146,7 +273,7 @@ class SupportVectorMachineTraining(Pipeline):
 
             # Save the classifier to disk and then upload it to storage service as regular file
             classifier_file_path = save_model(classifier, task_dir)
-            classifier_id = upload_model_archive(classifier_file_path, params['repository_id'], token)
+            classifier_id = upload_model_archive(classifier_file_path, params['repository_id'], get_access_token())
 
         finally:
             # Delete temporary task directory even though errors may have occurred
@@ -157,6 +284,8 @@ class SupportVectorMachineTraining(Pipeline):
             'accuracy': accuracy,
             'C': max_C,
             'gamma': max_gamma,
+            'search': params.get('search', 'grid'),
+            'n_fits': n_fits,
             'classifier_id': classifier_id,
         }
 
@@ -176,3 +305,31 @@ class SupportVectorMachineTraining(Pipeline):
         assert params['nr_folds'] > 1
         assert 'kernel' in params.keys()
         assert params['kernel'] in ['linear', 'rbf']
+        if 'n_jobs' in params.keys():
+            assert params['n_jobs'] >= 0
+        if 'search' in params.keys():
+            assert params['search'] in STRATEGIES
+            # Grid search sub-tasks fit every grid point
+            assert params['search'] == 'grid' or not params.get('grid_subtasks', False)
+        if 'search_budget' in params.keys():
+            assert params['search_budget'] > 0
+        if 'halving_factor' in params.keys():
+            assert params['halving_factor'] > 1
+        if params.get('precompute_kernel', False):
+            assert params['kernel'] in KERNELS
+        if 'nr_inner_folds' in params.keys():
+            assert params['nr_inner_folds'] > 1
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def create_estimator(X, params):
+    # Returns the estimator for the searches and the features to fit it on. With 'precompute_kernel'
+    # the squared distances (rbf) or dot products (linear) between all subjects are computed
+    # once. The kernel for each grid point is derived from them and the estimator is fitted on
+    # row indices instead of features. The kernel parameter is converted from unicode to str,
+    # because for some reason SVC() does not support unicode parameters.
+    kernel = str(params['kernel'])
+    if params.get('precompute_kernel', False):
+        print('Precomputing {} kernel for {} subjects'.format(kernel, X.shape[0]))
+        return PrecomputedKernelSVC(KernelCache(X, kernel)), row_indices(X)
+    return SVC(kernel=kernel), X
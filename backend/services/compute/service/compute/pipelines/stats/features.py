@@ -0,0 +1,200 @@
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+from flask import Config
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def get_feature_store():
+    # One store per process. The converted files live on disk and are shared by all worker
+    # processes on this node.
+    config = Config(None)
+    config.from_object('service.compute.settings')
+    key = (os.getpid(), config['FEATURE_CACHE_DIR'])
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = FeatureStore(
+                config['FEATURE_CACHE_DIR'], config['FEATURE_CACHE_MAX_SIZE'], config['FEATURE_SHARED_MATRIX'],
+                config['FEATURE_CACHE_MIN_AGE'])
+        return _stores[key]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class FeatureStore(object):
+
+    # Converted CSV files are stored as a directory with one .npy file per column and a
+    # 'columns.json' listing the column names in the order of their files. Loading only
+    # reads the .npy files of the columns that are needed.
+    META_FILE = 'columns.json'
+
+    def __init__(self, cache_dir, max_size=10 * 1024 * 1024 * 1024, shared_matrix=True, min_age=300):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        # Conversions used less than min_age seconds ago are not evicted. Tasks may still be
+        # loading their columns.
+        self.min_age = min_age
+        # If enabled, the feature matrix for a set of predictors is written to an .npy file next
+        # to the columns, once per node. Tasks then share it read-only through memory mapping
+        # instead of each building their own copy.
+        self.shared_matrix = shared_matrix
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir, 0o700)
+            except OSError:
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    def load_xy(self, key, file_path, index_column, target_column=None, exclude_columns=list()):
+        # Returns the feature matrix and target values like get_xy() but from the converted CSV
+        # file, converting it first if needed. 'key' identifies the file's content, e.g., its
+        # SHA-1, so files with the same content are converted once. The index column is not
+        # a predictor.
+        store_dir = self.convert(key, file_path)
+        meta = self._load_meta(store_dir)
+        predictors = []
+        for column in meta['columns']:
+            if column not in exclude_columns and column not in (target_column, index_column):
+                predictors.append(column)
+        if len(predictors) == 0:
+            raise RuntimeError('No predictor columns left in {} (excluded {})'.format(file_path, exclude_columns))
+        if self.shared_matrix:
+            X = self._load_matrix(store_dir, meta, predictors)
+        else:
+            X = np.column_stack([self._load_column(store_dir, meta, column) for column in predictors])
+        y = None
+        if target_column:
+            y = np.array(self._load_column(store_dir, meta, target_column))
+        return X, y
+
+    def convert(self, key, file_path):
+        # Converts the CSV file unless another task on this node did so already. The result
+        # is written to a temporary directory and renamed, so it is never seen half-written.
+        store_dir = os.path.join(self.cache_dir, key)
+        if not os.path.isfile(os.path.join(store_dir, self.META_FILE)):
+            with self._lock(store_dir):
+                if not os.path.isfile(os.path.join(store_dir, self.META_FILE)):
+                    self._convert(store_dir, file_path)
+                    self.evict(keep=store_dir)
+        # The modification time of the directory records when it was last used
+        os.utime(store_dir, None)
+        return store_dir
+
+    def evict(self, keep=None):
+        # Removes least recently used conversions until the store fits in max_size bytes.
+        # Conversions that are being written (their lock is taken) are skipped.
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if not os.path.isfile(os.path.join(path, self.META_FILE)):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+            total += size
+        now = time.time()
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path == keep or now - mtime < self.min_age:
+                continue
+            with self._lock(path, blocking=False) as locked:
+                # Another task may have used or evicted the conversion since we listed it
+                if not locked or not os.path.isdir(path) or now - os.path.getmtime(path) < self.min_age:
+                    continue
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+    def _convert(self, store_dir, file_path):
+        # All columns are converted, including the index column, so the conversion does not
+        # depend on the parameters of a pipeline run
+        features = pd.read_csv(file_path, memory_map=True)
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir)
+        meta = {'columns': [], 'created_at': time.time()}
+        try:
+            for i, column in enumerate(features.columns):
+                np.save(os.path.join(tmp_dir, 'column-{}.npy'.format(i)), self._to_array(features[column]))
+                meta['columns'].append(column)
+            with open(os.path.join(tmp_dir, self.META_FILE), 'w') as f:
+                json.dump(meta, f)
+            os.rename(tmp_dir, store_dir)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+    def _load_matrix(self, store_dir, meta, predictors):
+        # Returns the read-only, memory-mapped matrix of the predictor columns, writing it first
+        # if no other task on this node did. Slicing it, e.g., X[train], only copies the rows
+        # that are selected. Each set of predictors adds a matrix to the store directory, so
+        # the store is evicted afterwards.
+        digest = hashlib.sha1(json.dumps(predictors)).hexdigest()
+        file_path = os.path.join(store_dir, 'X-{}.npy'.format(digest))
+        if not os.path.isfile(file_path):
+            with self._lock(store_dir):
+                if not os.path.isfile(os.path.join(store_dir, self.META_FILE)):
+                    raise RuntimeError('Features in {} were evicted while loading'.format(store_dir))
+                if not os.path.isfile(file_path):
+                    # The matrix is filled column by column through a memory map, so it is
+                    # never held in memory as a whole
+                    columns = [self._load_column(store_dir, meta, column) for column in predictors]
+                    dtype = np.result_type(*[column.dtype for column in columns])
+                    shape = (len(columns[0]), len(columns))
+                    tmp_path = file_path + '.tmp'
+                    X = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape)
+                    for j, column in enumerate(columns):
+                        X[:, j] = column
+                    X.flush()
+                    del X
+                    os.rename(tmp_path, file_path)
+                    os.utime(store_dir, None)
+                    self.evict(keep=store_dir)
+        return np.load(file_path, mmap_mode='r')
+
+    @contextmanager
+    def _lock(self, store_dir, blocking=True):
+        # Serializes writes to a store directory and its eviction by the tasks on this node.
+        # Yields whether the lock was taken, which is always the case if blocking.
+        with open(store_dir + '.lock', 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_meta(self, store_dir):
+        with open(os.path.join(store_dir, self.META_FILE), 'r') as f:
+            return json.load(f)
+
+    @staticmethod
+    def _load_column(store_dir, meta, column):
+        # Columns are memory-mapped, so only the pages actually used are read
+        if column not in meta['columns']:
+            raise RuntimeError('Column {} not found'.format(column))
+        file_name = 'column-{}.npy'.format(meta['columns'].index(column))
+        return np.load(os.path.join(store_dir, file_name), mmap_mode='r')
+
+    @staticmethod
+    def _to_array(values):
+        # Numeric columns keep their type. Other columns are stored as unicode strings, which
+        # (unlike Python objects) can be saved without pickling and memory-mapped.
+        values = np.asarray(values)
+        if values.dtype.kind == 'O':
+            values = values.astype(unicode)
+        return values
@@ -0,0 +1,83 @@
+import numpy as np
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.svm import SVC
+
+# Kernels that can be precomputed. Both are derived from the same cached matrix: the squared
+# distances for 'rbf' and the dot products for 'linear'.
+KERNELS = ['linear', 'rbf']
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class KernelCache(object):
+
+    def __init__(self, X, kernel='rbf', chunk_size=512):
+        # Computes the squared distances (rbf) or dot products (linear) between all rows of X
+        # once. They are computed in blocks of 'chunk_size' x 'chunk_size' rows, so memory use
+        # beyond the n x n result is bounded by a few chunks of X.
+        if kernel not in KERNELS:
+            raise RuntimeError('Kernel {} cannot be precomputed'.format(kernel))
+        self.kernel = kernel
+        # X may be the memory map shared by the tasks on this node (see features.py), so it is
+        # read and converted to float64 one chunk of rows at a time instead of copied as a whole
+        n = X.shape[0]
+        self.matrix = np.empty((n, n), dtype=np.float64)
+        norms = np.empty(n, dtype=np.float64)
+        for start in range(0, n, chunk_size):
+            rows = np.asarray(X[start:start + chunk_size], dtype=np.float64)
+            norms[start:start + len(rows)] = np.einsum('ij,ij->i', rows, rows)
+        for start in range(0, n, chunk_size):
+            stop = min(start + chunk_size, n)
+            rows = np.asarray(X[start:stop], dtype=np.float64)
+            block = self.matrix[start:stop]
+            for other in range(0, n, chunk_size):
+                block[:, other:other + chunk_size] = np.dot(
+                    rows, np.asarray(X[other:other + chunk_size], dtype=np.float64).T)
+            if kernel == 'rbf':
+                # |a - b|^2 = |a|^2 - 2 a.b + |b|^2, clipped at zero to undo rounding errors
+                block *= -2.0
+                block += norms[start:stop, np.newaxis]
+                block += norms[np.newaxis, :]
+                np.maximum(block, 0.0, out=block)
+
+    def get(self, rows, columns, gamma=None):
+        # Returns the kernel between the given rows and columns of X. For rbf this takes one
+        # exp() per element instead of a distance computation over all features.
+        matrix = self.matrix[np.ix_(rows, columns)]
+        if self.kernel == 'rbf':
+            matrix *= -gamma
+            np.exp(matrix, out=matrix)
+        return matrix
+
+    def __deepcopy__(self, memo):
+        # Estimators are cloned for each fit in a search, which deep-copies their parameters.
+        # The cache is read-only, so all clones share it.
+        return self
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class PrecomputedKernelSVC(BaseEstimator, ClassifierMixin):
+
+    # SVC on a precomputed kernel. Instead of features, X holds a single column with the
+    # indices of the rows in the kernel cache, so the searches and cross-validation in
+    # scikit-learn select subjects as usual.
+    def __init__(self, kernels=None, C=1.0, gamma=1.0):
+        self.kernels = kernels
+        self.C = C
+        self.gamma = gamma
+
+    def fit(self, X, y):
+        self.rows_ = np.asarray(X)[:, 0].astype(int)
+        self.svc_ = SVC(kernel='precomputed', C=self.C)
+        self.svc_.fit(self.kernels.get(self.rows_, self.rows_, self.gamma), y)
+        self.classes_ = self.svc_.classes_
+        return self
+
+    def predict(self, X):
+        rows = np.asarray(X)[:, 0].astype(int)
+        return self.svc_.predict(self.kernels.get(rows, self.rows_, self.gamma))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def row_indices(X):
+    # Returns the input for PrecomputedKernelSVC that refers to all rows of X
+    return np.arange(X.shape[0]).reshape(-1, 1)
@@ -0,0 +1,87 @@
+import itertools
+import math
+import numpy as np
+from sklearn.base import clone
+from sklearn.cross_validation import StratifiedShuffleSplit, cross_val_score
+from sklearn.externals.joblib import Parallel, delayed
+from sklearn.grid_search import GridSearchCV, RandomizedSearchCV
+
+# Hyper-parameter search strategies: 'grid' fits every point, 'random' a random subset of the
+# points and 'halving' every point on a small subsample, keeping the best 1 / factor of the
+# points for the next round on a factor times larger subsample
+STRATEGIES = ['grid', 'random', 'halving']
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def search(estimator, param_grid, X, y, strategy='grid', budget=20, factor=3, cv=3, n_jobs=1):
+    # Searches the points in 'param_grid' (a dictionary of parameter values) for the one with
+    # the highest accuracy in 'cv'-fold cross-validation. Returns the estimator refitted on
+    # all of X and y with the best parameters, the best parameters and the number of fits.
+    if strategy == 'grid':
+        classifier = GridSearchCV(estimator, param_grid=param_grid, scoring='accuracy', cv=cv, n_jobs=n_jobs)
+        classifier.fit(X, y)
+        return classifier.best_estimator_, classifier.best_params_, len(points(param_grid)) * cv + 1
+    if strategy == 'random':
+        # Points are sampled without replacement, so the budget cannot exceed the grid
+        n_iter = min(budget, len(points(param_grid)))
+        classifier = RandomizedSearchCV(
+            estimator, param_distributions=param_grid, n_iter=n_iter, scoring='accuracy', cv=cv, n_jobs=n_jobs)
+        classifier.fit(X, y)
+        return classifier.best_estimator_, classifier.best_params_, n_iter * cv + 1
+    if strategy == 'halving':
+        best_params, n_fits = successive_halving(estimator, param_grid, X, y, factor, cv, n_jobs)
+        classifier = clone(estimator).set_params(**best_params)
+        classifier.fit(X, y)
+        return classifier, best_params, n_fits + 1
+    raise RuntimeError('Unknown search strategy {}'.format(strategy))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def successive_halving(estimator, param_grid, X, y, factor=3, cv=3, n_jobs=1):
+    # The number of rounds is chosen such that a single point is left in the last round, which
+    # uses all samples. Each earlier round uses 1 / factor of the samples of the next. Rounds
+    # never use fewer samples than needed for 'cv' stratified folds of each class.
+    candidates = points(param_grid)
+    n_rounds = max(1, int(math.ceil(math.log(len(candidates), factor))))
+    min_samples = 2 * cv * len(np.unique(y))
+    n_fits = 0
+    for i in range(n_rounds):
+        n_samples = max(min_samples, len(y) // factor ** (n_rounds - 1 - i))
+        rows = subsample(y, n_samples)
+        scores = score_points(estimator, candidates, X[rows], y[rows], cv, n_jobs)
+        n_fits += len(candidates) * cv
+        if len(candidates) == 1:
+            break
+        # Sorting is stable, so of points with the same score the first in the grid is kept
+        order = sorted(range(len(candidates)), key=lambda j: -scores[j])
+        nr_kept = int(math.ceil(len(candidates) / float(factor)))
+        candidates = [candidates[j] for j in sorted(order[:nr_kept])]
+    return candidates[0], n_fits
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def score_points(estimator, candidates, X, y, cv=3, n_jobs=1):
+    # Returns the mean accuracy in 'cv'-fold cross-validation of each point in 'candidates'
+    return Parallel(n_jobs=n_jobs)(delayed(_score)(estimator, params, X, y, cv) for params in candidates)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def points(param_grid):
+    # Returns the points of 'param_grid' in the order GridSearchCV visits them
+    keys = sorted(param_grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*[param_grid[key] for key in keys])]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def subsample(y, n_samples):
+    # Returns the row indices of a stratified random subsample of 'n_samples' rows. The rows
+    # left out must include each class, otherwise all rows are returned.
+    if n_samples > len(y) - len(np.unique(y)):
+        return np.arange(len(y))
+    for rows, _ in StratifiedShuffleSplit(y, n_iter=1, train_size=n_samples, test_size=None):
+        return np.sort(rows)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _score(estimator, params, X, y, cv):
+    return cross_val_score(clone(estimator).set_params(**params), X, y, scoring='accuracy', cv=cv).mean()
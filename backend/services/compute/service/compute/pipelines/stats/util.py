@@ -1,15 +1,23 @@
+import multiprocessing
 import os
 import tarfile
+from contextlib import contextmanager
+import billiard
 import pandas as pd
-import requests
+from flask import Config
+import lib.client as client
 from sklearn.externals import joblib
 from lib.authentication import token_header
-from lib.util import uri, generate_string
+from lib.util import generate_string
 from lib.files import upload_file
+from service.compute.pipelines.stats.features import get_feature_store
 
 
 # ----------------------------------------------------------------------------------------------------------------------
 def load_features(file_path, **kwargs):
+    # Memory-map the file so large inputs, e.g., linked from the shared files volume, are
+    # parsed in place instead of being read into a buffer first
+    kwargs.setdefault('memory_map', True)
     features = pd.read_csv(file_path, **kwargs)
     return features
 
@@ -23,6 +31,14 @@ def load_features_for(file_path, target_column, values, **kwargs):
     return pd.concat(tmp)
 
 
+# ----------------------------------------------------------------------------------------------------------------------
+def load_xy(file_path, key, index_column, target_column=None, exclude_columns=list()):
+    # Like load_features() followed by get_xy() but the CSV file is converted to a columnar
+    # format once per node (see features.py) and excluded columns are never read. The key
+    # identifies the file's content, preferably its SHA-1.
+    return get_feature_store().load_xy(key, file_path, index_column, target_column, exclude_columns)
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 def get_xy(features, target_column=None, exclude_columns=list()):
     predictors = list(features.columns)
@@ -43,6 +59,34 @@ def get_xy(features, target_column=None, exclude_columns=list()):
     return X, y
 
 
+# ----------------------------------------------------------------------------------------------------------------------
+def get_n_jobs(n_jobs=0):
+    # Number of parallel jobs for a search inside a task. Zero means the cores reserved by this
+    # worker process, i.e., the node's cores divided over the worker processes on that node.
+    if n_jobs > 0:
+        return n_jobs
+    config = Config(None)
+    config.from_object('service.compute.settings')
+    if config['PIPELINE_N_JOBS'] > 0:
+        return config['PIPELINE_N_JOBS']
+    return max(1, multiprocessing.cpu_count() // max(1, config['CELERYD_CONCURRENCY']))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+@contextmanager
+def parallel_jobs():
+    # Celery's prefork pool runs tasks in daemonic processes, which are not allowed to start a
+    # process pool of their own. Inside a worker, joblib therefore runs its jobs in threads.
+    # LIBSVM releases the GIL while fitting, so these still keep the reserved cores busy.
+    backend = getattr(joblib, 'parallel_backend', None)
+    if backend is None:
+        yield
+        return
+    daemon = billiard.current_process().daemon or multiprocessing.current_process().daemon
+    with backend('threading' if daemon else 'multiprocessing'):
+        yield
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 def save_model(model, target_dir):
     file_name = 'model-{}'.format(generate_string(8))
@@ -82,9 +126,9 @@ def load_model(file_path):
 
 # ----------------------------------------------------------------------------------------------------------------------
 def upload_model_archive(file_path, repository_id, token):
-    response = requests.get(uri('storage', '/file-types?name=binary'), headers=token_header(token))
+    response = client.get('storage', '/file-types', params={'name': 'binary'}, headers=token_header(token))
     file_type_id = response.json()[0]['id']
-    response = requests.get(uri('storage', '/scan-types?name=none'), headers=token_header(token))
+    response = client.get('storage', '/scan-types', params={'name': 'none'}, headers=token_header(token))
     scan_type_id = response.json()[0]['id']
     try:
         _, storage_id = upload_file(file_path, file_type_id, scan_type_id, repository_id, token)
@@ -1,9 +1,10 @@
 import os
 import shutil
-import requests
+import lib.client as client
 from flask import Config
-from lib.authentication import login_header, token_header
-from lib.util import uri, generate_string
+from lib.authentication import token_header
+from lib.tokens import get_token_manager
+from lib.util import generate_string
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -15,16 +16,27 @@ def get_worker_username_and_password():
 
 # ----------------------------------------------------------------------------------------------------------------------
 def get_access_token():
+    # The worker token is shared by all worker processes on this node and refreshed before
+    # it expires, so pipeline runs do not each log in with a password.
+    config = Config(None)
+    config.from_object('service.compute.settings')
     username, password = get_worker_username_and_password()
-    response = requests.post(uri('auth', '/tokens'), headers=login_header(username, password))
-    return response.json()['token']
+    manager = get_token_manager(
+        username, password, config['SERVICE_TOKEN_DIR'],
+        config['SERVICE_TOKEN_REFRESH_MARGIN'], config['SERVICE_TOKEN_LIFETIME'])
+    return manager.get_token()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def get_file(repository_id, file_id, token):
+    response = client.get(
+        'storage', '/repositories/{}/files/{}'.format(repository_id, file_id), headers=token_header(token))
+    return response.json()
 
 
 # ----------------------------------------------------------------------------------------------------------------------
 def get_storage_id_for_file(repository_id, file_id, token):
-    response = requests.get(
-        uri('storage', '/repositories/{}/files/{}'.format(repository_id, file_id)), headers=token_header(token))
-    storage_id = response.json()['storage_id']
+    storage_id = get_file(repository_id, file_id, token)['storage_id']
     return storage_id
 
 
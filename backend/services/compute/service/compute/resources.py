@@ -15,7 +15,7 @@ class RootResource(BaseResource):
     def get(self):
         return self.response({
             'service': 'compute',
-            'endpoints': ['tasks', 'pipelines'],
+            'endpoints': ['tasks', 'pipelines', 'token-cache'],
         })
 
 
@@ -1,5 +1,6 @@
 import os
 import logging
+import multiprocessing
 
 # ------------------------------------------------------------------------------------------------------------------
 # Development settings for environment variables
@@ -56,6 +57,10 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND')
 CELERY_CHORD_PROPAGATES = True
 
+# Number of worker processes per node. Each process reserves the node's cores divided by this
+# number for the parallel parts of a task, e.g., a grid search inside a cross-validation fold.
+CELERYD_CONCURRENCY = int(os.getenv('CELERYD_CONCURRENCY', str(multiprocessing.cpu_count())))
+
 # ------------------------------------------------------------------------------------------------------------------
 # Pipelines
 # ------------------------------------------------------------------------------------------------------------------
@@ -75,11 +80,20 @@ PIPELINES = {
             'excluded_columns': {'type': 'str_list', 'default': []},
             'kernel': {'type': 'str', 'allowed_values': ['linear', 'rbf', 'poly'], 'default': 'rbf'},
             'repository_id': {'type': 'int', 'min_value': 1},
+            'n_jobs': {'type': 'int', 'min_value': 0, 'default': 0},
+            'grid_subtasks': {'type': 'bool', 'default': False},
+            'search': {'type': 'str', 'allowed_values': ['grid', 'random', 'halving'], 'default': 'grid'},
+            'search_budget': {'type': 'int', 'min_value': 1, 'default': 20},
+            'halving_factor': {'type': 'int', 'min_value': 2, 'default': 3},
+            'precompute_kernel': {'type': 'bool', 'default': False},
+            'nr_inner_folds': {'type': 'int', 'min_value': 2, 'default': 3},
         },
         'outputs': {
             'accuracy': {'type': 'int'},
             'C': {'type': 'float'},
             'gamma': {'type': 'float'},
+            'search': {'type': 'str'},
+            'n_fits': {'type': 'int'},
             'classifier_id': {'type': 'str'},
         },
     },
@@ -93,6 +107,23 @@ PIPELINES = {
     },
 }
 
+# CSV feature files are converted once per node to a columnar format (one .npy file per column)
+# in FEATURE_CACHE_DIR, keyed by the file's SHA-1. Least recently used conversions are removed
+# when the directory grows beyond FEATURE_CACHE_MAX_SIZE bytes, except those used less than
+# FEATURE_CACHE_MIN_AGE seconds ago.
+FEATURE_CACHE_DIR = os.getenv('FEATURE_CACHE_DIR', '/tmp/yoda/features')
+FEATURE_CACHE_MAX_SIZE = int(os.getenv('FEATURE_CACHE_MAX_SIZE', str(10 * 1024 * 1024 * 1024)))
+FEATURE_CACHE_MIN_AGE = int(os.getenv('FEATURE_CACHE_MIN_AGE', '300'))
+
+# If enabled, the feature matrix X is written to the feature cache once per node as well and
+# the training tasks on that node share it through a read-only memory map instead of each
+# building a copy in memory
+FEATURE_SHARED_MATRIX = os.getenv('FEATURE_SHARED_MATRIX', 'true').lower() == 'true'
+
+# Number of parallel jobs for the hyper-parameter search inside a task, unless a pipeline run
+# specifies 'n_jobs'. Zero means the cores reserved by the worker process (see above).
+PIPELINE_N_JOBS = int(os.getenv('PIPELINE_N_JOBS', '0'))
+
 # ------------------------------------------------------------------------------------------------------------------
 # Security settings
 # ------------------------------------------------------------------------------------------------------------------
@@ -101,3 +132,36 @@ SERVICE_USERNAME = 'compute'
 SERVICE_PASSWORD = 'secret'
 SERVICE_WORKER_USERNAME = 'worker'
 SERVICE_WORKER_PASSWORD = 'secret'
+
+# The service's own token is shared by all worker processes on a host through a file in
+# SERVICE_TOKEN_DIR. It is refreshed in the background SERVICE_TOKEN_REFRESH_MARGIN seconds
+# before it expires, or after SERVICE_TOKEN_LIFETIME seconds if the token has no expiry.
+SERVICE_TOKEN_DIR = os.getenv('SERVICE_TOKEN_DIR', '/tmp/yoda/tokens')
+SERVICE_TOKEN_REFRESH_MARGIN = 300
+SERVICE_TOKEN_LIFETIME = 3600
+
+# Client tokens are either verified by the auth service ('remote', one /token-checks call per
+# request) or in-process ('local'). Local verification checks signature and expiry with
+# TOKEN_VERIFICATION_KEY (the auth service's SECRET_KEY for HS256, its public key for RS256)
+# and rejects deactivated users using the revocation list polled from the auth service.
+TOKEN_VERIFICATION = os.getenv('TOKEN_VERIFICATION', 'remote')
+TOKEN_ALGORITHM = os.getenv('TOKEN_ALGORITHM', 'HS256')
+TOKEN_VERIFICATION_KEY = os.getenv('TOKEN_VERIFICATION_KEY')
+TOKEN_REVOCATIONS_POLL_INTERVAL = 30
+
+# Verified client tokens are cached per token hash so that repeated requests with the same
+# token skip verification. Backend is 'local' (per worker process, LRU bounded by
+# TOKEN_CACHE_MAX_SIZE), 'redis' (shared by all workers) or 'none'. Rejected tokens are
+# cached for TOKEN_CACHE_NEGATIVE_TTL seconds only.
+TOKEN_CACHE_BACKEND = os.getenv('TOKEN_CACHE_BACKEND', 'local')
+TOKEN_CACHE_URL = os.getenv('TOKEN_CACHE_URL', 'redis://redis:6379/1')
+TOKEN_CACHE_MAX_SIZE = 10000
+TOKEN_CACHE_TTL = 60
+TOKEN_CACHE_NEGATIVE_TTL = 5
+
+# Invalidations of cached tokens are only accepted from administrators and the auth service
+# (AUTH_SERVICE_USERNAME). With the 'local' backend they are broadcast to all processes through
+# the Redis at TOKEN_CACHE_INVALIDATIONS_URL. Processes not subscribed to it (e.g., because Redis
+# is down) bypass their cache. An empty URL only invalidates the process receiving the request.
+AUTH_SERVICE_USERNAME = 'auth'
+TOKEN_CACHE_INVALIDATIONS_URL = os.getenv('TOKEN_CACHE_INVALIDATIONS_URL', TOKEN_CACHE_URL)
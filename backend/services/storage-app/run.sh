@@ -1,4 +1,4 @@
 #!/usr/bin/env bash
 
 export PYTHONPATH=/var/www/backend:${PYTHONPATH}
-uwsgi --http-socket 0.0.0.0:5003 --master --workers 1 --module service.storage.app:app --vacuum --die-on-term
\ No newline at end of file
+uwsgi --http-socket 0.0.0.0:5003 --master --enable-threads --workers 1 --module service.storage.app:app --vacuum --die-on-term
\ No newline at end of file
@@ -7,13 +7,18 @@ from flask_sqlalchemy import SQLAlchemy
 from werkzeug.contrib.cache import SimpleCache
 
 from dao import FileTypeDao, ScanTypeDao, RepositoryDao
+from service.storage.collector import start_garbage_collector
 from models import FileType, ScanType
+from lib.cache import create_token_cache
 from lib.models import Base
+from lib.queries import enable_query_counter
+from lib.resources import TokenCacheResource, TokenCacheInvalidationsResource
 from resources import (
     RootResource, FileTypesResource, ScanTypesResource,
     RepositoriesResource, RepositoryResource, RepositoryFileResource, RepositoryFilesResource,
-    RepositoryFileSetsResource, RepositoryFileSetResource, RepositoryFileSetFilesResource,
-    RepositoryFileSetFileResource, UploadsResource, DownloadsResource)
+    RepositoryFilesBatchResource, RepositoryFileSetsResource, RepositoryFileSetArchivesResource,
+    RepositoryFileSetResource, RepositoryFileSetFilesResource, RepositoryFileSetFileResource,
+    UploadsResource, UploadChecksResource, DownloadsResource)
 
 app = Flask(__name__)
 
@@ -29,20 +34,30 @@ api.add_resource(ScanTypesResource, ScanTypesResource.URI)
 api.add_resource(RepositoriesResource, RepositoriesResource.URI)
 api.add_resource(RepositoryResource, RepositoryResource.URI.format('<int:id>'))
 api.add_resource(RepositoryFilesResource, RepositoryFilesResource.URI.format('<int:id>'))
+api.add_resource(RepositoryFilesBatchResource, RepositoryFilesBatchResource.URI.format('<int:id>'))
 api.add_resource(RepositoryFileResource, RepositoryFileResource.URI.format('<int:id>', '<int:file_id>'))
 api.add_resource(RepositoryFileSetsResource, RepositoryFileSetsResource.URI.format('<int:id>'))
+api.add_resource(RepositoryFileSetArchivesResource, RepositoryFileSetArchivesResource.URI.format('<int:id>'))
 api.add_resource(RepositoryFileSetResource, RepositoryFileSetResource.URI.format('<int:id>', '<int:file_set_id>'))
 api.add_resource(RepositoryFileSetFilesResource,
                  RepositoryFileSetFilesResource.URI.format('<int:id>', '<int:file_set_id>', '<int:file_id>'))
 api.add_resource(RepositoryFileSetFileResource,
                  RepositoryFileSetFileResource.URI.format('<int:id>', '<int:file_set_id>', '<int:file_id>'))
 api.add_resource(UploadsResource, UploadsResource.URI)
+api.add_resource(UploadChecksResource, UploadChecksResource.URI)
 api.add_resource(DownloadsResource, DownloadsResource.URI)
+api.add_resource(TokenCacheResource, TokenCacheResource.URI)
+api.add_resource(TokenCacheInvalidationsResource, TokenCacheInvalidationsResource.URI)
 
 db = SQLAlchemy(app)
 
+if app.config.get('QUERY_COUNTER_ENABLED', False):
+    enable_query_counter(app)
+
 cache = SimpleCache()
 
+token_cache = create_token_cache(app.config)
+
 
 # ----------------------------------------------------------------------------------------------------------------------
 def init_tables():
@@ -81,6 +96,8 @@ def init_db(drop=False):
         Base.metadata.drop_all(db.engine)
     Base.metadata.create_all(bind=db.engine)
     init_tables()
+    if app.config.get('GC_ENABLED', False):
+        start_garbage_collector(app, db)
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -89,6 +106,7 @@ def before_request():
     g.config = app.config
     g.db_session = db.session
     g.cache = cache
+    g.token_cache = token_cache
 
 
 # ----------------------------------------------------------------------------------------------------------------------
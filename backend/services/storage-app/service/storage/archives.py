@@ -0,0 +1,50 @@
+import os
+import tarfile
+import zipfile
+from blobs import store_content, remove_content
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def extract_archive(file_obj, is_zip, max_files):
+    # Writes the regular files in a tar (optionally compressed) or zip archive to the files
+    # volume, one at a time and in chunks, so memory use does not depend on the size of the
+    # archive or its files. Tar archives are read as a stream, zip archives must be seekable.
+    # Returns the entries (name, storage ID, storage path, size and SHA-1) and an error message.
+    entries = []
+    try:
+        for name, member in _members(file_obj, is_zip):
+            if len(entries) == max_files:
+                raise RuntimeError('More than {} files'.format(max_files))
+            storage_id, storage_path, size, sha1 = store_content(member)
+            entries.append({
+                'name': name, 'storage_id': storage_id, 'storage_path': storage_path, 'size': size, 'sha1': sha1})
+    except (RuntimeError, IOError, EOFError, tarfile.TarError, zipfile.BadZipfile) as e:
+        for entry in entries:
+            remove_content(entry['storage_id'])
+        return None, 'Could not extract archive ({})'.format(e)
+    return entries, None
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _members(file_obj, is_zip):
+    # Yields the name (without path) and a file object for each regular file in the archive.
+    # Directories, links and metadata added by archivers (e.g., '__MACOSX/') are skipped.
+    if is_zip:
+        archive = zipfile.ZipFile(file_obj)
+        for info in archive.infolist():
+            if not info.filename.endswith('/') and not _skip(info.filename):
+                member = archive.open(info)
+                yield os.path.basename(info.filename), member
+                member.close()
+        archive.close()
+    else:
+        archive = tarfile.open(fileobj=file_obj, mode='r|*')
+        for info in archive:
+            if info.isfile() and not _skip(info.name):
+                yield os.path.basename(info.name), archive.extractfile(info)
+        archive.close()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _skip(path):
+    return '__MACOSX/' in path or os.path.basename(path).startswith('.')
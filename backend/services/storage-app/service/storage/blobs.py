@@ -0,0 +1,232 @@
+import hashlib
+import os
+import logging
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+from dao import FileDao, BlobDao
+from models import Blob, File, FileSet, FileSetFiles
+from lib.models import BaseModel
+from lib.util import generate_id
+
+LOG = logging.getLogger(__name__)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def content_path(storage_id):
+    # See RepositoryFileResource.delete() for why we use STORAGE_ROOT_DIR here
+    return os.path.join(os.getenv('STORAGE_ROOT_DIR'), storage_id)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def remove_content(storage_id):
+    # Removes the file's content and the SHA-1 context nginx-big-upload left next to it
+    path = content_path(storage_id)
+    for p in [path, path + '.shactx']:
+        try:
+            os.remove(p)
+        except (IOError, OSError) as e:
+            LOG.error('Could not remove {} ({})'.format(p, e))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def reference_blob(db_session, sha1, size, storage_id, storage_path):
+    # Returns the blob with the given content, creating it if it does not exist, and whether
+    # it existed already. The blob's reference count is incremented but not committed. The
+    # blob stays locked until the caller commits.
+    blob_dao = BlobDao(db_session)
+    blob = blob_dao.retrieve_for_update(sha1)
+    if blob is not None:
+        blob.ref_count += 1
+        db_session.add(blob)
+        return blob, True
+    blob = Blob(sha1=sha1, size=size, storage_id=storage_id, storage_path=storage_path, ref_count=1)
+    db_session.add(blob)
+    return blob, False
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def release_blob(db_session, sha1):
+    # Decrements the blob's reference count and deletes the blob if no files refer to it
+    # anymore. Nothing is committed. Returns the storage ID of the content that should be
+    # removed after committing, if any.
+    blob_dao = BlobDao(db_session)
+    blob = blob_dao.retrieve_for_update(sha1)
+    if blob is None:
+        return None
+    blob.ref_count -= 1
+    if blob.ref_count > 0:
+        db_session.add(blob)
+        return None
+    db_session.delete(blob)
+    return blob.storage_id
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def create_file(db_session, download_uri, storage_id, storage_path, size, sha1, **kwargs):
+    # Creates a file for uploaded content. If we already have a blob with the same content
+    # the file refers to that blob and the uploaded copy is removed.
+    if sha1 is None:
+        return FileDao(db_session).create(
+            size=size, storage_id=storage_id, storage_path=storage_path,
+            media_link='{}/{}'.format(download_uri, storage_id), **kwargs)
+    for i in range(2):
+        blob, exists = reference_blob(db_session, sha1, size, storage_id, storage_path)
+        try:
+            f = FileDao(db_session).create(
+                size=size, sha1=sha1, storage_id=blob.storage_id, storage_path=blob.storage_path,
+                media_link='{}/{}'.format(download_uri, blob.storage_id), **kwargs)
+        except IntegrityError:
+            # Another upload of the same content created the blob first, so try again
+            # using that one
+            db_session.rollback()
+            continue
+        if exists and blob.storage_id != storage_id:
+            remove_content(storage_id)
+        return f
+    raise RuntimeError('Could not create blob for content {}'.format(sha1))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def find_blob(db_session, sha1, size):
+    blob = BlobDao(db_session).retrieve(sha1=sha1)
+    if blob is None or blob.size != size:
+        return None
+    return blob
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def register_file(db_session, download_uri, sha1, size, **kwargs):
+    # Creates a file for content we already have without uploading it again. Returns None if
+    # there is no blob with the given digest and size.
+    blob = BlobDao(db_session).retrieve_for_update(sha1)
+    if blob is None or blob.size != size:
+        db_session.rollback()
+        return None
+    blob.ref_count += 1
+    db_session.add(blob)
+    return FileDao(db_session).create(
+        size=size, sha1=sha1, storage_id=blob.storage_id, storage_path=blob.storage_path,
+        media_link='{}/{}'.format(download_uri, blob.storage_id), **kwargs)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def store_content(file_obj, chunk_size=1024 * 1024):
+    # Writes content that did not arrive through nginx-big-upload, e.g., a part of a batch
+    # upload, to STORAGE_ROOT_DIR. Returns its storage ID, storage path, size and SHA-1.
+    storage_id = generate_id(32)
+    storage_path = content_path(storage_id)
+    digest = hashlib.sha1()
+    size = 0
+    with open(storage_path, 'wb') as f:
+        for chunk in iter(lambda: file_obj.read(chunk_size), b''):
+            f.write(chunk)
+            digest.update(chunk)
+            size += len(chunk)
+    return storage_id, storage_path, size, digest.hexdigest()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def create_files(db_session, download_uri, entries, file_set_name=None, user_id=None):
+    # Creates the files for a batch of entries in a single transaction. Each entry holds the
+    # file's 'name', 'content_type', 'file_type_id', 'scan_type_id', 'repository_id', 'size'
+    # and 'sha1'. Entries with a 'storage_id' and 'storage_path' refer to uploaded content,
+    # the others to content we already have. All blobs are locked with one query and the
+    # new blobs and files are inserted with one multi-row statement per table. If
+    # 'file_set_name' is given, a file set with the new files is created as well. Returns
+    # the new file IDs, the file set ID (if any) and an error message.
+    for i in range(2):
+        blobs = BlobDao(db_session).retrieve_all_for_update([e['sha1'] for e in entries])
+        missing = []
+        for e in entries:
+            blob = blobs.get(e['sha1'])
+            if e.get('storage_id') is None and (blob is None or blob.size != e['size']):
+                missing.append(e['sha1'])
+        if len(missing) > 0:
+            db_session.rollback()
+            return None, None, 'Content not found ({})'.format(', '.join(missing))
+        # Existing blobs are updated through the session, new blobs are collected as rows
+        new_blobs = {}
+        duplicates = []
+        for e in entries:
+            blob = blobs.get(e['sha1'])
+            if blob is not None:
+                if e.get('storage_id') is not None and e['storage_id'] != blob.storage_id:
+                    duplicates.append(e['storage_id'])
+                blob.ref_count += 1
+            elif e['sha1'] in new_blobs:
+                duplicates.append(e['storage_id'])
+                new_blobs[e['sha1']]['ref_count'] += 1
+            else:
+                new_blobs[e['sha1']] = {
+                    'sha1': e['sha1'], 'size': e['size'], 'storage_id': e['storage_id'],
+                    'storage_path': e['storage_path'], 'ref_count': 1}
+        try:
+            ids = allocate_ids(db_session, len(new_blobs) + len(entries) + (1 if file_set_name is not None else 0))
+            blob_rows = new_blobs.values()
+            for row, id in zip(blob_rows, ids):
+                row['id'] = id
+            insert_rows(db_session, Blob, blob_rows, user_id)
+            file_rows = []
+            for e, id in zip(entries, ids[len(blob_rows):]):
+                blob = blobs.get(e['sha1']) or new_blobs[e['sha1']]
+                storage_id = blob.storage_id if isinstance(blob, Blob) else blob['storage_id']
+                storage_path = blob.storage_path if isinstance(blob, Blob) else blob['storage_path']
+                file_rows.append({
+                    'id': id, 'name': e['name'], 'content_type': e['content_type'], 'file_type_id': e['file_type_id'],
+                    'scan_type_id': e['scan_type_id'], 'repository_id': e['repository_id'], 'size': e['size'],
+                    'sha1': e['sha1'], 'storage_id': storage_id, 'storage_path': storage_path,
+                    'media_link': '{}/{}'.format(download_uri, storage_id), 'status': File.ACTIVE})
+            insert_rows(db_session, File, file_rows, user_id)
+            file_set_id = None
+            if file_set_name is not None:
+                file_set_row = {'id': ids[-1], 'name': file_set_name, 'repository_id': entries[0]['repository_id']}
+                insert_rows(db_session, FileSet, [file_set_row], user_id)
+                file_set_id = file_set_row['id']
+                db_session.execute(
+                    FileSetFiles.insert(), [{'file_set_id': file_set_id, 'file_id': row['id']} for row in file_rows])
+            db_session.commit()
+        except IntegrityError:
+            # Another upload created one of the new blobs first, so try again using that one
+            db_session.rollback()
+            continue
+        for storage_id in duplicates:
+            remove_content(storage_id)
+        return [row['id'] for row in file_rows], file_set_id, None
+    return None, None, 'Could not create blobs for batch'
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def allocate_ids(db_session, n):
+    # Takes 'n' IDs from the sequence of the base table in one query, so the rows of a batch
+    # can be inserted without returning their generated keys one row at a time. Other databases
+    # than Postgres (e.g., the SQLite fallback in settings.py) have no sequence, so no IDs are
+    # allocated and insert_rows() inserts the rows one at a time instead.
+    if n == 0 or db_session.get_bind().dialect.name != 'postgresql':
+        return [None] * n
+    sequence = '{}_id_seq'.format(BaseModel.__tablename__)
+    query = select([func.nextval(sequence)]).select_from(func.generate_series(1, n))
+    return [row[0] for row in db_session.execute(query)]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def insert_rows(db_session, model, rows, user_id=None):
+    # Inserts rows of a joined-table inheritance model using one executemany statement for
+    # the base table and one for the model's own table. Rows without an ID (see allocate_ids())
+    # get one from a separate insert into the base table. The timestamps are set by their
+    # column defaults.
+    if len(rows) == 0:
+        return
+    identity = model.__mapper__.polymorphic_identity
+
+    def base_row(row):
+        return {'id': row.get('id'), 'created_by': user_id, 'updated_by': user_id, 'model_type': identity}
+
+    allocated = [base_row(row) for row in rows if row.get('id') is not None]
+    if len(allocated) > 0:
+        db_session.execute(BaseModel.__table__.insert(), allocated)
+    for row in rows:
+        if row.get('id') is None:
+            values = base_row(row)
+            del values['id']
+            row['id'] = db_session.execute(BaseModel.__table__.insert(), values).inserted_primary_key[0]
+    db_session.execute(model.__table__.insert(), rows)
@@ -0,0 +1,207 @@
+import argparse
+import logging
+import os
+import threading
+import time
+from sqlalchemy.sql import func
+from service.storage.blobs import release_blob, remove_content
+from service.storage.models import Blob, File, FileSet, FileSetFiles, FileQualityCheck, Repository
+
+LOG = logging.getLogger(__name__)
+
+_collectors = {}
+_collectors_lock = threading.Lock()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def delete_file(db_session, f):
+    # Turns the file into a tombstone. It disappears from its repository and file sets right
+    # away. Its content is released later by the garbage collector.
+    db_session.execute(FileSetFiles.delete().where(FileSetFiles.c.file_id == f.id))
+    f.status = File.DELETED
+    f.deleted_at = func.now()
+    db_session.add(f)
+    db_session.commit()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def delete_repository(db_session, repository):
+    # Deletes the repository's file sets and marks the repository as deleted. Its files are
+    # deleted by the garbage collector, after which the repository itself is removed. The
+    # repository is renamed so its name can be used again right away.
+    file_set_ids = [row[0] for row in db_session.query(FileSet.id).filter(FileSet.repository_id == repository.id)]
+    if len(file_set_ids) > 0:
+        db_session.execute(FileSetFiles.delete().where(FileSetFiles.c.file_set_id.in_(file_set_ids)))
+        for file_set in db_session.query(FileSet).filter(FileSet.id.in_(file_set_ids)):
+            db_session.delete(file_set)
+    repository.status = Repository.DELETED
+    repository.deleted_at = func.now()
+    repository.name = '{}.deleted-{}'.format(repository.name, repository.id)[-255:]
+    db_session.add(repository)
+    db_session.commit()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def lock_rows(db_session, query):
+    # Locks the rows selected by 'query', skipping rows locked by another collector. This needs
+    # Postgres. Other databases (e.g., the SQLite fallback in settings.py) get a plain select,
+    # so only a single collector should run against them.
+    if db_session.get_bind().dialect.name != 'postgresql':
+        return query
+    return query.with_for_update(skip_locked=True)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def collect(db_session, batch_size=100):
+    # Removes up to 'batch_size' deleted files together with content no other file refers to.
+    # Rows are deleted before content so a failure leaves orphaned content at worst, which the
+    # orphan scanner picks up. Tombstones locked by another collector are skipped. Returns the
+    # number of files removed.
+    files = lock_rows(db_session, db_session.query(File).filter(
+        File.status == File.DELETED).order_by(File.id).limit(batch_size)).all()
+    storage_ids = []
+    for f in files:
+        if f.sha1 is not None:
+            storage_id = release_blob(db_session, f.sha1)
+        else:
+            storage_id = f.storage_id
+        if storage_id is not None:
+            storage_ids.append(storage_id)
+        db_session.query(FileQualityCheck).filter(FileQualityCheck.file_id == f.id).delete(synchronize_session=False)
+        db_session.delete(f)
+    db_session.commit()
+    for storage_id in storage_ids:
+        remove_content(storage_id)
+    return len(files)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def collect_repositories(db_session, batch_size=1000):
+    # Deletes the files of deleted repositories, 'batch_size' at a time, and removes each
+    # repository once all its files are gone. Returns the number of files deleted.
+    nr_files = 0
+    repositories = lock_rows(db_session, db_session.query(Repository).filter(
+        Repository.status == Repository.DELETED)).all()
+    for repository in repositories:
+        ids = [row[0] for row in db_session.query(File.id).filter(
+            File.repository_id == repository.id, File.status == File.ACTIVE).limit(batch_size)]
+        if len(ids) > 0:
+            db_session.execute(FileSetFiles.delete().where(FileSetFiles.c.file_id.in_(ids)))
+            db_session.execute(File.__table__.update().where(File.__table__.c.id.in_(ids)).values(
+                status=File.DELETED, deleted_at=func.now()))
+            nr_files += len(ids)
+        elif db_session.query(File.id).filter(File.repository_id == repository.id).first() is None:
+            db_session.delete(repository)
+    db_session.commit()
+    return nr_files
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def scan_orphans(db_session, root_dir, min_age=3600, delete=False):
+    # Reconciles the files volume with the database. Returns the names of files that no file
+    # or blob refers to (orphans) and the storage IDs of files whose content is missing. Files
+    # modified less than 'min_age' seconds ago may be uploads in progress and are left alone.
+    known = set()
+    for query in [db_session.query(File.storage_id), db_session.query(Blob.storage_id)]:
+        for row in query.yield_per(10000):
+            known.add(row[0])
+    orphans = []
+    now = time.time()
+    for name in os.listdir(root_dir):
+        storage_id = name[:-len('.shactx')] if name.endswith('.shactx') else name
+        if storage_id in known:
+            continue
+        path = os.path.join(root_dir, name)
+        try:
+            if not os.path.isfile(path) or now - os.path.getmtime(path) < min_age:
+                continue
+            if delete:
+                os.remove(path)
+        except OSError as e:
+            LOG.error('Could not remove orphan {} ({})'.format(path, e))
+            continue
+        orphans.append(name)
+    missing = []
+    for row in db_session.query(File.storage_id).filter(File.status == File.ACTIVE).distinct().yield_per(10000):
+        if not os.path.isfile(os.path.join(root_dir, row[0])):
+            missing.append(row[0])
+    return orphans, missing
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def start_garbage_collector(app, db):
+    # One collector per process. uWSGI forks its workers, so this is called after forking.
+    # Collectors in different workers skip each other's locked tombstones.
+    key = os.getpid()
+    with _collectors_lock:
+        if key not in _collectors:
+            collector = GarbageCollector(app, db, app.config['GC_INTERVAL'], app.config['GC_BATCH_SIZE'])
+            collector.start()
+            _collectors[key] = collector
+        return _collectors[key]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class GarbageCollector(object):
+
+    def __init__(self, app, db, interval=60, batch_size=100):
+        self.app = app
+        self.db = db
+        self.interval = interval
+        self.batch_size = batch_size
+        self.nr_collected = 0
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                LOG.error('Garbage collection failed ({})'.format(e))
+            time.sleep(self.interval)
+
+    def run_once(self):
+        # Keeps collecting until deleted repositories have no files left and there are no more
+        # full batches of tombstones
+        with self.app.app_context():
+            try:
+                while True:
+                    nr_deleted = collect_repositories(self.db.session, self.batch_size * 10)
+                    n = collect(self.db.session, self.batch_size)
+                    self.nr_collected += n
+                    if nr_deleted == 0 and n < self.batch_size:
+                        break
+            finally:
+                self.db.session.remove()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description='Storage garbage collection')
+    parser.add_argument('command', choices=['collect', 'scan'])
+    parser.add_argument('--delete', action='store_true', help='Remove orphaned content found by scan')
+    parser.add_argument('--min-age', type=int, default=3600, help='Ignore content younger than this (seconds)')
+    args = parser.parse_args()
+
+    from service.storage.app import app, db, init_db
+    with app.app_context():
+        init_db()
+        if args.command == 'collect':
+            collector = GarbageCollector(app, db, batch_size=app.config['GC_BATCH_SIZE'])
+            collector.run_once()
+            print('Removed {} files'.format(collector.nr_collected))
+        else:
+            orphans, missing = scan_orphans(db.session, app.config['STORAGE_ROOT_DIR'], args.min_age, args.delete)
+            for name in orphans:
+                print('{} orphan {}'.format('Removed' if args.delete else 'Found', name))
+            for storage_id in missing:
+                print('Missing content {}'.format(storage_id))
+            print('{} orphans, {} files with missing content'.format(len(orphans), len(missing)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-from models import Repository, File, FileSet, FileType, ScanType
+from models import Repository, File, FileSet, FileType, ScanType, Blob
 from lib.dao import BaseDao
 
 
@@ -8,6 +8,19 @@ class RepositoryDao(BaseDao):
     def __init__(self, db_session):
         super(RepositoryDao, self).__init__(Repository, db_session)
 
+    def retrieve(self, profile=None, **kwargs):
+        # Deleted repositories are left to the garbage collector and no longer exist for clients
+        repository = super(RepositoryDao, self).retrieve(profile, **kwargs)
+        if repository is not None and repository.status == Repository.DELETED:
+            return None
+        return repository
+
+    def page_query(self, cursor=None, filters=None, query=None, **kwargs):
+        if query is None:
+            query = self.query()
+        query = query.filter(Repository.status == Repository.ACTIVE)
+        return super(RepositoryDao, self).page_query(cursor, filters, query, **kwargs)
+
 
 # ----------------------------------------------------------------------------------------------------------------------
 class FileDao(BaseDao):
@@ -15,6 +28,19 @@ class FileDao(BaseDao):
     def __init__(self, db_session):
         super(FileDao, self).__init__(File, db_session)
 
+    def retrieve(self, profile=None, **kwargs):
+        # Deleted files are tombstones for the garbage collector and no longer exist for clients
+        f = super(FileDao, self).retrieve(profile, **kwargs)
+        if f is not None and f.status == File.DELETED:
+            return None
+        return f
+
+    def page_query(self, cursor=None, filters=None, query=None, **kwargs):
+        if query is None:
+            query = self.query()
+        query = query.filter(File.status == File.ACTIVE)
+        return super(FileDao, self).page_query(cursor, filters, query, **kwargs)
+
 
 # ----------------------------------------------------------------------------------------------------------------------
 class FileSetDao(BaseDao):
@@ -35,3 +61,23 @@ class ScanTypeDao(BaseDao):
 
     def __init__(self, db_session):
         super(ScanTypeDao, self).__init__(ScanType, db_session)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class BlobDao(BaseDao):
+
+    def __init__(self, db_session):
+        super(BlobDao, self).__init__(Blob, db_session)
+
+    def retrieve_for_update(self, sha1):
+        # Locks the blob until the transaction ends so that concurrent uploads and deletes
+        # of the same content do not lose reference count updates
+        return self.query().filter_by(sha1=sha1).with_for_update().first()
+
+    def retrieve_all_for_update(self, sha1s):
+        # Locks all blobs with the given digests with a single query. Returns a dictionary
+        # of blobs by digest.
+        if len(sha1s) == 0:
+            return {}
+        query = self.query().filter(Blob.sha1.in_(set(sha1s))).order_by(Blob.sha1).with_for_update()
+        return {blob.sha1: blob for blob in query}
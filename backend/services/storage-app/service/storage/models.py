@@ -1,5 +1,5 @@
 import json
-from sqlalchemy import Column, Integer, String, ForeignKey, Table, Boolean, Text
+from sqlalchemy import Column, Integer, String, ForeignKey, Table, Boolean, Text, DateTime
 from sqlalchemy.orm import relationship, validates
 from lib.models import Base, BaseModel
 
@@ -77,15 +77,28 @@ class Repository(BaseModel):
         'polymorphic_identity': 'repository',
     }
 
+    LOAD_PROFILES = {
+        'dict': {'selectin': ['files', 'file_sets']},
+    }
+
+    ACTIVE = 'active'
+    DELETED = 'deleted'
+
     # Repository ID in database
     id = Column(Integer, ForeignKey('base.id'), primary_key=True)
     # Repository name
     name = Column(String(255), nullable=False, unique=True)
+    # Repository status. Deleted repositories are kept until the garbage collector has
+    # removed their files.
+    status = Column(String(16), nullable=False, default=ACTIVE, index=True)
+    # Date and time the repository was deleted
+    deleted_at = Column(DateTime(timezone=True))
 
     def to_dict(self):
         files = []
         for f in self.files:
-            files.append(f.id)
+            if f.status != File.DELETED:
+                files.append(f.id)
         file_sets = []
         for file_set in self.file_sets:
             file_sets.append(file_set.id)
@@ -106,6 +119,13 @@ class File(BaseModel):
         'polymorphic_identity': 'file',
     }
 
+    LOAD_PROFILES = {
+        'dict': {'joined': ['file_type', 'scan_type', 'repository'], 'selectin': ['file_sets']},
+    }
+
+    ACTIVE = 'active'
+    DELETED = 'deleted'
+
     # File ID in database
     id = Column(Integer, ForeignKey('base.id'), primary_key=True)
     # File name without path information
@@ -128,10 +148,17 @@ class File(BaseModel):
     storage_path = Column(String, nullable=False)
     # Media link for downloading the file
     media_link = Column(String, nullable=False)
+    # SHA-1 digest of the file's content. Files with the same digest share the same blob.
+    sha1 = Column(String(40), index=True)
     # File repository ID
     repository_id = Column(Integer, ForeignKey('repository.id'), nullable=False)
     # File repository
     repository = relationship('Repository', backref='files', foreign_keys=[repository_id])
+    # File status. Deleted files are kept as tombstones until the garbage collector has
+    # released their content.
+    status = Column(String(16), nullable=False, default=ACTIVE, index=True)
+    # Date and time the file was deleted
+    deleted_at = Column(DateTime(timezone=True))
 
     def to_dict(self):
         file_sets = []
@@ -147,12 +174,45 @@ class File(BaseModel):
             'storage_id': self.storage_id,
             'storage_path': self.storage_path,
             'media_link': self.media_link,
+            'sha1': self.sha1,
             'repository': self.repository.name,
             'file_sets': file_sets,
         })
         return obj
 
 
+# ----------------------------------------------------------------------------------------------------------------------
+class Blob(BaseModel):
+
+    __tablename__ = 'blob'
+    __mapper_args__ = {
+        'polymorphic_identity': 'blob',
+    }
+
+    # Blob ID in database
+    id = Column(Integer, ForeignKey('base.id'), primary_key=True)
+    # SHA-1 digest of the blob's content
+    sha1 = Column(String(40), nullable=False, unique=True, index=True)
+    # Blob size
+    size = Column(Integer, nullable=False)
+    # Storage ID in storage backend
+    storage_id = Column(String, nullable=False)
+    # Storage path in storage backend
+    storage_path = Column(String, nullable=False)
+    # Number of files referring to this blob. The blob is deleted when it drops to zero.
+    ref_count = Column(Integer, nullable=False, default=0)
+
+    def to_dict(self):
+        obj = super(Blob, self).to_dict()
+        obj.update({
+            'sha1': self.sha1,
+            'size': self.size,
+            'storage_id': self.storage_id,
+            'ref_count': self.ref_count,
+        })
+        return obj
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 class FileSet(BaseModel):
 
@@ -161,6 +221,10 @@ class FileSet(BaseModel):
         'polymorphic_identity': 'file_set',
     }
 
+    LOAD_PROFILES = {
+        'dict': {'joined': ['repository'], 'selectin': ['files']},
+    }
+
     # File set ID
     id = Column(Integer, ForeignKey('base.id'), primary_key=True)
     # File set name
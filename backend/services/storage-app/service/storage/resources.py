@@ -1,9 +1,16 @@
 import os
 import logging
+import tempfile
+import zipfile
 import lib.http as http
 from flask_restful import reqparse, request
 from lib.authentication import token_required
+from lib.permissions import check_permissions
+from archives import extract_archive
+from blobs import (
+    content_path, create_file, create_files, remove_content, find_blob, register_file, store_content)
 from dao import FileDao, FileTypeDao, ScanTypeDao, RepositoryDao, FileSetDao
+from service.storage.collector import delete_file, delete_repository
 from lib.resources import BaseResource
 
 LOG = logging.getLogger(__name__)
@@ -17,7 +24,7 @@ class RootResource(BaseResource):
     def get(self):
         return self.response({
             'service': 'storage',
-            'endpoints': ['file-types', 'scan-types', 'repositories', 'files', 'file-sets'],
+            'endpoints': ['file-types', 'scan-types', 'repositories', 'files', 'file-sets', 'token-cache'],
         })
 
 
@@ -33,11 +40,15 @@ class FileTypesResource(BaseResource):
         parser.add_argument('name', type=str, location='args')
         args = parser.parse_args()
 
+        list_args, msg = self.list_args(['id', 'name'])
+        if list_args is None:
+            return self.error_response(msg, http.BAD_REQUEST_400)
+
         file_type_dao = FileTypeDao(self.db_session())
-        file_types = file_type_dao.retrieve_all(**args)
-        result = [file_type.to_dict() for file_type in file_types]
+        file_types, has_more = file_type_dao.retrieve_page(
+            cursor=list_args['cursor'], limit=list_args['limit'], filters=list_args['filters'], **args)
 
-        return self.response(result)
+        return self.list_response(file_types, has_more, list_args)
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -52,11 +63,15 @@ class ScanTypesResource(BaseResource):
         parser.add_argument('name', type=str, location='args')
         args = parser.parse_args()
 
+        list_args, msg = self.list_args(['id', 'name'])
+        if list_args is None:
+            return self.error_response(msg, http.BAD_REQUEST_400)
+
         scan_type_dao = ScanTypeDao(self.db_session())
-        scan_types = scan_type_dao.retrieve_all(**args)
-        result = [scan_type.to_dict() for scan_type in scan_types]
+        scan_types, has_more = scan_type_dao.retrieve_page(
+            cursor=list_args['cursor'], limit=list_args['limit'], filters=list_args['filters'], **args)
 
-        return self.response(result)
+        return self.list_response(scan_types, has_more, list_args)
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -71,11 +86,16 @@ class RepositoriesResource(BaseResource):
         parser.add_argument('name', type=str, location='args')
         args = parser.parse_args()
 
+        list_args, msg = self.list_args(['id', 'name', 'created_at', 'updated_at'])
+        if list_args is None:
+            return self.error_response(msg, http.BAD_REQUEST_400)
+
         repository_dao = RepositoryDao(self.db_session())
-        repositories = repository_dao.retrieve_all(**args)
-        result = [repository.to_dict() for repository in repositories]
+        repositories, has_more = repository_dao.retrieve_page(
+            profile='dict', cursor=list_args['cursor'], limit=list_args['limit'], filters=list_args['filters'],
+            **args)
 
-        return self.response(result)
+        return self.list_response(repositories, has_more, list_args)
 
     @token_required
     def post(self):
@@ -124,21 +144,37 @@ class RepositoryResource(BaseResource):
     @token_required
     def delete(self, id):
 
+        # Repositories with files or file sets are only deleted if 'recursive' is set
+        parser = reqparse.RequestParser()
+        parser.add_argument('recursive', type=str, location='args')
+        args = parser.parse_args()
+        recursive = (args['recursive'] or 'false').lower() == 'true'
+
         repository_dao = RepositoryDao(self.db_session())
         repository = repository_dao.retrieve(id=id)
         if repository is None:
             return self.error_response('Repository {} not found'.format(id), http.NOT_FOUND_404)
-        
-        # Check if repository has files. If not, return an error
-        if len(repository.files) > 0:
-            return self.error_response('Repository {} not empty'.format(id), http.FORBIDDEN_403)
-        
-        # Check if repository has file sets. If so, return an error
-        if len(repository.file_sets) > 0:
-            return self.error_response('Repository {} not empty'.format(id), http.FORBIDDEN_403)
-        
-        # Delete repository
-        repository_dao.delete(repository)
+
+        # Check if repository has files or file sets. If so, return an error unless we're
+        # deleting recursively. In that case the files are deleted in the background by the
+        # garbage collector.
+        f_dao = FileDao(self.db_session())
+        has_files = f_dao.page_query(repository_id=repository.id).first() is not None
+        if has_files or len(repository.file_sets) > 0:
+            if not recursive:
+                return self.error_response('Repository {} not empty'.format(id), http.FORBIDDEN_403)
+            delete_repository(self.db_session(), repository)
+            return self.response({}, http.ACCEPTED_202)
+
+        # Delete the repository right away if no files refer to it anymore. Files that were
+        # deleted before may still be waiting for the garbage collector. In that case the
+        # repository is only marked as deleted. It no longer exists for clients and its name
+        # can be used again, but its row is removed by the collector together with the last
+        # of these files. Either way the client gets a 204 response.
+        if f_dao.query().filter_by(repository_id=repository.id).first() is None:
+            repository_dao.delete(repository)
+        else:
+            delete_repository(self.db_session(), repository)
 
         return self.response({}, http.NO_CONTENT_204)
 
@@ -151,16 +187,115 @@ class RepositoryFilesResource(BaseResource):
     @token_required
     def get(self, id):
 
+        list_args, msg = self.list_args(
+            ['id', 'name', 'size', 'content_type', 'file_type_id', 'scan_type_id', 'created_at', 'updated_at'])
+        if list_args is None:
+            return self.error_response(msg, http.BAD_REQUEST_400)
+
         # Retrieve repository
         repository_dao = RepositoryDao(self.db_session())
         repository = repository_dao.retrieve(id=id)
         if repository is None:
             return self.error_response('Repository {} not found'.format(id), http.NOT_FOUND_404)
 
-        # Retrieve files in given repository
-        result = [f.to_dict() for f in repository.files]
+        # Retrieve files in given repository. Their relationships are loaded up front so
+        # that to_dict() does not need additional queries per file.
+        f_dao = FileDao(self.db_session())
+        if not self.config().get('PERMISSION_CHECKS_ENABLED', False):
+            files, next_cursor = f_dao.stream_page(
+                profile='dict', cursor=list_args['cursor'], limit=list_args['limit'], filters=list_args['filters'],
+                repository_id=repository.id)
+            return self.stream_list_response(files, next_cursor, list_args)
+
+        files, has_more = f_dao.retrieve_page(
+            profile='dict', cursor=list_args['cursor'], limit=list_args['limit'], filters=list_args['filters'],
+            repository_id=repository.id)
+
+        # Only return files the user is allowed to retrieve. All files are checked with
+        # a single call to the auth service. Paging continues after the last file checked.
+        permissions = ['retrieve:file@{}'.format(f.id) for f in files]
+        results, msg = check_permissions(request.authorization.username, permissions)
+        if results is None:
+            return self.error_response(msg, http.FORBIDDEN_403)
+        result = [f.to_dict() for f, allowed in zip(files, results) if allowed]
 
-        return self.response(result)
+        return self.list_response(files, has_more, list_args, result)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class RepositoryFilesBatchResource(BaseResource):
+
+    URI = '/repositories/{}/files:batch'
+
+    @token_required
+    def post(self, id):
+
+        # Retrieve repository
+        repository_dao = RepositoryDao(self.db_session())
+        repository = repository_dao.retrieve(id=id)
+        if repository is None:
+            return self.error_response('Repository {} not found'.format(id), http.NOT_FOUND_404)
+
+        # Small files are uploaded together as the 'files' parts of a multipart request, with
+        # 'file_type_id' and 'scan_type_id' form fields for all of them. Files for content we
+        # already have are registered with a JSON list of files with SHA-1 and size instead.
+        parts = None
+        if request.mimetype == 'multipart/form-data':
+            parts = request.files.getlist('files')
+            entries = [{
+                'name': part.filename,
+                'content_type': part.mimetype,
+                'file_type_id': request.form.get('file_type_id', type=int),
+                'scan_type_id': request.form.get('scan_type_id', type=int),
+            } for part in parts]
+        else:
+            data = request.get_json(silent=True)
+            if data is None or not isinstance(data.get('files'), list):
+                return self.error_response('Missing list of files', http.BAD_REQUEST_400)
+            entries = data['files']
+            for e in entries:
+                if not isinstance(e, dict) or not isinstance(e.get('sha1'), basestring) or \
+                        not isinstance(e.get('size'), (int, long)) or not isinstance(e.get('name'), basestring):
+                    return self.error_response('Files require name, sha1 and size', http.BAD_REQUEST_400)
+        if len(entries) == 0:
+            return self.error_response('No files', http.BAD_REQUEST_400)
+        if len(entries) > self.config()['MAX_BATCH_SIZE']:
+            return self.error_response(
+                'Too many files (maximum is {})'.format(self.config()['MAX_BATCH_SIZE']), http.BAD_REQUEST_400)
+
+        # Look up each distinct file and scan type once
+        file_types = FileTypeDao(self.db_session()).retrieve_by_ids([e.get('file_type_id') for e in entries])
+        scan_types = ScanTypeDao(self.db_session()).retrieve_by_ids([e.get('scan_type_id') for e in entries])
+        for e in entries:
+            if e.get('file_type_id') not in file_types:
+                return self.error_response('File type {} not found'.format(e.get('file_type_id')), http.NOT_FOUND_404)
+            if e.get('scan_type_id') not in scan_types:
+                return self.error_response('Scan type {} not found'.format(e.get('scan_type_id')), http.NOT_FOUND_404)
+            e['name'] = os.path.basename(e['name'] or 'unknown')
+            e['content_type'] = e.get('content_type') or 'application/octet-stream'
+            e['repository_id'] = repository.id
+            if parts is None:
+                e['sha1'] = e['sha1'].lower()
+                e.pop('storage_id', None)
+                e.pop('storage_path', None)
+
+        # Write uploaded content to the files volume. Duplicates of content we already have
+        # are removed again when the files are created.
+        if parts is not None:
+            for e, part in zip(entries, parts):
+                e['storage_id'], e['storage_path'], e['size'], e['sha1'] = store_content(part.stream)
+
+        # Create all files in a single transaction
+        ids, _, msg = create_files(
+            self.db_session(), self.config()['DOWNLOAD_URI'], entries, user_id=self.current_user()['id'])
+        if ids is None:
+            for e in entries:
+                if e.get('storage_id') is not None:
+                    remove_content(e['storage_id'])
+            return self.error_response(msg, http.NOT_FOUND_404)
+
+        files = FileDao(self.db_session()).retrieve_by_ids(ids, profile='dict')
+        return self.response([files[i].to_dict() for i in ids], http.CREATED_201)
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -205,21 +340,14 @@ class RepositoryFileResource(BaseResource):
         if f.repository != repository:
             return self.error_response('File {} not in repository {}'.format(file_id, id), http.BAD_REQUEST_400)
         
-        # Delete physical file on file server. This requires we get the storage ID of the
-        # file and append it to the STORAGE_ROOT_DIR environment variable. This variable
-        # must exist! It allows us to test locally. In a full Docker environment it will
-        # most likely point to /mnt/shared/files whereas in a local development environment
-        # it will point to a /files somewhere inside this project
-        path = os.path.join(os.getenv('STORAGE_ROOT_DIR'), f.storage_id)
-        path_shactx = path + '.shactx'
-        try:
-            os.remove(path)
-            os.remove(path_shactx)
-            f_dao.delete(f)
-        except IOError:
-            return self.error_response(
-                'File {} at path {} could not be deleted'.format(file_id, path), http.INTERNAL_SERVER_ERROR_500)
-        
+        # Mark the file as deleted. The garbage collector (see collector.py) removes it later together
+        # with its physical file in STORAGE_ROOT_DIR. This variable must exist! It allows us to
+        # test locally. In a full Docker environment it will most likely point to
+        # /mnt/shared/files whereas in a local development environment it will point to a
+        # /files somewhere inside this project. Content shared with other files (same SHA-1)
+        # is only deleted together with the last of them.
+        delete_file(self.db_session(), f)
+
         return self.response({}, http.NO_CONTENT_204)
 
 
@@ -242,10 +370,17 @@ class RepositoryFileSetsResource(BaseResource):
         if repository is None:
             return self.error_response('Repository {} not found'.format(id), http.NOT_FOUND_404)
 
+        list_args, msg = self.list_args(['id', 'name', 'created_at', 'updated_at'])
+        if list_args is None:
+            return self.error_response(msg, http.BAD_REQUEST_400)
+
         # Retrieve file sets in given repository
-        result = [file_set.to_dict() for file_set in repository.file_sets]
+        file_set_dao = FileSetDao(self.db_session())
+        file_sets, has_more = file_set_dao.retrieve_page(
+            profile='dict', cursor=list_args['cursor'], limit=list_args['limit'], filters=list_args['filters'],
+            repository_id=repository.id, name=args['name'])
 
-        return self.response(result)
+        return self.list_response(file_sets, has_more, list_args)
 
     @token_required
     def post(self):
@@ -268,6 +403,84 @@ class RepositoryFileSetsResource(BaseResource):
         return self.response(file_set.to_dict(), http.CREATED_201)
 
 
+# ----------------------------------------------------------------------------------------------------------------------
+class RepositoryFileSetArchivesResource(BaseResource):
+
+    URI = '/repositories/{}/file-sets:extract'
+
+    @token_required
+    def post(self, id):
+
+        # The archive is either the request body (a tar, optionally compressed, or zip with
+        # 'Content-Type: application/zip') or a file uploaded before, e.g., because it is too
+        # large for a single request. Its files are added to the repository with the given file
+        # and scan type, and to a new file set.
+        parser = reqparse.RequestParser()
+        parser.add_argument('name', type=str, required=True, location='args')
+        parser.add_argument('file_type_id', type=int, required=True, location='args')
+        parser.add_argument('scan_type_id', type=int, required=True, location='args')
+        parser.add_argument('content_type', type=str, location='args')
+        parser.add_argument('file_id', type=int, location='args')
+        args = parser.parse_args()
+
+        # Retrieve repository
+        repository_dao = RepositoryDao(self.db_session())
+        repository = repository_dao.retrieve(id=id)
+        if repository is None:
+            return self.error_response('Repository {} not found'.format(id), http.NOT_FOUND_404)
+
+        # Retrieve file and scan type
+        file_type = FileTypeDao(self.db_session()).retrieve(id=args['file_type_id'])
+        if file_type is None:
+            return self.error_response('File type {} not found'.format(args['file_type_id']), http.NOT_FOUND_404)
+        scan_type = ScanTypeDao(self.db_session()).retrieve(id=args['scan_type_id'])
+        if scan_type is None:
+            return self.error_response('Scan type {} not found'.format(args['scan_type_id']), http.NOT_FOUND_404)
+
+        # Extract the archive's files to the files volume
+        if args['file_id'] is not None:
+            f = FileDao(self.db_session()).retrieve(id=args['file_id'])
+            if f is None:
+                return self.error_response('File {} not found'.format(args['file_id']), http.NOT_FOUND_404)
+            if f.repository != repository:
+                return self.error_response(
+                    'File {} not in repository {}'.format(args['file_id'], id), http.BAD_REQUEST_400)
+            with open(content_path(f.storage_id), 'rb') as file_obj:
+                is_zip = zipfile.is_zipfile(file_obj)
+                file_obj.seek(0)
+                entries, msg = extract_archive(file_obj, is_zip, self.config()['MAX_ARCHIVE_FILES'])
+        elif request.mimetype in ('application/zip', 'application/x-zip-compressed'):
+            # Zip archives list their files at the end, so the body is spooled to disk first
+            with tempfile.TemporaryFile(dir=self.config()['STORAGE_ROOT_DIR']) as file_obj:
+                for chunk in iter(lambda: request.stream.read(1024 * 1024), b''):
+                    file_obj.write(chunk)
+                file_obj.seek(0)
+                entries, msg = extract_archive(file_obj, True, self.config()['MAX_ARCHIVE_FILES'])
+        else:
+            entries, msg = extract_archive(request.stream, False, self.config()['MAX_ARCHIVE_FILES'])
+        if entries is None:
+            return self.error_response(msg, http.BAD_REQUEST_400)
+        if len(entries) == 0:
+            return self.error_response('Archive contains no files', http.BAD_REQUEST_400)
+
+        # Create the files and the file set in a single transaction
+        for e in entries:
+            e['content_type'] = args['content_type'] or 'application/octet-stream'
+            e['file_type_id'] = file_type.id
+            e['scan_type_id'] = scan_type.id
+            e['repository_id'] = repository.id
+        _, file_set_id, msg = create_files(
+            self.db_session(), self.config()['DOWNLOAD_URI'], entries, file_set_name=args['name'],
+            user_id=self.current_user()['id'])
+        if file_set_id is None:
+            for e in entries:
+                remove_content(e['storage_id'])
+            return self.error_response(msg, http.BAD_REQUEST_400)
+
+        file_set = FileSetDao(self.db_session()).retrieve(profile='dict', id=file_set_id)
+        return self.response(file_set.to_dict(), http.CREATED_201)
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 class RepositoryFileSetResource(BaseResource):
 
@@ -363,10 +576,18 @@ class RepositoryFileSetFilesResource(BaseResource):
         if file_set.repository != repository:
             return self.error_response('File set {} not in repository {}'.format(file_set_id, id), http.BAD_REQUEST_400)
 
+        list_args, msg = self.list_args(
+            ['id', 'name', 'size', 'content_type', 'file_type_id', 'scan_type_id', 'created_at', 'updated_at'])
+        if list_args is None:
+            return self.error_response(msg, http.BAD_REQUEST_400)
+
         # Get files in file set
-        files = [f.to_dict() for f in file_set.files]
+        f_dao = FileDao(self.db_session())
+        files, next_cursor = f_dao.stream_page(
+            profile='dict', cursor=list_args['cursor'], limit=list_args['limit'], filters=list_args['filters'],
+            query=f_dao.query().with_parent(file_set, 'files'))
 
-        return self.response(files)
+        return self.stream_list_response(files, next_cursor, list_args)
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -467,6 +688,7 @@ class UploadsResource(BaseResource):
         parser.add_argument('path', type=str, location='form')
         parser.add_argument('name', type=str, location='form')
         parser.add_argument('size', type=int, location='form')
+        parser.add_argument('sha1', type=str, location='form')
 
         # These arguments have to be passed in the headers, otherwise it won't work
         parser.add_argument('X-File-Type', type=int, location='headers')
@@ -500,16 +722,74 @@ class UploadsResource(BaseResource):
         # Strip file name from any path-related info
         name = os.path.basename(args['name'])
         
-        # Create media link for downloading the file. The link should refer to the UI_SERVICE
-        # IP address because it will be used by clients.
-        media_link = '{}/{}'.format(self.config()['DOWNLOAD_URI'], args['id'])
-
-        # Create the file and return its dictionary info
-        f_dao = FileDao(self.db_session())
-        f = f_dao.create(
+        # Create the file and return its dictionary info. If we already have the same content
+        # the file will refer to the existing blob instead. The media link for downloading the
+        # file refers to the UI_SERVICE IP address because it will be used by clients.
+        f = create_file(
+            self.db_session(), self.config()['DOWNLOAD_URI'], args['id'], args['path'], args['size'], args['sha1'],
             name=name, file_type=file_type, scan_type=scan_type, content_type=args['Content-Type'],
-            size=args['size'], storage_id=args['id'], storage_path=args['path'],
-            media_link=media_link, repository=repository)
+            repository=repository, user_id=self.current_user()['id'])
+
+        return self.response(f.to_dict(), http.CREATED_201)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class UploadChecksResource(BaseResource):
+
+    URI = '/uploads/check'
+
+    @token_required
+    def head(self):
+
+        # Tells clients whether we already have content with the given digest and size
+        parser = reqparse.RequestParser()
+        parser.add_argument('sha1', type=str, required=True, location='args')
+        parser.add_argument('size', type=int, required=True, location='args')
+        args = parser.parse_args()
+
+        if find_blob(self.db_session(), args['sha1'].lower(), args['size']) is None:
+            return self.response({}, http.NOT_FOUND_404)
+        return self.response({})
+
+    @token_required
+    def post(self):
+
+        # Creates a file for content we already have, so the client can skip the upload. If
+        # we do not have the content a 404 is returned and the client should upload it.
+        parser = reqparse.RequestParser()
+        parser.add_argument('sha1', type=str, required=True, location='json')
+        parser.add_argument('size', type=int, required=True, location='json')
+        parser.add_argument('name', type=str, required=True, location='json')
+        parser.add_argument('file_type_id', type=int, required=True, location='json')
+        parser.add_argument('scan_type_id', type=int, required=True, location='json')
+        parser.add_argument('repository_id', type=int, required=True, location='json')
+        parser.add_argument('content_type', type=str, location='json')
+        args = parser.parse_args()
+
+        file_type_dao = FileTypeDao(self.db_session())
+        file_type = file_type_dao.retrieve(id=args['file_type_id'])
+        if file_type is None:
+            return self.error_response('File type {} not found'.format(args['file_type_id']), http.NOT_FOUND_404)
+
+        scan_type_dao = ScanTypeDao(self.db_session())
+        scan_type = scan_type_dao.retrieve(id=args['scan_type_id'])
+        if scan_type is None:
+            return self.error_response('Scan type {} not found'.format(args['scan_type_id']), http.NOT_FOUND_404)
+
+        repository_dao = RepositoryDao(self.db_session())
+        repository = repository_dao.retrieve(id=args['repository_id'])
+        if repository is None:
+            return self.error_response('Repository {} not found'.format(args['repository_id']), http.NOT_FOUND_404)
+
+        if args['content_type'] is None:
+            args['content_type'] = 'application/octet-stream'
+
+        f = register_file(
+            self.db_session(), self.config()['DOWNLOAD_URI'], args['sha1'].lower(), args['size'],
+            name=os.path.basename(args['name']), file_type=file_type, scan_type=scan_type,
+            content_type=args['content_type'], repository=repository, user_id=self.current_user()['id'])
+        if f is None:
+            return self.response({}, http.NOT_FOUND_404)
 
         return self.response(f.to_dict(), http.CREATED_201)
 
@@ -44,6 +44,9 @@ RESTFUL_JSON = {'indent': 2, 'sort_keys': True}
 
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Adds the number of SQL queries per request as 'X-Query-Count' header (for testing)
+QUERY_COUNTER_ENABLED = os.getenv('QUERY_COUNTER_ENABLED', 'false').lower() == 'true'
+
 if os.getenv('DB_USER', None) is not None:
     SQLALCHEMY_DATABASE_URI = 'postgres://{}:{}@{}:{}/{}'.format(
         os.getenv('DB_USER'),
@@ -62,6 +65,43 @@ else:
 SERVICE_USERNAME = 'storage'
 SERVICE_PASSWORD = 'secret'
 
+# The service's own token is shared by all worker processes on a host through a file in
+# SERVICE_TOKEN_DIR. It is refreshed in the background SERVICE_TOKEN_REFRESH_MARGIN seconds
+# before it expires, or after SERVICE_TOKEN_LIFETIME seconds if the token has no expiry.
+SERVICE_TOKEN_DIR = os.getenv('SERVICE_TOKEN_DIR', '/tmp/yoda/tokens')
+SERVICE_TOKEN_REFRESH_MARGIN = 300
+SERVICE_TOKEN_LIFETIME = 3600
+
+# Client tokens are either verified by the auth service ('remote', one /token-checks call per
+# request) or in-process ('local'). Local verification checks signature and expiry with
+# TOKEN_VERIFICATION_KEY (the auth service's SECRET_KEY for HS256, its public key for RS256)
+# and rejects deactivated users using the revocation list polled from the auth service.
+TOKEN_VERIFICATION = os.getenv('TOKEN_VERIFICATION', 'remote')
+TOKEN_ALGORITHM = os.getenv('TOKEN_ALGORITHM', 'HS256')
+TOKEN_VERIFICATION_KEY = os.getenv('TOKEN_VERIFICATION_KEY')
+TOKEN_REVOCATIONS_POLL_INTERVAL = 30
+
+# Verified client tokens are cached per token hash so that repeated requests with the same
+# token skip verification. Backend is 'local' (per worker process, LRU bounded by
+# TOKEN_CACHE_MAX_SIZE), 'redis' (shared by all workers) or 'none'. Rejected tokens are
+# cached for TOKEN_CACHE_NEGATIVE_TTL seconds only.
+TOKEN_CACHE_BACKEND = os.getenv('TOKEN_CACHE_BACKEND', 'local')
+TOKEN_CACHE_URL = os.getenv('TOKEN_CACHE_URL', 'redis://redis:6379/1')
+TOKEN_CACHE_MAX_SIZE = 10000
+TOKEN_CACHE_TTL = 60
+TOKEN_CACHE_NEGATIVE_TTL = 5
+
+# Invalidations of cached tokens are only accepted from administrators and the auth service
+# (AUTH_SERVICE_USERNAME). With the 'local' backend they are broadcast to all processes through
+# the Redis at TOKEN_CACHE_INVALIDATIONS_URL. Processes not subscribed to it (e.g., because Redis
+# is down) bypass their cache. An empty URL only invalidates the process receiving the request.
+AUTH_SERVICE_USERNAME = 'auth'
+TOKEN_CACHE_INVALIDATIONS_URL = os.getenv('TOKEN_CACHE_INVALIDATIONS_URL', TOKEN_CACHE_URL)
+
+# If enabled, file listings only include files the user has 'retrieve' permission for. The
+# permissions are checked in bulk by the auth service ('/permission-checks').
+PERMISSION_CHECKS_ENABLED = os.getenv('PERMISSION_CHECKS_ENABLED', 'false').lower() == 'true'
+
 # ------------------------------------------------------------------------------------------------------------------
 # Miscellaneous settings
 # ------------------------------------------------------------------------------------------------------------------
@@ -71,3 +111,22 @@ DOWNLOAD_URI = 'http://{}:{}/storage/downloads'.format(
     os.getenv('UI_SERVICE_PORT'))
 
 STORAGE_ROOT_DIR = os.getenv('STORAGE_ROOT_DIR')
+
+# List endpoints return at most DEFAULT_PAGE_SIZE objects unless clients ask for more with
+# 'limit' (up to MAX_PAGE_SIZE). The next page is referred to in the 'Link' header.
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
+# Maximum number of files created by a single request to '/repositories/<id>/files:batch'
+MAX_BATCH_SIZE = 10000
+
+# Deleted files are removed in the background by a garbage collector thread in each worker
+# process. Every GC_INTERVAL seconds it removes deleted files in batches of GC_BATCH_SIZE.
+# It can also be run from the command line ('python -m service.storage.collector collect'), which
+# also offers a scan for content in STORAGE_ROOT_DIR no file refers to ('scan').
+GC_ENABLED = os.getenv('GC_ENABLED', 'true').lower() == 'true'
+GC_INTERVAL = 60
+GC_BATCH_SIZE = 100
+
+# Maximum number of files extracted from a single archive ('/repositories/<id>/file-sets:extract')
+MAX_ARCHIVE_FILES = 100000
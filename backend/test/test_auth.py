@@ -1,7 +1,10 @@
+import json
+import time
 import requests
+from jose import jwt
 from lib.util import generate_string
 from lib.authentication import login_header, token_header
-from util import uri
+from util import uri, get_token
 
 
 # --------------------------------------------------------------------------------------------------------------------
@@ -21,6 +24,18 @@ def test_request_token():
     assert response.status_code == 403
 
 
+# --------------------------------------------------------------------------------------------------------------------
+def test_token_claims():
+
+    response = requests.post(uri('auth', '/tokens'), headers=login_header('ralph', 'secret'))
+    assert response.status_code == 201
+    claims = jwt.get_unverified_claims(response.json()['token'])
+    assert claims['exp'] > claims['iat']
+    if claims.get('ver') == 2:
+        assert claims['username'] == 'ralph'
+        assert 'permissions' not in claims
+
+
 # --------------------------------------------------------------------------------------------------------------------
 def test_check_token():
 
@@ -124,3 +139,156 @@ def test_create_update_and_delete_group():
     assert response.status_code == 204
     response = requests.get(uri('auth', '/user-groups/{}'.format(user_group_id)), headers=token_header(token))
     assert response.status_code == 404
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def test_revocations():
+
+    token = get_token()
+    data = {
+        'username': generate_string(),
+        'password': 'secret',
+        'email': '{}@yoda.com'.format(generate_string()),
+    }
+
+    # Create user and deactivate it. This should put the user on the revocation list.
+    response = requests.post(uri('auth', '/users'), json=data, headers=token_header(token))
+    assert response.status_code == 201
+    user_id = response.json()['id']
+    user_token = get_token(data['username'])
+    data['is_active'] = False
+    response = requests.put(uri('auth', '/users/{}'.format(user_id)), json=data, headers=token_header(token))
+    assert response.status_code == 200
+    response = requests.get(uri('auth', '/revocations'), headers=token_header(token))
+    assert response.status_code == 200
+    assert user_id in [item['user_id'] for item in response.json()['revocations']]
+
+    # Reactivate user. The revocation stays on the list, so the token issued before the
+    # deactivation is still rejected, but new tokens are accepted.
+    time.sleep(1)
+    data['is_active'] = True
+    response = requests.put(uri('auth', '/users/{}'.format(user_id)), json=data, headers=token_header(token))
+    assert response.status_code == 200
+    response = requests.get(uri('auth', '/revocations'), headers=token_header(token))
+    assert response.status_code == 200
+    assert user_id in [item['user_id'] for item in response.json()['revocations']]
+    response = requests.post(uri('auth', '/token-checks'), json={'token': user_token}, headers=token_header(token))
+    assert response.status_code == 403
+    response = requests.post(uri('auth', '/tokens'), headers=login_header(data['username'], 'secret'))
+    assert response.status_code == 201
+    user_token = response.json()['token']
+    response = requests.post(uri('auth', '/token-checks'), json={'token': user_token}, headers=token_header(token))
+    assert response.status_code == 201
+
+    response = requests.delete(uri('auth', '/users/{}'.format(user_id)), headers=token_header(token))
+    assert response.status_code == 204
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def test_permission_checks():
+
+    token = get_token()
+    data = {
+        'username': generate_string(),
+        'password': 'secret',
+        'email': '{}@yoda.com'.format(generate_string()),
+    }
+    response = requests.post(uri('auth', '/users'), json=data, headers=token_header(token))
+    assert response.status_code == 201
+    user_id = response.json()['id']
+    user_token = get_token(data['username'])
+    permissions = ['retrieve:file', 'retrieve:file@1', 'delete:repository@2']
+
+    # Administrators have all permissions, new users have none
+    response = requests.post(uri('auth', '/permission-checks'), json={
+        'token': token, 'permissions': permissions}, headers=token_header(token))
+    assert response.status_code == 201
+    assert response.json()['results'] == [True, True, True]
+    response = requests.post(uri('auth', '/permission-checks'), json={
+        'token': user_token, 'permissions': permissions}, headers=token_header(token))
+    assert response.status_code == 201
+    assert response.json()['user_id'] == user_id
+    assert response.json()['results'] == [False, False, False]
+
+    # Invalid permission strings are rejected
+    response = requests.post(uri('auth', '/permission-checks'), json={
+        'token': user_token, 'permissions': ['retrieve']}, headers=token_header(token))
+    assert response.status_code == 400
+
+    response = requests.delete(uri('auth', '/users/{}'.format(user_id)), headers=token_header(token))
+    assert response.status_code == 204
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def test_login_throttling():
+
+    # Successful logins are not counted
+    for i in range(25):
+        response = requests.post(uri('auth', '/tokens'), headers=login_header('ralph', 'secret'))
+        assert response.status_code == 201
+
+    # Unknown users count as well, so we can use a random user name
+    username = generate_string()
+    status_codes = []
+    for i in range(25):
+        response = requests.post(uri('auth', '/tokens'), headers=login_header(username, 'secret'))
+        status_codes.append(response.status_code)
+    assert 403 in status_codes
+    assert status_codes[-1] == 429
+
+    token = get_token()
+    response = requests.get(uri('auth', '/login-metrics'), headers=token_header(token))
+    assert response.status_code == 200
+    assert response.json()['username_throttle']['throttled'] > 0
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def test_users_paging():
+
+    token = get_token()
+
+    # Page through users two at a time using the link to the next page
+    response = requests.get(uri('auth', '/users?limit=2&fields=id,username'), headers=token_header(token))
+    assert response.status_code == 200
+    users = response.json()
+    assert len(users) == 2
+    assert sorted(users[0].keys()) == ['id', 'username']
+    while 'next' in response.links:
+        response = requests.get(uri('auth', '/users') + response.links['next']['url'], headers=token_header(token))
+        assert response.status_code == 200
+        assert len(response.json()) <= 2
+        users.extend(response.json())
+    ids = [user['id'] for user in users]
+    assert ids == sorted(set(ids))
+    assert len(ids) >= 4
+
+    # Filters
+    response = requests.get(uri('auth', '/users?username__prefix=ral'), headers=token_header(token))
+    assert response.status_code == 200
+    assert 'ralph' in [user['username'] for user in response.json()]
+    response = requests.get(uri('auth', '/users?id__gt={}'.format(ids[-1])), headers=token_header(token))
+    assert response.status_code == 200
+    assert len(response.json()) == 0
+    response = requests.get(uri('auth', '/users?password__prefix=x'), headers=token_header(token))
+    assert response.status_code == 400
+    response = requests.get(uri('auth', '/users?id__gt=abc'), headers=token_header(token))
+    assert response.status_code == 400
+    assert 'id' in response.json()['message']
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def test_users_ndjson():
+
+    token = get_token()
+    response = requests.get(uri('auth', '/users'), headers=token_header(token))
+    assert response.status_code == 200
+    users = response.json()
+
+    headers = token_header(token)
+    headers['Accept'] = 'application/x-ndjson'
+    response = requests.get(uri('auth', '/users'), headers=headers)
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith('application/x-ndjson')
+    lines = [line for line in response.iter_lines() if line]
+    assert len(lines) == len(users)
+    assert json.loads(lines[0])['id'] == users[0]['id']
@@ -5,7 +5,7 @@ import sys
 import pandas as pd
 from lib.util import generate_string
 from lib.authentication import login_header, token_header
-from util import uri, upload_file
+from util import uri, upload_file, get_token, get_file_type_id, get_scan_type_id, create_repository
 
 
 # --------------------------------------------------------------------------------------------------------------------
@@ -120,3 +120,96 @@ def test_train_classifier():
             assert subject_label == result['predicted_labels'][0]
             break
         time.sleep(2)
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def train_classifier(**params):
+
+    # Uploads the feature file to a new repository, trains a classifier on it with the given
+    # extra parameters and returns the training result
+    token = get_token()
+    repository_id = create_repository(token)
+    file_type_id = get_file_type_id('csv', token)
+    scan_type_id = get_scan_type_id('none', token)
+
+    file_path = os.path.join(os.getenv('DATA_DIR'), 'data.csv')
+    features = pd.read_csv(file_path, index_col='MRid')
+    subject_labels = list(features['Diagnosis'])
+
+    file_id, _ = upload_file(file_path, file_type_id, scan_type_id, repository_id, token)
+    assert file_id
+
+    params.update({
+        'repository_id': repository_id,
+        'file_id': file_id,
+        'subject_labels': subject_labels,
+        'nr_folds': 2,
+        'index_column': 'MRid',
+        'target_column': 'Diagnosis',
+    })
+    response = requests.post(uri('compute', '/tasks'), headers=token_header(token), json={
+        'pipeline_name': 'svm_train',
+        'params': params,
+    })
+
+    assert response.status_code == 201
+    task_id = response.json()['id']
+
+    while True:
+        response = requests.get(uri('compute', '/tasks/{}'.format(task_id)), headers=token_header(token))
+        assert response.status_code == 200
+        status = response.json()['status']
+        assert status == 'PENDING' or status == 'SUCCESS'
+        result = response.json()['result']
+        sys.stdout.write('.')
+        sys.stdout.flush()
+        if status == 'SUCCESS' and result is not None:
+            return result
+        time.sleep(2)
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def test_train_classifier_grid_subtasks():
+
+    if os.getenv('DATA_DIR', None) is None:
+        return
+
+    # Train classifier with the grid of each fold scored in its own sub-task. The result
+    # should look the same as when each fold runs its grid search in a single task.
+    result = train_classifier(kernel='rbf', n_jobs=1, grid_subtasks=True)
+    assert 0.0 <= result['accuracy'] <= 1.0
+    assert result['classifier_id']
+
+    # The sub-tasks use the precomputed kernel and number of inner folds as well
+    result = train_classifier(kernel='rbf', grid_subtasks=True, precompute_kernel=True, nr_inner_folds=2)
+    assert result['n_fits'] == 2 * (100 * 2 + 1)
+    assert result['classifier_id']
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def test_train_classifier_search_strategies():
+
+    if os.getenv('DATA_DIR', None) is None:
+        return
+
+    # Randomized search and successive halving fit fewer models than the exhaustive grid
+    # search (100 points with 3-fold cross-validation and a refit, in each of 2 folds)
+    for strategy in ['random', 'halving']:
+        result = train_classifier(kernel='rbf', search=strategy, search_budget=10)
+        assert result['search'] == strategy
+        assert 0 < result['n_fits'] < 2 * (100 * 3 + 1)
+        assert result['classifier_id']
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def test_train_classifier_precomputed_kernel():
+
+    if os.getenv('DATA_DIR', None) is None:
+        return
+
+    # Train classifiers on kernels computed once per fold. The resulting classifier is a
+    # regular SVC trained with the optimal hyper-parameters.
+    for kernel in ['linear', 'rbf']:
+        result = train_classifier(kernel=kernel, precompute_kernel=True)
+        assert 0.0 <= result['accuracy'] <= 1.0
+        assert result['classifier_id']
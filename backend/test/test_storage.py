@@ -1,8 +1,11 @@
+import hashlib
+import io
 import os
+import tarfile
 import requests
 from lib.util import generate_string
 from lib.authentication import login_header, token_header
-from util import uri, upload_file
+from util import uri, upload_file, upload_content, get_token, get_file_type_id, get_scan_type_id, create_repository
 
 
 # --------------------------------------------------------------------------------------------------------------------
@@ -12,6 +15,20 @@ def test_root():
     pass
 
 
+# --------------------------------------------------------------------------------------------------------------------
+def test_token_cache_invalidation():
+
+    # Only administrators and the auth service may invalidate cached tokens
+    token = get_token('armin')
+    response = requests.post(uri('storage', '/token-cache-invalidations'), json={}, headers=token_header(token))
+    assert response.status_code == 403
+
+    token = get_token()
+    response = requests.post(
+        uri('storage', '/token-cache-invalidations'), json={'user_id': 1}, headers=token_header(token))
+    assert response.status_code in (201, 503)
+
+
 # --------------------------------------------------------------------------------------------------------------------
 def test_upload_and_download():
 
@@ -62,3 +79,227 @@ def test_resume_upload():
 
     if os.getenv('DATA_DIR', None) is None:
         return
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def test_file_listing_query_count():
+
+    token = get_token()
+    file_type_id = get_file_type_id('txt', token)
+    scan_type_id = get_scan_type_id('none', token)
+    repository_id = create_repository(token)
+
+    # The number of queries needed to list the files should not depend on the number of files
+    query_counts = []
+    for i in range(2):
+        for j in range(5):
+            upload_content(generate_string(1000), file_type_id, scan_type_id, repository_id, token)
+        response = requests.get(uri('storage', '/repositories/{}/files'.format(repository_id)), headers=token_header(token))
+        assert response.status_code == 200
+        assert len(response.json()) == (i + 1) * 5
+        if 'X-Query-Count' not in response.headers:
+            return
+        query_counts.append(int(response.headers['X-Query-Count']))
+    assert query_counts[0] == query_counts[1]
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def test_upload_duplicate_content():
+
+    token = get_token()
+    file_type_id = get_file_type_id('txt', token)
+    scan_type_id = get_scan_type_id('none', token)
+
+    repository_ids = [create_repository(token) for i in range(2)]
+
+    # Upload the same content to both repositories. Both files should refer to the same blob.
+    content = generate_string(1000)
+    file_ids, storage_ids = [], []
+    for repository_id in repository_ids:
+        file_id, storage_id = upload_content(content, file_type_id, scan_type_id, repository_id, token)
+        file_ids.append(file_id)
+        storage_ids.append(storage_id)
+    assert storage_ids[0] == storage_ids[1]
+
+    # Deleting the first file should leave the content of the second one in place
+    response = requests.delete(uri('storage', '/repositories/{}/files/{}'.format(
+        repository_ids[0], file_ids[0])), headers=token_header(token))
+    assert response.status_code == 204
+    response = requests.get(uri('storage', '/downloads/{}'.format(storage_ids[1])), headers=token_header(token))
+    assert response.status_code == 200
+    assert len(response.content) == 1000
+    response = requests.delete(uri('storage', '/repositories/{}/files/{}'.format(
+        repository_ids[1], file_ids[1])), headers=token_header(token))
+    assert response.status_code == 204
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def test_upload_check():
+
+    token = get_token()
+    file_type_id = get_file_type_id('txt', token)
+    scan_type_id = get_scan_type_id('none', token)
+    repository_id = create_repository(token)
+
+    content = generate_string(1000)
+    sha1 = hashlib.sha1(content).hexdigest()
+    data = {
+        'sha1': sha1, 'size': len(content), 'name': 'check.txt', 'file_type_id': file_type_id,
+        'scan_type_id': scan_type_id, 'repository_id': repository_id,
+    }
+
+    # Unknown content cannot be registered without uploading it
+    response = requests.head(uri('storage', '/uploads/check?sha1={}&size={}'.format(sha1, len(content))),
+                             headers=token_header(token))
+    assert response.status_code == 404
+    response = requests.post(uri('storage', '/uploads/check'), json=data, headers=token_header(token))
+    assert response.status_code == 404
+
+    # After uploading the content once, it can be registered again without uploading it
+    file_id, storage_id = upload_content(content, file_type_id, scan_type_id, repository_id, token)
+    response = requests.head(uri('storage', '/uploads/check?sha1={}&size={}'.format(sha1, len(content))),
+                             headers=token_header(token))
+    assert response.status_code == 200
+    response = requests.post(uri('storage', '/uploads/check'), json=data, headers=token_header(token))
+    assert response.status_code == 201
+    assert response.json()['storage_id'] == storage_id
+    assert response.json()['id'] != file_id
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def test_range_download():
+
+    token = get_token()
+    file_type_id = get_file_type_id('txt', token)
+    scan_type_id = get_scan_type_id('none', token)
+    repository_id = create_repository(token)
+
+    content = generate_string(1000)
+    _, storage_id = upload_content(content, file_type_id, scan_type_id, repository_id, token)
+
+    headers = token_header(token)
+    headers['Range'] = 'bytes=100-199'
+    response = requests.get(uri('storage', '/downloads/{}'.format(storage_id)), headers=headers)
+    assert response.status_code == 206
+    assert response.content == content[100:200]
+    assert response.headers['Content-Range'] == 'bytes 100-199/1000'
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def test_files_batch():
+
+    token = get_token()
+    file_type_id = get_file_type_id('txt', token)
+    scan_type_id = get_scan_type_id('none', token)
+    repository_id = create_repository(token)
+
+    # Upload several files in one request. Files with the same content share their storage.
+    contents = [generate_string(100) for _ in range(5)]
+    contents.append(contents[0])
+    files = [('files', ('batch-{}.txt'.format(i), content)) for i, content in enumerate(contents)]
+    response = requests.post(
+        uri('storage', '/repositories/{}/files:batch'.format(repository_id)), files=files,
+        data={'file_type_id': file_type_id, 'scan_type_id': scan_type_id}, headers=token_header(token))
+    assert response.status_code == 201
+    assert len(response.json()) == 6
+    assert response.json()[1]['name'] == 'batch-1.txt'
+    assert response.json()[1]['sha1'] == hashlib.sha1(contents[1]).hexdigest()
+    assert response.json()[5]['storage_id'] == response.json()[0]['storage_id']
+
+    # Register files for content we already have. Nothing is created if any content is missing.
+    entries = [{
+        'name': 'registered-{}.txt'.format(i), 'sha1': hashlib.sha1(content).hexdigest(), 'size': len(content),
+        'file_type_id': file_type_id, 'scan_type_id': scan_type_id,
+    } for i, content in enumerate(contents[:3])]
+    missing = dict(entries[0], sha1=hashlib.sha1(generate_string(100)).hexdigest())
+    response = requests.post(
+        uri('storage', '/repositories/{}/files:batch'.format(repository_id)), json={'files': entries + [missing]},
+        headers=token_header(token))
+    assert response.status_code == 404
+    response = requests.post(
+        uri('storage', '/repositories/{}/files:batch'.format(repository_id)), json={'files': entries},
+        headers=token_header(token))
+    assert response.status_code == 201
+    assert [f['name'] for f in response.json()] == ['registered-0.txt', 'registered-1.txt', 'registered-2.txt']
+
+    response = requests.get(uri('storage', '/repositories/{}/files'.format(repository_id)), headers=token_header(token))
+    assert response.status_code == 200
+    assert len(response.json()) == 9
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def test_archive_extraction():
+
+    token = get_token()
+    file_type_id = get_file_type_id('dicom', token)
+    scan_type_id = get_scan_type_id('none', token)
+    repository_id = create_repository(token)
+
+    # Create a compressed tar archive with a directory of slices
+    data = io.BytesIO()
+    archive = tarfile.open(fileobj=data, mode='w:gz')
+    for i in range(20):
+        content = generate_string(100)
+        info = tarfile.TarInfo('series/slice-{}.dcm'.format(i))
+        info.size = len(content)
+        archive.addfile(info, io.BytesIO(content))
+    archive.close()
+
+    params = {'name': 'series', 'file_type_id': file_type_id, 'scan_type_id': scan_type_id}
+    headers = token_header(token)
+    headers['Content-Type'] = 'application/x-tar'
+    response = requests.post(
+        uri('storage', '/repositories/{}/file-sets:extract'.format(repository_id)), params=params,
+        data=data.getvalue(), headers=headers)
+    assert response.status_code == 201
+    assert response.json()['name'] == 'series'
+    assert len(response.json()['files']) == 20
+
+    # Anything else is rejected without creating files
+    response = requests.post(
+        uri('storage', '/repositories/{}/file-sets:extract'.format(repository_id)), params=params,
+        data='not an archive', headers=headers)
+    assert response.status_code == 400
+
+    response = requests.get(uri('storage', '/repositories/{}/files'.format(repository_id)), headers=token_header(token))
+    assert response.status_code == 200
+    assert len(response.json()) == 20
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def test_repository_delete():
+
+    token = get_token()
+    file_type_id = get_file_type_id('txt', token)
+    scan_type_id = get_scan_type_id('none', token)
+    name = 'repository-{}'.format(generate_string(8))
+    repository_id = create_repository(token, name)
+
+    file_ids = []
+    for i in range(2):
+        file_id, _ = upload_content(generate_string(1000), file_type_id, scan_type_id, repository_id, token)
+        file_ids.append(file_id)
+
+    # Deleted files are gone right away, even if their content is removed later
+    response = requests.delete(uri('storage', '/repositories/{}/files/{}'.format(
+        repository_id, file_ids[0])), headers=token_header(token))
+    assert response.status_code == 204
+    response = requests.get(uri('storage', '/repositories/{}/files/{}'.format(
+        repository_id, file_ids[0])), headers=token_header(token))
+    assert response.status_code == 404
+    response = requests.get(uri('storage', '/repositories/{}'.format(repository_id)), headers=token_header(token))
+    assert response.status_code == 200
+    assert response.json()['files'] == [file_ids[1]]
+
+    # Repositories with files are only deleted recursively
+    response = requests.delete(uri('storage', '/repositories/{}'.format(repository_id)), headers=token_header(token))
+    assert response.status_code == 403
+    response = requests.delete(
+        uri('storage', '/repositories/{}?recursive=true'.format(repository_id)), headers=token_header(token))
+    assert response.status_code == 202
+    response = requests.get(uri('storage', '/repositories/{}'.format(repository_id)), headers=token_header(token))
+    assert response.status_code == 404
+
+    # The name of the deleted repository can be used again
+    response = requests.post(uri('storage', '/repositories'), json={'name': name}, headers=token_header(token))
+    assert response.status_code == 201
@@ -1,6 +1,7 @@
 import os
 import requests
-from lib.authentication import token_header
+from lib.util import generate_string
+from lib.authentication import login_header, token_header
 
 
 # --------------------------------------------------------------------------------------------------------------------
@@ -20,6 +21,37 @@ def uri(service, path=''):
     return ref
 
 
+# --------------------------------------------------------------------------------------------------------------------
+def get_token(username='ralph', password='secret'):
+    response = requests.post(uri('auth', '/tokens'), headers=login_header(username, password))
+    assert response.status_code == 201
+    return response.json()['token']
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def get_file_type_id(name, token):
+    response = requests.get(uri('storage', '/file-types?name={}'.format(name)), headers=token_header(token))
+    assert response.status_code == 200
+    return response.json()[0]['id']
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def get_scan_type_id(name, token):
+    response = requests.get(uri('storage', '/scan-types?name={}'.format(name)), headers=token_header(token))
+    assert response.status_code == 200
+    return response.json()[0]['id']
+
+
+# --------------------------------------------------------------------------------------------------------------------
+def create_repository(token, name=None):
+    # Creates a repository with the given or a random name and returns its ID
+    if name is None:
+        name = 'repository-{}'.format(generate_string(8))
+    response = requests.post(uri('storage', '/repositories'), json={'name': name}, headers=token_header(token))
+    assert response.status_code == 201
+    return response.json()['id']
+
+
 # --------------------------------------------------------------------------------------------------------------------
 def read_chunks(file_obj, chunk_size):
     while True:
@@ -63,6 +95,18 @@ def upload_file(file_name, file_type_id, scan_type_id, repository_id, token):
     return file_id, storage_id
 
 
+# --------------------------------------------------------------------------------------------------------------------
+def upload_content(content, file_type_id, scan_type_id, repository_id, token):
+    # Uploads the content as a temporary text file and returns its file ID and storage ID
+    file_name = 'tmp-{}.txt'.format(generate_string(8))
+    with open(file_name, 'w') as f:
+        f.write(content)
+    try:
+        return upload_file(file_name, file_type_id, scan_type_id, repository_id, token)
+    finally:
+        os.remove(file_name)
+
+
 # --------------------------------------------------------------------------------------------------------------------
 def download_file(storage_id, target_dir, token, extension=None):
     response = requests.get(uri('storage', '/downloads/{}'.format(storage_id)), headers=token_header(token))
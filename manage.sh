@@ -168,6 +168,10 @@ elif [ "${1}" == "up" ]; then
             --workdir /var/www/backend \
             --mount type=volume,source=postgres,target=/var/lib/postgres/data \
             --env AUTH_SERVICE_SETTINGS=/var/www/backend/service/auth/settings.py \
+            --env COMPUTE_SERVICE_HOST=compute \
+            --env COMPUTE_SERVICE_PORT=5001 \
+            --env STORAGE_SERVICE_HOST=storage \
+            --env STORAGE_SERVICE_PORT=5002 \
             --env DB_NAME=postgres \
             --env DB_USER=postgres \
             --env DB_PASS=postgres \
@@ -183,6 +187,7 @@ elif [ "${1}" == "up" ]; then
             --name worker \
             --network my-network \
             --workdir /var/www/backend \
+            --mount type=volume,source=files,target=/mnt/shared/files \
             --env COMPUTE_SERVICE_SETTINGS=/var/www/backend/service/compute/settings.py \
             --env BROKER_URL=amqp://rabbitmq:5672// \
             --env CELERY_RESULT_BACKEND=redis://redis:6379/0 \
@@ -191,6 +196,8 @@ elif [ "${1}" == "up" ]; then
             --env STORAGE_SERVICE_HOST=storage \
             --env STORAGE_SERVICE_PORT=5002 \
             --env C_FORCE_ROOT=1 \
+            --env CONTENT_CACHE_DIR=/tmp/yoda/content \
+            --env STORAGE_ROOT_DIR=/mnt/shared/files \
             --env DB_NAME=postgres \
             --env DB_USER=postgres \
             --env DB_PASS=postgres \